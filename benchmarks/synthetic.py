@@ -0,0 +1,258 @@
+# coding: utf-8
+"""Synthetic inputs for the benchmarks."""
+
+import struct
+
+import numpy as np
+
+DEFAULT_ANNOTATIONS = {
+    "HardwareSetting|ParameterCollection|Binning": "[4,4]",
+    "HardwareSetting|ParameterCollection|ImageFrame": "[96,24,1600,1400]",
+    "HardwareSetting|ParameterCollection|CameraLUT1": "[100]",
+    "HardwareSetting|ParameterCollection|CameraLUT2": "[4095]",
+    "HardwareSetting|ParameterCollection|ValidBits": "[12]",
+}
+
+
+def make_ome_xml(
+    tiles=1,
+    T=1,
+    Z=1,
+    channels=("Phase",),
+    size_x=400,
+    size_y=350,
+    n_extra_annotations=0,
+):
+    """
+    generate an OME-XML string shaped like the output of
+    `pycziutils.get_tiled_omexml_metadata`
+
+    Parameters
+    ----------
+    tiles : int, default 1
+        the number of tiles (OME images)
+    T : int, default 1
+        the number of time points
+    Z : int, default 1
+        the number of Z slices
+    channels : sequence of str, default ("Phase",)
+        the channel names
+    size_x, size_y : int
+        the image size in pixels
+    n_extra_annotations : int, default 0
+        the number of dummy OriginalMetadata entries added to the camera ones
+
+    Returns
+    -------
+    xml : str
+        the OME-XML string
+    """
+    C = len(channels)
+    out = [
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06">'
+    ]
+    for i in range(tiles):
+        x, y = -1000.0 + 100.0 * (i % 100), 100.0 + 100.0 * (i // 100)
+        out.append(
+            f'<Image ID="Image:{i}" Name="tile{i}">'
+            "<AcquisitionDate>2021-04-12T02:12:21.340</AcquisitionDate>"
+            f'<Pixels ID="Pixels:{i}" DimensionOrder="XYCZT" '
+            'PhysicalSizeX="1.3" PhysicalSizeXUnit="µm" '
+            'PhysicalSizeY="1.3" PhysicalSizeYUnit="µm" '
+            f'SizeC="{C}" SizeT="{T}" SizeX="{size_x}" SizeY="{size_y}" '
+            f'SizeZ="{Z}" Type="uint16">'
+        )
+        for c, name in enumerate(channels):
+            out.append(
+                f'<Channel ID="Channel:{i}:{c}" Name="{name}" SamplesPerPixel="1">'
+                "<LightPath/></Channel>"
+            )
+        for t in range(T):
+            for z in range(Z):
+                for c in range(C):
+                    out.append(
+                        f'<Plane DeltaT="{1.0 + 10.0 * t + 0.1 * c:.3f}" '
+                        'DeltaTUnit="s" '
+                        f'PositionX="{x}" PositionXUnit="µm" '
+                        f'PositionY="{y}" PositionYUnit="µm" '
+                        f'PositionZ="{0.5 * z}" PositionZUnit="µm" '
+                        f'TheC="{c}" TheT="{t}" TheZ="{z}"/>'
+                    )
+        out.append("</Pixels></Image>")
+
+    annotations = dict(DEFAULT_ANNOTATIONS)
+    for j in range(n_extra_annotations):
+        annotations[f"Information|Dummy|Key{j}"] = f"[{j}]"
+    out.append("<StructuredAnnotations>")
+    for j, (key, value) in enumerate(annotations.items()):
+        out.append(
+            f'<XMLAnnotation ID="Annotation:{j}" '
+            'Namespace="openmicroscopy.org/OriginalMetadata">'
+            "<Value><OriginalMetadata>"
+            f"<Key>{key}</Key><Value>{value}</Value>"
+            "</OriginalMetadata></Value></XMLAnnotation>"
+        )
+    out.append("</StructuredAnnotations></OME>")
+    return "".join(out)
+
+
+def _segment(sid, data):
+    """a CZI segment padded to a multiple of 32 bytes"""
+    allocated_size = -(-len(data) // 32) * 32
+    header = struct.pack("<16sqq", sid, allocated_size, len(data))
+    return header + data + bytes(allocated_size - len(data))
+
+
+def _directory_entry(file_position, compression, dimensions):
+    entry = struct.pack(
+        "<2siqiiB5si",
+        b"DV",
+        1,
+        file_position,
+        0,
+        compression,
+        0,
+        bytes(5),
+        len(dimensions),
+    )
+    for d, start, size in dimensions:
+        entry += struct.pack("<4siifi", d.encode(), start, size, 0.0, size)
+    return entry
+
+
+def _compress(pixels, compression):
+    import zstandard
+
+    data = pixels.tobytes()
+    if compression == "zstd0":
+        return zstandard.ZstdCompressor().compress(data)
+    # zstd1 with the hi-lo byte packing of 16 bit pixels
+    packed = np.frombuffer(data, dtype=np.uint8)
+    packed = np.concatenate([packed[0::2], packed[1::2]])
+    return bytes([3, 1, 1]) + zstandard.ZstdCompressor().compress(packed.tobytes())
+
+
+def make_czi(
+    path,
+    tiles=1,
+    T=1,
+    Z=1,
+    channels=("Phase",),
+    size_x=64,
+    size_y=48,
+    compression="uncompressed",
+    seed=0,
+):
+    """
+    write a minimal Gray16 CZI file with a mosaic of tiles
+
+    Parameters
+    ----------
+    path : str
+        the output path
+    tiles, T, Z : int, default 1
+        the number of tiles, time points and Z slices
+    channels : sequence of str, default ("Phase",)
+        the channel names
+    size_x, size_y : int
+        the tile size in pixels
+    compression : str, default "uncompressed"
+        "uncompressed", "zstd0" or "zstd1"
+    seed : int, default 0
+        the seed of the random pixel values
+
+    Returns
+    -------
+    pixels : numpy.ndarray
+        the written pixels with the shape (tiles, T, Z, C, Y, X)
+    """
+    compression_id = {"uncompressed": 0, "zstd0": 5, "zstd1": 6}[compression]
+    rng = np.random.default_rng(seed)
+    C = len(channels)
+    pixels = rng.integers(0, 4096, size=(tiles, T, Z, C, size_y, size_x))
+    pixels = pixels.astype("<u2")
+
+    position = 512
+    subblocks = []
+    entries = []
+    for m in range(tiles):
+        for t in range(T):
+            for z in range(Z):
+                for c in range(C):
+                    dimensions = [
+                        ("X", size_x * (m % 100), size_x),
+                        ("Y", size_y * (m // 100), size_y),
+                        ("C", c, 1),
+                        ("Z", z, 1),
+                        ("T", t, 1),
+                        ("M", m, 1),
+                        ("S", 0, 1),
+                    ]
+                    seconds = 13.0 + 10.0 * t + 0.1 * c
+                    metadata = (
+                        "<METADATA><Tags>"
+                        f"<AcquisitionTime>2021-04-12T02:15:{seconds:010.7f}Z"
+                        "</AcquisitionTime>"
+                        f"<StageXPosition>{100.0 * (m % 100)}</StageXPosition>"
+                        f"<StageYPosition>{100.0 * (m // 100)}</StageYPosition>"
+                        f"<FocusPosition>{0.5 * z}</FocusPosition>"
+                        "</Tags></METADATA>"
+                    ).encode()
+                    data = pixels[m, t, z, c]
+                    if compression_id == 0:
+                        data = data.tobytes()
+                    else:
+                        data = _compress(data, compression)
+                    entry = _directory_entry(position, compression_id, dimensions)
+                    header = struct.pack("<iiq", len(metadata), 0, len(data)) + entry
+                    header += bytes(max(256, len(header)) - len(header))
+                    segment = _segment(b"ZISRAWSUBBLOCK", header + metadata + data)
+                    subblocks.append(segment)
+                    entries.append(entry)
+                    position += len(segment)
+
+    directory_position = position
+    directory = _segment(
+        b"ZISRAWDIRECTORY",
+        struct.pack("<i", len(entries)) + bytes(124) + b"".join(entries),
+    )
+    metadata_position = directory_position + len(directory)
+    channel_xml = "".join(
+        f'<Channel Id="Channel:{c}" Name="{name}" />' for c, name in enumerate(channels)
+    )
+    metadata_xml = (
+        "<ImageDocument><Metadata><Information><Image>"
+        "<AcquisitionDateAndTime>2021-04-12T02:15:12.5000000Z"
+        "</AcquisitionDateAndTime>"
+        f"<SizeX>{size_x}</SizeX><SizeY>{size_y}</SizeY><SizeC>{C}</SizeC>"
+        f"<Dimensions><Channels>{channel_xml}</Channels></Dimensions>"
+        "</Image></Information></Metadata></ImageDocument>"
+    ).encode()
+    metadata = _segment(
+        b"ZISRAWMETADATA",
+        struct.pack("<ii", len(metadata_xml), 0) + bytes(248) + metadata_xml,
+    )
+    file_header = struct.pack(
+        "<iiii16s16siqqiq",
+        1,
+        0,
+        0,
+        0,
+        bytes(16),
+        bytes(16),
+        0,
+        directory_position,
+        metadata_position,
+        0,
+        0,
+    )
+    file_header += bytes(512 - 32 - len(file_header))
+
+    with open(path, "wb") as f:
+        f.write(_segment(b"ZISRAWFILE", file_header))
+        for segment in subblocks:
+            f.write(segment)
+        f.write(directory)
+        f.write(metadata)
+    return pixels
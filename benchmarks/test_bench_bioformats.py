@@ -0,0 +1,58 @@
+# coding: utf-8
+"""Benchmarks for the metadata extraction and the reads through Bio-Formats."""
+
+import numpy as np
+import pycziutils
+import pytest
+from synthetic import make_czi
+
+# tiles x 2 time points x 2 channels
+SHAPE = dict(T=2, Z=1, channels=("Phase", "EGFP"), size_x=256, size_y=256)
+
+
+@pytest.fixture(scope="module", params=[10, 500], ids=lambda n: f"{n}_tiles")
+def czi_path(request, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("czi") / f"{request.param}_tiles.czi")
+    make_czi(path, tiles=request.param, **SHAPE)
+    return path
+
+
+@pytest.mark.benchmark(group="get_tiled_omexml_metadata")
+@pycziutils.with_javabridge
+def test_get_tiled_omexml_metadata(benchmark, czi_path):
+    ome_xml = benchmark(pycziutils.get_tiled_omexml_metadata, czi_path)
+    benchmark.extra_info["omexml_length"] = len(ome_xml)
+
+
+@pytest.mark.benchmark(group="get_tiled_reader")
+@pycziutils.with_javabridge
+def test_get_tiled_reader(benchmark, czi_path):
+    def open_reader():
+        reader = pycziutils.get_tiled_reader(czi_path)
+        reader.close()
+
+    benchmark(open_reader)
+
+
+@pytest.mark.benchmark(group="bioformats_read")
+@pytest.mark.parametrize("method", ["read", "read_plane"])
+@pycziutils.with_javabridge
+def test_bioformats_read(benchmark, czi_path, method):
+    planes_df = pycziutils.parse_planes(pycziutils.get_tiled_omexml_metadata(czi_path))
+    reader = pycziutils.get_tiled_reader(czi_path)
+    try:
+        keys = planes_df[["image", "T_index", "Z_index", "C_index"]].to_numpy()
+        out = np.empty((SHAPE["size_y"], SHAPE["size_x"]), dtype=np.uint16)
+
+        def read_all():
+            for image, t, z, c in keys:
+                if method == "read":
+                    reader.read(series=image, t=t, z=z, c=c, rescale=False)
+                else:
+                    pycziutils.read_plane(reader, image, t, z, c, out=out)
+
+        benchmark(read_all)
+    finally:
+        reader.close()
+    benchmark.extra_info["planes"] = len(keys)
+    benchmark.extra_info["bytes_per_plane"] = out.nbytes
@@ -0,0 +1,33 @@
+# coding: utf-8
+"""Benchmarks for the JVM-free CZI reader."""
+
+import pycziutils
+import pytest
+from synthetic import make_czi
+
+
+@pytest.fixture(scope="module", params=["uncompressed", "zstd0", "zstd1"])
+def czi_path(request, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("czi") / f"{request.param}.czi")
+    make_czi(path, tiles=2000, channels=("Phase", "EGFP"), compression=request.param)
+    return path
+
+
+@pytest.mark.benchmark(group="get_czi_planes")
+def test_get_czi_planes(benchmark, czi_path):
+    planes_df = benchmark(pycziutils.get_czi_planes, czi_path)
+    assert len(planes_df) == 4000
+
+
+@pytest.mark.benchmark(group="czi_read")
+def test_czi_read(benchmark, czi_path):
+    with pycziutils.CziFile(czi_path) as czi:
+        planes_df = czi.get_planes()
+        keys = planes_df[["image", "T_index", "Z_index", "C_index"]].to_numpy()
+
+        def read_all():
+            for image, t, z, c in keys:
+                czi.read(series=image, t=t, z=z, c=c)
+
+        benchmark(read_all)
+        benchmark.extra_info["planes"] = len(keys)
@@ -0,0 +1,23 @@
+# coding: utf-8
+"""Benchmarks for the import time of pycziutils, in new interpreters."""
+
+import subprocess
+import sys
+
+import pytest
+
+STATEMENTS = {
+    "python": "pass",
+    "import": "import pycziutils",
+    "parsers": "import pycziutils; pycziutils.parse_planes",
+    "readers": "import pycziutils; pycziutils.get_tiled_reader",
+}
+
+
+@pytest.mark.benchmark(group="import")
+@pytest.mark.parametrize("statement", list(STATEMENTS))
+def test_import(benchmark, statement):
+    command = [sys.executable, "-c", STATEMENTS[statement]]
+    benchmark.pedantic(
+        subprocess.run, args=(command,), kwargs=dict(check=True), rounds=5
+    )
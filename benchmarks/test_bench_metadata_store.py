@@ -0,0 +1,60 @@
+# coding: utf-8
+"""Benchmarks for the metadata extraction and the reader initialization."""
+
+from glob import glob
+from os import path
+
+import pycziutils
+import pytest
+
+CZI_PATHS = sorted(
+    glob(path.join(path.dirname(__file__), "..", "tests", "data", "*.czi"))
+)
+
+
+@pytest.mark.benchmark(group="plane_table")
+@pytest.mark.parametrize("method", ["omexml", "metadata_store"])
+@pycziutils.with_javabridge
+def test_plane_table(benchmark, method):
+    name = CZI_PATHS[0]
+    if method == "omexml":
+        planes_df = benchmark(
+            lambda: pycziutils.parse_planes(pycziutils.get_tiled_omexml_metadata(name))
+        )
+    else:
+        planes_df = benchmark(pycziutils.get_tiled_planes, name)
+    assert len(planes_df) > 0
+
+
+@pytest.mark.benchmark(group="omexml_metadata_level")
+@pytest.mark.parametrize(
+    "metadata_level,original_metadata_keys",
+    [
+        ("all", None),
+        ("all", ["HardwareSetting|ParameterCollection|*"]),
+        ("no_overlays", []),
+        ("minimum", []),
+    ],
+)
+@pycziutils.with_javabridge
+def test_omexml_metadata_level(benchmark, metadata_level, original_metadata_keys):
+    xml = benchmark(
+        pycziutils.get_tiled_omexml_metadata,
+        CZI_PATHS[0],
+        metadata_level=metadata_level,
+        original_metadata_keys=original_metadata_keys,
+    )
+    benchmark.extra_info["omexml_length"] = len(xml)
+
+
+@pytest.mark.benchmark(group="reader_metadata_level")
+@pytest.mark.parametrize("metadata_level", ["all", "no_overlays", "minimum"])
+@pycziutils.with_javabridge
+def test_reader_metadata_level(benchmark, metadata_level):
+    def open_reader():
+        reader = pycziutils.get_tiled_reader(
+            CZI_PATHS[0], metadata_level=metadata_level
+        )
+        reader.close()
+
+    benchmark(open_reader)
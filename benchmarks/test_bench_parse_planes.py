@@ -0,0 +1,103 @@
+# coding: utf-8
+"""Benchmarks for `pycziutils.parse_planes`."""
+
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+import pycziutils
+import pytest
+from synthetic import make_ome_xml
+
+# 5000 tiles x 5 time points x 4 channels = 100k planes
+N_PLANES_SHAPE = dict(tiles=5000, T=5, Z=1, channels=("Phase", "EGFP", "Cy3", "DAPI"))
+
+
+def parse_planes_per_image(ome_xml, acquisition_timezone=0):
+    """the former per-image implementation, kept as the baseline"""
+    keys = ["@PositionX", "@PositionY", "@PositionZ", "@DeltaT"]
+    keys += ["@TheC", "@TheT", "@TheZ"]
+    names = ["X", "Y", "Z", "T", "C_index", "T_index", "Z_index"]
+    positions = pycziutils.parse_properties(ome_xml, keys, domain="plane")
+    acq_dates = pycziutils.parse_properties(ome_xml, "AcquisitionDate", "image")
+    dfs = []
+    for j, (ps, acq_date) in enumerate(zip(positions, acq_dates)):
+        df = pd.DataFrame(data=ps, columns=names, dtype=np.float64)
+        df["image"] = j
+        df["plane"] = range(len(ps))
+        if isinstance(acquisition_timezone, int):
+            acquisition_timezone = timezone(timedelta(hours=acquisition_timezone))
+        acq_date = (
+            datetime.strptime(acq_date, "%Y-%m-%dT%H:%M:%S.%f")
+            .replace(tzinfo=timezone.utc)
+            .astimezone(acquisition_timezone)
+        )
+        df["image_acquisition_T"] = acq_date
+        dfs.append(df)
+    planes_df = pd.concat(dfs)
+    for k in [n for n in names if "index" in n] + ["image", "plane"]:
+        planes_df[k] = planes_df[k].astype(int)
+    non_nan_indices = ~planes_df["T"].isna()
+    planes_df.loc[non_nan_indices, "absolute_T"] = planes_df.loc[
+        non_nan_indices, "image_acquisition_T"
+    ] + np.vectorize(timedelta)(
+        seconds=planes_df.loc[non_nan_indices, "T"].astype(np.float64)
+    )
+    planes_df = planes_df.reset_index()
+    channels = pycziutils.parse_channels(ome_xml)
+    planes_df["C"] = planes_df["C_index"].apply(lambda i: channels[i]["@Name"])
+    return planes_df
+
+
+def peak_memory_mb(func, *args, **kwargs):
+    """the peak memory allocated by Python during the call in MB"""
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.fixture(scope="module")
+def large_ome_xml():
+    return make_ome_xml(**N_PLANES_SHAPE)
+
+
+@pytest.fixture(scope="module")
+def large_metadata():
+    metadata = pycziutils.CziMetadata(make_ome_xml(**N_PLANES_SHAPE))
+    metadata.planes  # parse in advance to measure the DataFrame building only
+    return metadata
+
+
+@pytest.mark.benchmark(group="parse_planes")
+def test_parse_planes(benchmark, large_metadata):
+    planes_df = benchmark(pycziutils.parse_planes, large_metadata)
+    assert len(planes_df) == 100000
+
+
+@pytest.mark.benchmark(group="parse_planes")
+def test_parse_planes_per_image_baseline(benchmark, large_metadata):
+    planes_df = benchmark.pedantic(
+        parse_planes_per_image, args=(large_metadata,), rounds=1, iterations=1
+    )
+    assert len(planes_df) == 100000
+
+
+@pytest.mark.benchmark(group="parse_planes_from_xml")
+@pytest.mark.parametrize("backend", ["xmltodict", "iterparse"])
+def test_parse_planes_from_xml(benchmark, large_ome_xml, backend):
+    benchmark.extra_info["xml_size_mb"] = len(large_ome_xml) / 2**20
+    benchmark.extra_info["peak_memory_mb"] = peak_memory_mb(
+        pycziutils.parse_planes, large_ome_xml, backend=backend
+    )
+    planes_df = benchmark.pedantic(
+        pycziutils.parse_planes,
+        args=(large_ome_xml,),
+        kwargs=dict(backend=backend),
+        rounds=3,
+        iterations=1,
+    )
+    assert len(planes_df) == 100000
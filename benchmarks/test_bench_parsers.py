@@ -0,0 +1,79 @@
+# coding: utf-8
+"""Benchmarks for `pycziutils.parse_properties` and the annotation parsers."""
+
+import pycziutils
+import pytest
+from synthetic import make_ome_xml
+
+# 1000 tiles x 2 time points x 2 channels = 4000 planes
+SHAPE = dict(tiles=1000, T=2, Z=1, channels=("Phase", "EGFP"))
+
+PROPERTIES = {
+    "image": ["@ID", "@Name", "AcquisitionDate"],
+    "pixels": ["@SizeX", "@SizeY", "@PhysicalSizeX", "@PhysicalSizeY"],
+    "plane": ["@PositionX", "@PositionY", "@TheC", "@TheT"],
+}
+
+ANNOTATION_PARSERS = [
+    "parse_structured_annotation_dict",
+    "parse_binning",
+    "parse_camera_roi",
+    "parse_camera_roi_slice",
+    "parse_camera_LUT",
+    "parse_camera_bits",
+]
+
+
+@pytest.fixture(scope="module")
+def ome_xml():
+    return make_ome_xml(**SHAPE)
+
+
+@pytest.fixture(scope="module", params=[0, 10000], ids=lambda n: f"{n}_extra_keys")
+def annotated_ome_xml(request):
+    return make_ome_xml(**SHAPE, n_extra_annotations=request.param)
+
+
+@pytest.mark.benchmark(group="parse_properties")
+@pytest.mark.parametrize("backend", ["xmltodict", "iterparse"])
+@pytest.mark.parametrize("domain", list(PROPERTIES))
+def test_parse_properties(benchmark, ome_xml, domain, backend):
+    # from the string, so that the OME-XML is parsed in each round
+    properties = benchmark(
+        pycziutils.parse_properties, ome_xml, PROPERTIES[domain], domain, backend
+    )
+    assert len(properties) == SHAPE["tiles"]
+
+
+@pytest.mark.benchmark(group="parse_properties_parsed")
+@pytest.mark.parametrize("domain", list(PROPERTIES))
+def test_parse_properties_parsed(benchmark, ome_xml, domain):
+    metadata = pycziutils.CziMetadata(ome_xml)
+    metadata.parse_properties(PROPERTIES[domain], domain)
+    properties = benchmark(metadata.parse_properties, PROPERTIES[domain], domain)
+    assert len(properties) == SHAPE["tiles"]
+
+
+@pytest.mark.benchmark(group="parse_channels")
+@pytest.mark.parametrize("parser", ["parse_channels", "parse_pixel_size"])
+def test_parse_channels(benchmark, ome_xml, parser):
+    benchmark(getattr(pycziutils, parser), ome_xml)
+
+
+@pytest.mark.benchmark(group="annotation_parsers")
+@pytest.mark.parametrize("parser", ANNOTATION_PARSERS)
+def test_annotation_parser(benchmark, annotated_ome_xml, parser):
+    benchmark.extra_info["xml_size_mb"] = len(annotated_ome_xml) / 2**20
+    benchmark(getattr(pycziutils, parser), annotated_ome_xml)
+
+
+@pytest.mark.benchmark(group="annotation_parsers_parsed")
+def test_annotation_parsers_parsed(benchmark, annotated_ome_xml):
+    metadata = pycziutils.CziMetadata(annotated_ome_xml)
+    metadata.annotations  # parse in advance to measure the lookups only
+
+    def parse_all():
+        return [getattr(pycziutils, parser)(metadata) for parser in ANNOTATION_PARSERS]
+
+    results = benchmark(parse_all)
+    assert results[1] == [4, 4]
@@ -0,0 +1,64 @@
+# coding: utf-8
+"""Benchmarks for the region reads, against cropping full planes."""
+
+from glob import glob
+from os import path
+
+import numpy as np
+import pycziutils
+import pytest
+from synthetic import make_czi
+
+# (x, y, w, h) in the planes
+REGIONS = {"small": (100, 200, 64, 64), "full": (0, 0, 1024, 1024)}
+
+
+@pytest.fixture(scope="module")
+def czi_path(tmp_path_factory):
+    czi_path = str(tmp_path_factory.mktemp("czi") / "large.czi")
+    make_czi(czi_path, tiles=16, size_x=1024, size_y=1024)
+    return czi_path
+
+
+@pytest.mark.benchmark(group="czi_region")
+@pytest.mark.parametrize("region", list(REGIONS))
+@pytest.mark.parametrize("method", ["crop", "region"])
+def test_czi_region(benchmark, czi_path, method, region):
+    x, y, w, h = REGIONS[region]
+    with pycziutils.CziFile(czi_path) as czi:
+
+        def read_all():
+            for image in range(16):
+                if method == "crop":
+                    crop = np.array(czi.read(series=image))[y : y + h, x : x + w]
+                else:
+                    crop = np.array(czi.read(series=image, region=(x, y, w, h)))
+            return crop
+
+        crop = benchmark(read_all)
+        assert crop.shape == (h, w)
+        # the bytes copied out of the file per plane
+        benchmark.extra_info["bytes_per_plane"] = (
+            crop.nbytes if method == "region" else 1024 * 1024 * 2
+        )
+
+
+@pytest.mark.benchmark(group="bioformats_region")
+@pytest.mark.parametrize("method", ["crop", "region"])
+@pycziutils.with_javabridge
+def test_bioformats_region(benchmark, method):
+    name = sorted(
+        glob(path.join(path.dirname(__file__), "..", "tests", "data", "*.czi"))
+    )[0]
+    x, y, w, h = 100, 50, 32, 32
+    with pycziutils.TiledReaderPool() as pool:
+        if method == "crop":
+            crop = benchmark(
+                lambda: pool.read(name, rescale=False)[y : y + h, x : x + w]
+            )
+            shape = pool.read(name, rescale=False).shape
+            benchmark.extra_info["bytes_transferred"] = int(np.prod(shape)) * 2
+        else:
+            crop = benchmark(lambda: pool.read(name, region=(x, y, w, h)))
+            benchmark.extra_info["bytes_transferred"] = crop.nbytes
+    assert crop.shape == (h, w)
@@ -11,26 +11,100 @@ __author__ = """Yohsuke T. Fukai"""
 __email__ = "ysk@yfukai.net"
 __version__ = "0.3.1"
 
-from ._parsers import (
-    parse_binning,
-    parse_camera_bits,
-    parse_camera_LUT,
-    parse_camera_roi,
-    parse_camera_roi_slice,
-    parse_channels,
-    parse_pixel_size,
-    parse_planes,
-    parse_properties,
-    parse_structured_annotation_dict,
-    summarize_image_size,
-)
-from ._readers import get_tiled_omexml_metadata, get_tiled_reader, with_javabridge
+import importlib
+
+# the public names by the submodule defining them. the submodules are imported
+# on the first access to their names, so that importing the package does not
+# load bioformats, javabridge (and the JVM), pandas or xmltodict, and the
+# parsers work without Java
+_SUBMODULE_NAMES = {
+    "_annotations": ["AnnotationStore"],
+    "_batch": ["MetadataResult", "extract_metadata_many", "read_planes"],
+    "_cache": ["MetadataCache"],
+    "_czifile": ["CziFile", "get_czi_planes"],
+    "_export": ["export_zarr"],
+    "_index": ["PlaneIndex"],
+    "_lazy": ["LazyTiledArray", "open_lazy"],
+    "_parsers": [
+        "CziMetadata",
+        "parse_binning",
+        "parse_camera_bits",
+        "parse_camera_LUT",
+        "parse_camera_roi",
+        "parse_camera_roi_slice",
+        "parse_channels",
+        "parse_pixel_size",
+        "parse_planes",
+        "parse_properties",
+        "parse_structured_annotation_dict",
+        "summarize_image_size",
+    ],
+    "_pool": ["TiledReaderPool"],
+    "_readers": [
+        "JavabridgeSession",
+        "get_tiled_omexml_metadata",
+        "get_tiled_planes",
+        "get_tiled_reader",
+        "get_resolution_sizes",
+        "javabridge_session",
+        "read_plane",
+        "with_javabridge",
+    ],
+    "_reduce": ["reduce_planes"],
+    "_shading": ["ShadingCorrection", "estimate_shading"],
+    "_stitch": ["MosaicCanvas", "get_tile_offsets", "make_overview", "stitch_tiles"],
+    "_tilecache": ["CachedReader", "TileCache"],
+}
+_NAME_SUBMODULES = {
+    name: submodule for submodule, names in _SUBMODULE_NAMES.items() for name in names
+}
+
+
+def __getattr__(name):
+    if name not in _NAME_SUBMODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    submodule = importlib.import_module("." + _NAME_SUBMODULES[name], __name__)
+    value = getattr(submodule, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_NAME_SUBMODULES))
+
 
 # __all__ = [name for name in dir() if not name.startswith("_")]
 __all__ = [
+    "CziFile",
+    "CziMetadata",
+    "AnnotationStore",
+    "get_czi_planes",
+    "MetadataCache",
+    "PlaneIndex",
     "get_tiled_omexml_metadata",
+    "get_tiled_planes",
     "get_tiled_reader",
     "with_javabridge",
+    "read_plane",
+    "get_resolution_sizes",
+    "javabridge_session",
+    "JavabridgeSession",
+    "TiledReaderPool",
+    "read_planes",
+    "extract_metadata_many",
+    "MetadataResult",
+    "open_lazy",
+    "LazyTiledArray",
+    "get_tile_offsets",
+    "MosaicCanvas",
+    "stitch_tiles",
+    "make_overview",
+    "export_zarr",
+    "reduce_planes",
+    "estimate_shading",
+    "ShadingCorrection",
+    "TileCache",
+    "CachedReader",
     "parse_binning",
     "parse_camera_bits",
     "parse_camera_LUT",
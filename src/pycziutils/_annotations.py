@@ -0,0 +1,222 @@
+# coding: utf-8
+"""
+Indexed store of the original metadata in the structured annotations
+
+Only the StructuredAnnotations element of the OME-XML is parsed, once, and
+the JSON values are decoded on the first access.
+"""
+
+import bisect
+import json
+import re
+import xml.etree.ElementTree as ET
+from collections.abc import Mapping
+
+import numpy as np
+
+from ._iterparse import _local_name
+
+HARDWARE_SETTING_PREFIX = "HardwareSetting|ParameterCollection|"
+_START_PATTERN = re.compile(r"<(?:[\w.-]+:)?StructuredAnnotations[\s/>]")
+_END_TAG = "StructuredAnnotations>"
+
+
+def _parse_original_metadata(xml, chunk_size=2**20):
+    """the OriginalMetadata Key and Value texts in xml as a dict"""
+    parser = ET.XMLPullParser(events=("start", "end"))
+    values = {}
+    names = []
+    current = {}
+
+    def handle_events():
+        for event, elem in parser.read_events():
+            name = _local_name(elem.tag)
+            if event == "start":
+                names.append(name)
+                continue
+            names.pop()
+            if names and names[-1] == "OriginalMetadata":
+                if name in ("Key", "Value"):
+                    current[name] = elem.text
+            elif name == "OriginalMetadata":
+                if current.get("Key") is not None:
+                    values[current["Key"]] = current.get("Value")
+                current.clear()
+            elif name == "XMLAnnotation":
+                elem.clear()
+
+    for i in range(0, len(xml), chunk_size):
+        parser.feed(xml[i : i + chunk_size])
+        handle_events()
+    parser.close()
+    handle_events()
+    return values
+
+
+def _structured_annotations(ome_xml):
+    """
+    the original metadata of the OME-XML, parsing only the
+    StructuredAnnotations element if possible
+    """
+    match = _START_PATTERN.search(ome_xml)
+    if match is None:
+        return {}
+    end = ome_xml.rfind(_END_TAG)
+    if end > match.start():
+        try:
+            return _parse_original_metadata(
+                ome_xml[match.start() : end + len(_END_TAG)]
+            )
+        except ET.ParseError:
+            pass  # such as an undeclared namespace prefix in the fragment
+    return _parse_original_metadata(ome_xml)
+
+
+class AnnotationStore(Mapping):
+    """
+    read-only mapping of the OriginalMetadata keys to the raw values in the
+    structured annotations of OME-XML
+
+    The keys are indexed once for the prefix lookup, and the JSON values are
+    decoded on the first access by :meth:`value` and cached.
+
+    Parameters
+    ----------
+    ome_xml : str
+        the input OME-XML string
+
+    Examples
+    --------
+    >>> annotations = pycziutils.CziMetadata(ome_xml).annotations
+    >>> annotations["HardwareSetting|ParameterCollection|Binning"]
+    '[4,4]'
+    >>> annotations.value("HardwareSetting|ParameterCollection|Binning")
+    [4, 4]
+    >>> annotations.keys_with_prefix("HardwareSetting|ParameterCollection|*")
+    """
+
+    def __init__(self, ome_xml):
+        self._raw = _structured_annotations(ome_xml)
+        self._decoded = {}
+        self._sorted_keys = None
+
+    def __getitem__(self, key):
+        return self._raw[key]
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __repr__(self):
+        return f"<AnnotationStore {len(self)} keys>"
+
+    def value(self, key):
+        """
+        get the value decoded as JSON, or the raw string if not JSON
+
+        Parameters
+        ----------
+        key : str
+            the OriginalMetadata key
+
+        Returns
+        -------
+        value : object
+            the decoded value, cached and shared by the callers
+        """
+        if key not in self._decoded:
+            raw = self._raw[key]
+            try:
+                self._decoded[key] = json.loads(raw)
+            except (TypeError, ValueError):
+                self._decoded[key] = raw
+        return self._decoded[key]
+
+    def keys_with_prefix(self, prefix):
+        """
+        get the keys starting with the prefix
+
+        Parameters
+        ----------
+        prefix : str
+            the prefix. a trailing "*" is ignored
+
+        Returns
+        -------
+        keys : list of str
+            the sorted keys
+        """
+        if prefix.endswith("*"):
+            prefix = prefix[:-1]
+        if self._sorted_keys is None:
+            self._sorted_keys = sorted(self._raw)
+        keys = []
+        for key in self._sorted_keys[bisect.bisect_left(self._sorted_keys, prefix) :]:
+            if not key.startswith(prefix):
+                break
+            keys.append(key)
+        return keys
+
+    def with_prefix(self, prefix):
+        """
+        get the decoded values of the keys starting with the prefix
+
+        Parameters
+        ----------
+        prefix : str
+            the prefix, see :meth:`keys_with_prefix`
+
+        Returns
+        -------
+        values : dict
+            {key : the decoded value}
+        """
+        return {key: self.value(key) for key in self.keys_with_prefix(prefix)}
+
+    def hardware_setting(self, name):
+        """
+        get the decoded value of "HardwareSetting|ParameterCollection|" + name
+
+        Parameters
+        ----------
+        name : str
+            the name of the setting, such as "Binning"
+
+        Returns
+        -------
+        value : object
+            the decoded value
+        """
+        return self.value(HARDWARE_SETTING_PREFIX + name)
+
+    @property
+    def binning(self):
+        """the binning as [x,y]"""
+        return list(self.hardware_setting("Binning"))
+
+    @property
+    def camera_roi(self):
+        """the camera ROI (x0,y0,x1,y1) as a list"""
+        # or 'HardwareSetting|ParameterCollection|Frame'?
+        return list(self.hardware_setting("ImageFrame"))[:4]
+
+    @property
+    def camera_LUT(self):
+        """the LUT as (lut1,lut2), (np.nan,np.nan) if not found"""
+        try:
+            lut1 = self.hardware_setting("CameraLUT1")
+            lut2 = self.hardware_setting("CameraLUT2")
+        except KeyError:
+            return (np.nan, np.nan)
+        assert len(lut1) == 1
+        assert len(lut2) == 1
+        return (lut1[0], lut2[0])
+
+    @property
+    def camera_bits(self):
+        """the camera valid bits"""
+        res = list(self.hardware_setting("ValidBits"))
+        assert len(res) == 1
+        return res[0]
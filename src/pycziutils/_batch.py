@@ -0,0 +1,292 @@
+# coding: utf-8
+"""
+Concurrent reading of planes and metadata
+"""
+
+import multiprocessing
+import pickle
+import traceback
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from ._parsers import parse_planes
+from ._pool import TiledReaderPool, _attached_executor
+from ._readers import get_tiled_omexml_metadata, javabridge_session
+
+_INDEX_COLUMNS = ["image", "T_index", "Z_index", "C_index"]
+_READ_BACKENDS = ["threads", "processes"]
+
+# the reader pool of a worker process
+_worker_pool = None
+
+
+def _read_plane(pool, path, row, kwargs):
+    image, t, z, c = row
+    return pool.read(path, series=image, t=t, z=z, c=c, **kwargs)
+
+
+def _init_worker():
+    global _worker_pool
+    _worker_pool = TiledReaderPool()
+
+
+def _read_plane_in_worker(path, row, kwargs):
+    return _read_plane(_worker_pool, path, row, kwargs)
+
+
+def read_planes(
+    path,
+    planes_df,
+    workers=4,
+    backend="threads",
+    max_in_flight=None,
+    pool=None,
+    correction=None,
+    **kwargs,
+):
+    """
+    read the planes in the rows of planes_df concurrently
+
+    Parameters
+    ----------
+    path : str
+        path to the czi file
+    planes_df : pandas.DataFrame
+        the planes to read, with the columns "image", "T_index", "Z_index"
+        and "C_index", such as the output of :func:`pycziutils.parse_planes`
+    workers : int, default 4
+        the number of worker threads or processes
+    backend : str, default "threads"
+        "threads" to read with threads attached to the JVM, or "processes"
+        to read with worker processes, each running its own JVM
+    max_in_flight : int, default None
+        the maximum number of planes being read or waiting to be copied
+        into the output, to cap the memory. 2 * workers if None
+    pool : TiledReaderPool, default None
+        the reader pool used by the "threads" backend. a pool with
+        readers_per_file=workers is used and closed if None
+    correction : ShadingCorrection, default None
+        if given, the planes are corrected by it while being copied into the
+        output, such as the output of :func:`pycziutils.estimate_shading`.
+        the output is float32
+    **kwargs
+        passed to bioformats.ImageReader.read, such as rescale=False
+
+    Returns
+    -------
+    images : numpy.ndarray
+        the planes in the order of the rows, with the shape
+        (len(planes_df), Y, X) or (len(planes_df), Y, X, RGB)
+    """
+    if backend not in _READ_BACKENDS:
+        raise ValueError(f"backend must be one of {_READ_BACKENDS}")
+    rows = planes_df[_INDEX_COLUMNS].to_numpy(dtype=int).tolist()
+    if not rows:
+        raise ValueError("planes_df has no rows")
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+
+    own_pool = False
+    if backend == "processes":
+        # spawned, as a forked process cannot use the JVM of the parent
+        executor_context = ProcessPoolExecutor(
+            workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+
+        def submit(i):
+            return executor.submit(_read_plane_in_worker, path, rows[i], kwargs)
+
+    else:
+        if pool is None:
+            pool = TiledReaderPool(readers_per_file=workers, max_files=1)
+            own_pool = True
+        executor_context = _attached_executor(workers)
+
+        def submit(i):
+            return executor.submit(_read_plane, pool, path, rows[i], kwargs)
+
+    images = None
+    pending = {}
+    next_row = 0
+    try:
+        with executor_context as executor:
+            while next_row < len(rows) or pending:
+                while next_row < len(rows) and len(pending) < max_in_flight:
+                    pending[submit(next_row)] = next_row
+                    next_row += 1
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    image = future.result()
+                    i = pending.pop(future)
+                    if images is None:
+                        dtype = image.dtype if correction is None else np.float32
+                        images = np.empty((len(rows),) + image.shape, dtype)
+                    if correction is None:
+                        images[i] = image
+                    else:
+                        correction.apply(image, rows[i][3], out=images[i])
+    except BaseException:
+        for future in pending:
+            future.cancel()
+        raise
+    finally:
+        if own_pool:
+            pool.close()
+    return images
+
+
+MetadataResult = namedtuple("MetadataResult", ["path", "ome_xml", "planes_df", "error"])
+MetadataResult.__doc__ = """
+the metadata of a file extracted by :func:`pycziutils.extract_metadata_many`
+
+Attributes
+----------
+path : str
+    path to the czi file
+ome_xml : str
+    the OME-XML string, None if failed
+planes_df : pandas.DataFrame
+    the output of :func:`pycziutils.parse_planes`, None if failed
+error : Exception
+    the exception raised for the file, None if succeeded. an exception that
+    cannot be sent from the worker process, such as javabridge.JavaException,
+    is replaced by a RuntimeError with its message and traceback
+"""
+
+
+def _init_metadata_worker():
+    javabridge_session.start()
+
+
+def _picklable_error(e):
+    """
+    the exception if picklable, otherwise (such as javabridge.JavaException
+    holding a Java object) a RuntimeError with the message and the traceback
+    """
+    try:
+        pickle.loads(pickle.dumps(e))
+        return e
+    except Exception:
+        message = "".join(traceback.format_exception(type(e), e, e.__traceback__))
+        return RuntimeError(f"{type(e).__name__}: {e}\n{message}")
+
+
+def _extract_metadata(path, acquisition_timezone, group_file):
+    try:
+        ome_xml = get_tiled_omexml_metadata(path, group_file=group_file)
+        planes_df = parse_planes(ome_xml, acquisition_timezone=acquisition_timezone)
+    except Exception as e:
+        # sent back to the parent process
+        error = _picklable_error(e)
+        if error is e:
+            raise
+        raise error from None
+    return ome_xml, planes_df
+
+
+def _metadata_executor(processes):
+    # spawned, as a forked process cannot use the JVM of the parent
+    return ProcessPoolExecutor(
+        processes,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_metadata_worker,
+    )
+
+
+def _as_result(path, future):
+    try:
+        ome_xml, planes_df = future.result()
+    except Exception as e:
+        return MetadataResult(path, None, None, e)
+    return MetadataResult(path, ome_xml, planes_df, None)
+
+
+def extract_metadata_many(
+    paths,
+    processes=4,
+    acquisition_timezone=0,
+    group_file=True,
+    max_in_flight=None,
+):
+    """
+    extract the OME-XML and the planes DataFrame of many files in parallel
+
+    Each worker process starts its own JVM once and runs
+    :func:`pycziutils.get_tiled_omexml_metadata` and
+    :func:`pycziutils.parse_planes` for the files. An exception for a file is
+    returned in the result without stopping the others. If a worker process
+    dies (for example, by a crash of the JVM), the files being processed are
+    retried one by one in isolated processes at the end.
+
+    Parameters
+    ----------
+    paths : iterable of str
+        paths to the czi files
+    processes : int, default 4
+        the number of worker processes
+    acquisition_timezone : Union[datetime.timezone, int]
+        timezone to use, passed to parse_planes
+    group_file : bool, default True
+        passed to get_tiled_omexml_metadata
+    max_in_flight : int, default None
+        the maximum number of files submitted at once. 2 * processes if None
+
+    Yields
+    ------
+    result : MetadataResult
+        (path, ome_xml, planes_df, error) for each file, in the order of
+        completion
+    """
+    if max_in_flight is None:
+        max_in_flight = 2 * processes
+    args = (acquisition_timezone, group_file)
+    paths = iter(paths)
+    exhausted = False
+    suspects = []
+    pending = {}
+    executor = _metadata_executor(processes)
+    try:
+        while True:
+            while not exhausted and len(pending) < max_in_flight:
+                try:
+                    path = next(paths)
+                except StopIteration:
+                    exhausted = True
+                    break
+                try:
+                    future = executor.submit(_extract_metadata, path, *args)
+                except BrokenProcessPool:
+                    suspects.append(path)
+                    continue
+                pending[future] = path
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            broken = any(isinstance(f.exception(), BrokenProcessPool) for f in done)
+            if broken:
+                # the other files in the pool fail as well
+                done, _ = wait(pending)
+            for future in done:
+                path = pending.pop(future)
+                if isinstance(future.exception(), BrokenProcessPool):
+                    suspects.append(path)
+                else:
+                    yield _as_result(path, future)
+            if broken:
+                executor.shutdown()
+                executor = _metadata_executor(processes)
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown()
+
+    for path in suspects:
+        with _metadata_executor(1) as isolated_executor:
+            future = isolated_executor.submit(_extract_metadata, path, *args)
+            wait([future])
+        yield _as_result(path, future)
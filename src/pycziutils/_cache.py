@@ -0,0 +1,290 @@
+# coding: utf-8
+"""
+Persistent on-disk cache of the metadata extracted from CZI files
+
+Each entry is a directory named by the hash of the file identity
+(absolute path, size, modification time and the bioformats version),
+holding the gzip-compressed OME-XML and the plane table as NPZ.
+"""
+
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from ._czifile import get_czi_planes
+from ._parsers import _as_timezone, parse_planes
+
+_OMEXML_FILENAME = "omexml.xml.gz"
+_PLANES_FILENAME = "planes.npz"
+_KEY_PATTERN = re.compile(r"^[0-9a-f]{40}$")
+
+
+def _bioformats_version():
+    try:
+        from importlib.metadata import PackageNotFoundError, version
+    except ImportError:  # Python 3.7
+        from pkg_resources import DistributionNotFound as PackageNotFoundError
+        from pkg_resources import get_distribution
+
+        def version(name):
+            return get_distribution(name).version
+
+    try:
+        return version("python-bioformats")
+    except PackageNotFoundError:
+        return None
+
+
+def _default_cache_directory():
+    return os.environ.get(
+        "PYCZIUTILS_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "pycziutils"),
+    )
+
+
+def _save_planes(planes_df, f):
+    """save the plane table as NPZ, with the datetime columns in UTC"""
+    arrays = {}
+    tz_columns = []
+    for i, k in enumerate(planes_df.columns):
+        column = planes_df[k]
+        if isinstance(column.dtype, pd.DatetimeTZDtype):
+            tz_columns.append(k)
+            column = column.dt.tz_convert("UTC").dt.tz_localize(None)
+            arrays[f"column_{i}"] = column.to_numpy(dtype="datetime64[ns]")
+        elif column.dtype.kind in "biufcmM":
+            arrays[f"column_{i}"] = column.to_numpy()
+        else:
+            arrays[f"column_{i}"] = column.to_numpy(dtype=str)
+    np.savez_compressed(
+        f,
+        columns=np.array(planes_df.columns, dtype=str),
+        tz_columns=np.array(tz_columns, dtype=str),
+        **arrays,
+    )
+
+
+def _load_planes(filename, acquisition_timezone):
+    with np.load(filename) as npz:
+        columns = list(npz["columns"])
+        tz_columns = set(npz["tz_columns"])
+        data = {k: npz[f"column_{i}"] for i, k in enumerate(columns)}
+    planes_df = pd.DataFrame(
+        {k: v.astype(object) if v.dtype.kind == "U" else v for k, v in data.items()}
+    )
+    timezone = _as_timezone(acquisition_timezone)
+    for k in tz_columns:
+        planes_df[k] = planes_df[k].dt.tz_localize("UTC").dt.tz_convert(timezone)
+    return planes_df
+
+
+class MetadataCache:
+    """
+    on-disk cache of the OME-XML and the plane table of CZI files
+
+    The entries are keyed by the absolute path, the size and the modification
+    time of the file and the bioformats version, and the least recently used
+    entries are removed when the total size exceeds max_bytes.
+
+    Parameters
+    ----------
+    directory : str, default None
+        the cache directory. if None, $PYCZIUTILS_CACHE_DIR or
+        ~/.cache/pycziutils is used
+    max_bytes : int, default 2**30
+        the maximum total size of the cache in bytes
+
+    Attributes
+    ----------
+    hits : int
+        the number of the calls served from the cache
+    misses : int
+        the number of the calls extracting the metadata from the file
+    evictions : int
+        the number of evicted entries
+
+    Examples
+    --------
+    >>> cache = pycziutils.MetadataCache("path/to/cache")
+    >>> planes_df = cache.parse_planes("path/to/czi/file.czi")  # needs the JVM
+    >>> cache.hits, cache.misses
+    """
+
+    def __init__(self, directory=None, max_bytes=2**30):
+        if directory is None:
+            directory = _default_cache_directory()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _key(self, path, *options):
+        stat = os.stat(path)
+        identity = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        identity += (_bioformats_version(),) + options
+        return hashlib.sha1(repr(identity).encode("utf-8")).hexdigest()
+
+    def _lookup(self, key, name):
+        filename = os.path.join(self.directory, key, name)
+        if os.path.isfile(filename):
+            self.hits += 1
+            os.utime(os.path.join(self.directory, key))  # mark as recently used
+            return filename
+        else:
+            self.misses += 1
+            return None
+
+    def _store(self, key, name, write):
+        entry_directory = os.path.join(self.directory, key)
+        os.makedirs(entry_directory, exist_ok=True)
+        # written to a temporary file and renamed, for concurrent processes
+        fd, temp_filename = tempfile.mkstemp(dir=entry_directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(temp_filename, os.path.join(entry_directory, name))
+        except BaseException:
+            os.remove(temp_filename)
+            raise
+        os.utime(entry_directory)
+        self._evict(keep=key)
+
+    def _entries(self):
+        """[(last used time, size, entry directory)] sorted by the time"""
+        entries = []
+        for key in os.listdir(self.directory):
+            if not _KEY_PATTERN.match(key):
+                continue  # not created by the cache
+            entry_directory = os.path.join(self.directory, key)
+            try:
+                size = sum(
+                    os.path.getsize(os.path.join(entry_directory, name))
+                    for name in os.listdir(entry_directory)
+                )
+                entries.append((os.path.getmtime(entry_directory), size, key))
+            except (FileNotFoundError, NotADirectoryError):
+                continue  # removed by another process, or a stray file
+        return sorted(entries)
+
+    def _evict(self, keep):
+        entries = self._entries()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total_size <= self.max_bytes:
+                break
+            if key == keep:
+                continue  # kept even if it exceeds max_bytes alone
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            total_size -= size
+            self.evictions += 1
+
+    @property
+    def size(self):
+        """the total size of the cache in bytes"""
+        return sum(size for _, size, _ in self._entries())
+
+    def clear(self):
+        """remove all the entries"""
+        for _, _, key in self._entries():
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+
+    def get_tiled_omexml_metadata(self, path, group_file=True):
+        """
+        cached version of :func:`pycziutils.get_tiled_omexml_metadata`
+
+        Parameters
+        ----------
+        path : str
+            path to the czi file
+        group_file : bool, default True
+            passed to get_tiled_omexml_metadata
+
+        Returns
+        -------
+        xml : str
+            the OME-XML string
+        """
+        key = self._key(path, bool(group_file))
+        return self._omexml(key, self._lookup(key, _OMEXML_FILENAME), path, group_file)
+
+    def _omexml(self, key, filename, path, group_file):
+        """
+        read the cached OME-XML from filename, or extract and store it if
+        filename is None, without counting the hits and misses
+        """
+        if filename is not None:
+            with gzip.open(filename, "rt", encoding="utf-8") as f:
+                return f.read()
+
+        from ._readers import get_tiled_omexml_metadata
+
+        xml = get_tiled_omexml_metadata(path, group_file=group_file)
+        self._store(
+            key, _OMEXML_FILENAME, lambda f: f.write(gzip.compress(xml.encode()))
+        )
+        return xml
+
+    def parse_planes(self, path, acquisition_timezone=0, group_file=True):
+        """
+        cached plane table of :func:`pycziutils.parse_planes` for a czi file
+
+        Parameters
+        ----------
+        path : str
+            path to the czi file
+        acquisition_timezone : Union[datetime.timezone, int]
+            timezone to use. if int is given,
+            datetime.timezone(datetime.timedelta(timezone)) is used
+        group_file : bool, default True
+            passed to get_tiled_omexml_metadata
+
+        Returns
+        -------
+        planes_df : pandas.DataFrame
+            dataframe for all planes, see :func:`pycziutils.parse_planes`
+        """
+        key = self._key(path, bool(group_file))
+        filename = self._lookup(key, _PLANES_FILENAME)
+        if filename is None:
+            # the OME-XML lookup is not counted, a call is a hit or a miss
+            omexml_filename = os.path.join(self.directory, key, _OMEXML_FILENAME)
+            if not os.path.isfile(omexml_filename):
+                omexml_filename = None
+            ome_xml = self._omexml(key, omexml_filename, path, group_file)
+            planes_df = parse_planes(ome_xml)
+            self._store(key, _PLANES_FILENAME, lambda f: _save_planes(planes_df, f))
+            filename = os.path.join(self.directory, key, _PLANES_FILENAME)
+        return _load_planes(filename, acquisition_timezone)
+
+    def get_czi_planes(self, path, acquisition_timezone=0):
+        """
+        cached version of :func:`pycziutils.get_czi_planes`
+
+        Parameters
+        ----------
+        path : str
+            path to the czi file
+        acquisition_timezone : Union[datetime.timezone, int]
+            timezone to use. if int is given,
+            datetime.timezone(datetime.timedelta(timezone)) is used
+
+        Returns
+        -------
+        planes_df : pandas.DataFrame
+            dataframe for all planes, see :meth:`pycziutils.CziFile.get_planes`
+        """
+        key = self._key(path, "czi")
+        filename = self._lookup(key, _PLANES_FILENAME)
+        if filename is None:
+            planes_df = get_czi_planes(path)
+            self._store(key, _PLANES_FILENAME, lambda f: _save_planes(planes_df, f))
+            filename = os.path.join(self.directory, key, _PLANES_FILENAME)
+        return _load_planes(filename, acquisition_timezone)
@@ -0,0 +1,650 @@
+# coding: utf-8
+"""
+Pure-Python reader of the CZI (ZISRAW) file structure
+
+The file header, the subblock directory and the metadata segment are read
+directly from the memory-mapped file, so no JVM is needed for the metadata.
+"""
+
+import mmap
+import re
+import struct
+
+import numpy as np
+import pandas as pd
+
+from ._iterparse import iterparse_properties
+from ._parsers import _build_planes_df, _lazy_property
+
+# all segments start with (SID, AllocatedSize, UsedSize)
+_SEGMENT_HEADER = struct.Struct("<16sqq")
+# Major, Minor, Reserved1, Reserved2, PrimaryFileGuid, FileGuid, FilePart,
+# DirectoryPosition, MetadataPosition, UpdatePending, AttachmentDirectoryPosition
+_FILE_HEADER = struct.Struct("<iiii16s16siqqiq")
+# SchemaType, PixelType, FilePosition, FilePart, Compression, PyramidType,
+# spare, DimensionCount
+_ENTRY_HEADER = struct.Struct("<2siqiiB5si")
+# Dimension, Start, Size, StartCoordinate, StoredSize
+_DIMENSION_ENTRY = struct.Struct("<4siifi")
+# MetadataSize, AttachmentSize, DataSize
+_SUBBLOCK_HEADER = struct.Struct("<iiq")
+# XmlSize, AttachmentSize
+_METADATA_HEADER = struct.Struct("<ii")
+
+DIMENSIONS = "XYCZTRISHVBM"
+
+# PixelType : (dtype, samples per pixel)
+PIXEL_TYPES = {
+    0: ("u1", 1),  # Gray8
+    1: ("<u2", 1),  # Gray16
+    2: ("<f4", 1),  # Gray32Float
+    3: ("u1", 3),  # Bgr24
+    4: ("<u2", 3),  # Bgr48
+    8: ("<f4", 3),  # Bgr96Float
+    9: ("u1", 4),  # Bgra32
+    10: ("<c8", 1),  # Gray64ComplexFloat
+    11: ("<c8", 3),  # Bgr192ComplexFloat
+    12: ("<i4", 1),  # Gray32
+    13: ("<f8", 1),  # Gray64
+}
+
+COMPRESSION_UNCOMPRESSED = 0
+COMPRESSION_ZSTD0 = 5
+COMPRESSION_ZSTD1 = 6
+SUPPORTED_COMPRESSIONS = [
+    COMPRESSION_UNCOMPRESSED,
+    COMPRESSION_ZSTD0,
+    COMPRESSION_ZSTD1,
+]
+
+_DIRECTORY_DTYPE = np.dtype(
+    [
+        ("file_position", np.int64),
+        ("file_part", np.int32),
+        ("pixel_type", np.int32),
+        ("compression", np.int32),
+        ("pyramid_type", np.uint8),
+    ]
+    + [(f"{d}_{k}", np.int32) for d in DIMENSIONS for k in ["start", "size"]]
+    + [("X_stored_size", np.int32), ("Y_stored_size", np.int32)]
+)
+
+_SUBBLOCK_TAGS = ["AcquisitionTime", "StageXPosition", "StageYPosition"]
+_SUBBLOCK_TAGS += ["FocusPosition"]
+_SUBBLOCK_TAG_PATTERN = re.compile(r"<(" + "|".join(_SUBBLOCK_TAGS) + r")>([^<]*)</\1>")
+
+
+def _to_utc_datetime64(date_strings):
+    dates = pd.to_datetime(pd.Series(date_strings, dtype=object), utc=True)
+    return dates.dt.tz_localize(None).to_numpy(dtype="datetime64[ns]")
+
+
+def _check_out(out, shape, dtype):
+    """validate an output buffer for the pixels with the shape and dtype"""
+    if not isinstance(out, np.ndarray):
+        raise TypeError("out must be a numpy.ndarray")
+    if out.shape != tuple(shape):
+        raise ValueError(f"out has the shape {out.shape}, expected {tuple(shape)}")
+    if not np.can_cast(dtype, out.dtype, casting="equiv"):
+        raise ValueError(f"out has the dtype {out.dtype}, expected {dtype}")
+    if not out.flags.writeable:
+        raise ValueError("out is read-only")
+
+
+def _as_region(region, size_y, size_x):
+    """
+    normalize a region given as (x, y, w, h) or (slice_x, slice_y) to
+    (x, y, w, h), checking that it is inside the plane
+    """
+    if len(region) == 2 and all(isinstance(r, slice) for r in region):
+        x0, x1, step_x = region[0].indices(size_x)
+        y0, y1, step_y = region[1].indices(size_y)
+        if step_x != 1 or step_y != 1:
+            raise ValueError("the region slices must not have steps")
+        region = (x0, y0, x1 - x0, y1 - y0)
+    x, y, w, h = map(int, region)
+    if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > size_x or y + h > size_y:
+        raise ValueError(
+            f"the region {(x, y, w, h)} is not inside the plane of {size_x}x{size_y}"
+        )
+    return x, y, w, h
+
+
+def _decompress_zstd(data, compression, nbytes, out=None):
+    """
+    decompress zstd0 / zstd1 subblock data
+
+    zstd1 data starts with a small header which may ask for the "hi-lo byte
+    packing", where all the low bytes precede all the high bytes.
+    If out (a contiguous uint8 array of nbytes) is given, the data is
+    decompressed into it.
+    """
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError(
+            "zstandard is required to read zstd-compressed subblocks. "
+            "Install it by `pip install zstandard`."
+        ) from e
+    hilo_packed = False
+    if compression == COMPRESSION_ZSTD1:
+        header_size = data[0]
+        if header_size == 3 and data[1] == 1:
+            hilo_packed = bool(data[2] & 1)
+        data = data[header_size:]
+    decompressor = zstandard.ZstdDecompressor()
+    if out is not None and not hilo_packed:
+        filled = 0
+        with decompressor.stream_reader(data) as reader:
+            while filled < nbytes:
+                size = reader.readinto(out[filled:])
+                if size == 0:
+                    raise ValueError("the compressed data is truncated")
+                filled += size
+        return out
+    decompressed = decompressor.decompress(data, max_output_size=nbytes)
+    if not hilo_packed:
+        return decompressed
+    packed = np.frombuffer(decompressed, dtype=np.uint8)
+    half = len(packed) // 2
+    unpacked = np.empty_like(packed) if out is None else out
+    unpacked[0::2] = packed[:half]
+    unpacked[1::2] = packed[half:]
+    return unpacked
+
+
+class CziFile:
+    """
+    CZI file opened with mmap, read without bioformats
+
+    Parameters
+    ----------
+    path : str
+        path to the czi file
+
+    Attributes
+    ----------
+    header : dict
+        the fields of the ZISRAWFILE segment
+
+    Note
+    ----
+    uncompressed subblocks are returned as read-only views into the memory map,
+    which is kept open until those arrays are freed even after close()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._bioformats_reader = None
+        self._file = open(path, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            (
+                major,
+                minor,
+                _,
+                _,
+                primary_file_guid,
+                file_guid,
+                file_part,
+                directory_position,
+                metadata_position,
+                update_pending,
+                attachment_directory_position,
+            ) = _FILE_HEADER.unpack_from(
+                self._mmap, self._segment_data_position(0, b"ZISRAWFILE")
+            )
+        except Exception:
+            self.close()
+            raise
+        self.header = dict(
+            major=major,
+            minor=minor,
+            primary_file_guid=primary_file_guid,
+            file_guid=file_guid,
+            file_part=file_part,
+            directory_position=directory_position,
+            metadata_position=metadata_position,
+            update_pending=bool(update_pending),
+            attachment_directory_position=attachment_directory_position,
+        )
+
+    def close(self):
+        """close the memory map and the file"""
+        if self._bioformats_reader is not None:
+            self._bioformats_reader.close()
+            self._bioformats_reader = None
+        if getattr(self, "_mmap", None) is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # arrays still refer to the map; it is unmapped when they are freed
+                pass
+            self._mmap = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _segment_data_position(self, position, sid):
+        found_sid, _allocated_size, _used_size = _SEGMENT_HEADER.unpack_from(
+            self._mmap, position
+        )
+        found_sid = found_sid.rstrip(b"\0")
+        if found_sid != sid:
+            raise ValueError(
+                f"expected the {sid.decode()} segment at {position} in {self.path}, "
+                f"found {found_sid!r}"
+            )
+        return position + _SEGMENT_HEADER.size
+
+    @_lazy_property
+    def directory(self):
+        """
+        the subblock directory as a numpy structured array
+
+        The dimensions absent from an entry have start 0 and size 1.
+        """
+        position = self._segment_data_position(
+            self.header["directory_position"], b"ZISRAWDIRECTORY"
+        )
+        (entry_count,) = struct.unpack_from("<i", self._mmap, position)
+        position += 128
+        entries = []
+        for _ in range(entry_count):
+            entry, position = self._read_directory_entry(position)
+            entries.append(entry)
+        return np.array(entries, dtype=_DIRECTORY_DTYPE)
+
+    def _read_directory_entry(self, position):
+        """returns the entry as a tuple and the position of the next entry"""
+        (
+            _schema_type,
+            pixel_type,
+            file_position,
+            file_part,
+            compression,
+            pyramid_type,
+            _,
+            dimension_count,
+        ) = _ENTRY_HEADER.unpack_from(self._mmap, position)
+        position += _ENTRY_HEADER.size
+        dimensions = {}
+        for _ in range(dimension_count):
+            dimension, start, size, _, stored_size = _DIMENSION_ENTRY.unpack_from(
+                self._mmap, position
+            )
+            dimensions[dimension.rstrip(b"\0").decode()] = (start, size, stored_size)
+            position += _DIMENSION_ENTRY.size
+        entry = (file_position, file_part, pixel_type, compression, pyramid_type)
+        for d in DIMENSIONS:
+            entry += dimensions.get(d, (0, 1))[:2]
+        for d in "XY":
+            entry += dimensions.get(d, (0, 1, 1))[2:]
+        return entry, position
+
+    @_lazy_property
+    def metadata_xml(self):
+        """the XML string in the metadata segment"""
+        position = self._segment_data_position(
+            self.header["metadata_position"], b"ZISRAWMETADATA"
+        )
+        xml_size, _attachment_size = _METADATA_HEADER.unpack_from(self._mmap, position)
+        position += 256
+        return self._mmap[position : position + xml_size].decode("utf-8")
+
+    def _subblock_layout(self, file_position):
+        """
+        returns the positions of the metadata and the data of the subblock,
+        and their sizes
+        """
+        position = self._segment_data_position(file_position, b"ZISRAWSUBBLOCK")
+        metadata_size, _attachment_size, data_size = _SUBBLOCK_HEADER.unpack_from(
+            self._mmap, position
+        )
+        (dimension_count,) = struct.unpack_from(
+            "<i", self._mmap, position + _SUBBLOCK_HEADER.size + 28
+        )
+        entry_size = _ENTRY_HEADER.size + _DIMENSION_ENTRY.size * dimension_count
+        metadata_position = position + max(256, _SUBBLOCK_HEADER.size + entry_size)
+        data_position = metadata_position + metadata_size
+        return metadata_position, metadata_size, data_position, data_size
+
+    def subblock_metadata_xml(self, index):
+        """
+        get the metadata XML string of a subblock
+
+        Parameters
+        ----------
+        index : int
+            the index of the subblock in the directory
+
+        Returns
+        -------
+        xml : str
+            the subblock metadata
+        """
+        return self._subblock_metadata_xml_at(
+            int(self.directory["file_position"][index])
+        )
+
+    def _subblock_metadata_xml_at(self, file_position):
+        position, size, _, _ = self._subblock_layout(file_position)
+        return self._mmap[position : position + size].decode("utf-8")
+
+    def read_subblock(self, index, out=None, region=None):
+        """
+        read the pixels of a subblock without bioformats
+
+        Parameters
+        ----------
+        index : int
+            the index of the subblock in the directory
+        out : numpy.ndarray, default None
+            if given, the pixels are copied into this array of the same shape
+            and dtype (the byte order may differ), copying at most once for
+            uncompressed and zstd0 subblocks
+        region : tuple, default None
+            the region to read, as (x, y, w, h) or (slice_x, slice_y) such as
+            the output of :func:`pycziutils.parse_camera_roi_slice`, in the
+            pixels of the subblock. only the rows of the region are touched
+            for uncompressed subblocks
+
+        Returns
+        -------
+        image : numpy.ndarray
+            the pixels with the shape (Y, X) or (Y, X, samples) for the BGR
+            pixel types, as stored in the file. uncompressed subblocks are
+            returned as zero-copy read-only views. out if given.
+        """
+        entry = self.directory[index]
+        pixel_type = int(entry["pixel_type"])
+        compression = int(entry["compression"])
+        if pixel_type not in PIXEL_TYPES:
+            raise NotImplementedError(f"pixel type {pixel_type} is not supported")
+        if compression not in SUPPORTED_COMPRESSIONS:
+            raise NotImplementedError(f"compression {compression} is not supported")
+
+        dtype, samples = PIXEL_TYPES[pixel_type]
+        dtype = np.dtype(dtype)
+        shape = (int(entry["Y_stored_size"]), int(entry["X_stored_size"]))
+        if samples > 1:
+            shape += (samples,)
+        count = int(np.prod(shape))
+        _, _, data_position, data_size = self._subblock_layout(
+            int(entry["file_position"])
+        )
+        if region is not None:
+            x, y, w, h = _as_region(region, shape[0], shape[1])
+            if out is not None:
+                _check_out(out, (h, w) + shape[2:], dtype)
+            if compression == COMPRESSION_UNCOMPRESSED:
+                # the rows from y to y + h only
+                row_size = int(np.prod(shape[1:]))
+                image = np.frombuffer(
+                    self._mmap,
+                    dtype=dtype,
+                    count=h * row_size,
+                    offset=data_position + y * row_size * dtype.itemsize,
+                )
+                image = image.reshape((h,) + shape[1:])[:, x : x + w]
+            else:
+                image = self.read_subblock(index)[y : y + h, x : x + w]
+            if out is None:
+                return image
+            np.copyto(out, image, casting="equiv")
+            return out
+
+        if out is not None:
+            _check_out(out, shape, dtype)
+            if (
+                compression != COMPRESSION_UNCOMPRESSED
+                and out.dtype == dtype
+                and out.flags.c_contiguous
+            ):
+                # decompressed directly into out
+                _decompress_zstd(
+                    self._mmap[data_position : data_position + data_size],
+                    compression,
+                    count * dtype.itemsize,
+                    out=out.reshape(-1).view(np.uint8),
+                )
+                return out
+            np.copyto(out, self.read_subblock(index), casting="equiv")
+            return out
+        if compression == COMPRESSION_UNCOMPRESSED:
+            image = np.frombuffer(
+                self._mmap, dtype=dtype, count=count, offset=data_position
+            )
+        else:
+            data = _decompress_zstd(
+                self._mmap[data_position : data_position + data_size],
+                compression,
+                count * dtype.itemsize,
+            )
+            image = np.frombuffer(data, dtype=dtype, count=count)
+        return image.reshape(shape)
+
+    def is_readable_without_bioformats(self, index):
+        """
+        check if the subblock can be read by :meth:`read_subblock`
+
+        Parameters
+        ----------
+        index : int
+            the index of the subblock in the directory
+
+        Returns
+        -------
+        readable : bool
+            True if the pixel type and the compression are supported
+        """
+        entry = self.directory[index]
+        return (
+            int(entry["pixel_type"]) in PIXEL_TYPES
+            and int(entry["compression"]) in SUPPORTED_COMPRESSIONS
+        )
+
+    def read(self, series=0, t=0, z=0, c=0, out=None, region=None):
+        """
+        read a plane without bioformats if possible
+
+        Parameters
+        ----------
+        series : int, default 0
+            the image (tile) index, as "image" in :meth:`get_planes`
+        t, z, c : int, default 0
+            the time, Z and channel indices
+        out : numpy.ndarray, default None
+            if given, the pixels are copied into this array, see
+            :meth:`read_subblock`
+        region : tuple, default None
+            the region to read, as (x, y, w, h) or (slice_x, slice_y), see
+            :meth:`read_subblock`
+
+        Returns
+        -------
+        image : numpy.ndarray
+            the pixels, see :meth:`read_subblock`. out if given.
+
+        Note
+        ----
+        the planes with unsupported compressions (JPEG, JPEG XR, LZW) are read
+        through :func:`pycziutils.get_tiled_reader` without rescaling, which
+        needs a running JVM (see :func:`pycziutils.with_javabridge`)
+        """
+        key = (int(series), int(t), int(z), int(c))
+        if key not in self._plane_lookup:
+            raise IndexError(f"no plane for series={series}, t={t}, z={z}, c={c}")
+        index = self._plane_lookup[key]
+        if self.is_readable_without_bioformats(index):
+            return self.read_subblock(index, out=out, region=region)
+        from ._readers import get_tiled_reader, read_plane
+
+        if self._bioformats_reader is None:
+            self._bioformats_reader = get_tiled_reader(self.path)
+        return read_plane(self._bioformats_reader, *key, out=out, region=region)
+
+    def subblock_tags(self, indices=None):
+        """
+        get the acquisition time and the stage positions stored in the subblocks
+
+        Parameters
+        ----------
+        indices : array-like, default None
+            the indices of the subblocks in the directory. all if None.
+
+        Returns
+        -------
+        tags : dict
+            {tag : array} for AcquisitionTime (str), StageXPosition,
+            StageYPosition and FocusPosition (float, in micrometers).
+            missing values are None or NaN.
+        """
+        if indices is None:
+            indices = np.arange(len(self.directory))
+        file_positions = self.directory["file_position"][indices]
+        tags = {tag: [None] * len(file_positions) for tag in _SUBBLOCK_TAGS}
+        for i, file_position in enumerate(file_positions):
+            for tag, value in _SUBBLOCK_TAG_PATTERN.findall(
+                self._subblock_metadata_xml_at(int(file_position))
+            ):
+                tags[tag][i] = value
+        return {
+            tag: np.array(values, dtype=object if tag == "AcquisitionTime" else float)
+            for tag, values in tags.items()
+        }
+
+    @_lazy_property
+    def _plane_subblocks(self):
+        """
+        the full-resolution subblocks ordered by (image, T, Z, C),
+        their image indices and the number of images
+        """
+        directory = self.directory
+        # pyramid levels are stored downscaled
+        subblocks = np.nonzero(
+            (directory["X_size"] == directory["X_stored_size"])
+            & (directory["Y_size"] == directory["Y_stored_size"])
+        )[0]
+        entries = directory[subblocks]
+        image_keys, image = np.unique(
+            np.stack([entries["S_start"], entries["M_start"]], axis=1),
+            axis=0,
+            return_inverse=True,
+        )
+        image = image.ravel()
+        order = np.lexsort(
+            (entries["C_start"], entries["Z_start"], entries["T_start"], image)
+        )
+        return subblocks[order], image[order], len(image_keys)
+
+    @_lazy_property
+    def _plane_lookup(self):
+        """{(image, T, Z, C) : subblock index}"""
+        subblocks, image, _ = self._plane_subblocks
+        entries = self.directory[subblocks]
+        keys = zip(image, entries["T_start"], entries["Z_start"], entries["C_start"])
+        lookup = {}
+        for key, subblock in zip(keys, subblocks):
+            lookup.setdefault(tuple(map(int, key)), int(subblock))
+        return lookup
+
+    def get_planes(self, acquisition_timezone=0):
+        """
+        get the plane table compatible with :func:`pycziutils.parse_planes`
+
+        Parameters
+        ----------
+        acquisition_timezone : Union[datetime.timezone, int]
+            timezone to use. if int is given,
+            datetime.timezone(datetime.timedelta(timezone)) is used
+
+        Returns
+        -------
+        planes_df : pandas.DataFrame
+            dataframe for all planes with the columns of parse_planes, plus
+            S_index, M_index, the tile position and size in pixels (X_start,
+            Y_start, X_size, Y_size) and the subblock index in the directory
+
+        Note
+        ----
+        images are the (scene, mosaic tile) pairs, as the tiled reader gives
+        series. X, Y and Z are the stage and focus positions in the subblock
+        metadata, and T is the subblock acquisition time relative to the image
+        acquisition date.
+        """
+        subblocks, image, n_images = self._plane_subblocks
+        entries = self.directory[subblocks]
+        tags = self.subblock_tags(subblocks)
+        acq_date, channel_names = self._image_metadata()
+        acq_date = _to_utc_datetime64([acq_date])[0]
+        acquisition_times = _to_utc_datetime64(tags["AcquisitionTime"])
+        delta_T = (acquisition_times - acq_date) / np.timedelta64(1, "s")
+        size_C = int(np.max(entries["C_start"], initial=-1)) + 1
+        for i in range(len(channel_names), size_C):
+            channel_names.append(f"Channel:{i}")
+
+        columns = {
+            "X": tags["StageXPosition"],
+            "Y": tags["StageYPosition"],
+            "Z": tags["FocusPosition"],
+            "T": delta_T,
+            "C_index": entries["C_start"],
+            "T_index": entries["T_start"],
+            "Z_index": entries["Z_start"],
+        }
+        planes_df = _build_planes_df(
+            columns,
+            np.bincount(image, minlength=n_images),
+            [acq_date] * n_images,
+            channel_names,
+            acquisition_timezone,
+        )
+        planes_df["S_index"] = entries["S_start"]
+        planes_df["M_index"] = entries["M_start"]
+        for d in "XY":
+            planes_df[f"{d}_start"] = entries[f"{d}_start"]
+            planes_df[f"{d}_size"] = entries[f"{d}_size"]
+        planes_df["subblock"] = subblocks
+        return planes_df
+
+    def _image_metadata(self):
+        """the acquisition date and the channel names in the metadata segment"""
+        image_path = ("Metadata", "Information", "Image")
+        channel_path = image_path + ("Dimensions", "Channels", "Channel")
+        props = iterparse_properties(
+            self.metadata_xml,
+            {
+                image_path: (["AcquisitionDateAndTime"], object),
+                channel_path: (["@Name"], object),
+            },
+            group_path=("Metadata",),
+        )
+        acq_dates = props[image_path][0]["AcquisitionDateAndTime"]
+        channel_names = list(props[channel_path][0]["@Name"])
+        return (acq_dates[0] if len(acq_dates) else None), channel_names
+
+
+def get_czi_planes(path, acquisition_timezone=0):
+    """
+    read the CZI file without bioformats and get the plane table
+
+    Parameters
+    ----------
+    path : str
+        path to the czi file
+    acquisition_timezone : Union[datetime.timezone, int]
+        timezone to use. if int is given,
+        datetime.timezone(datetime.timedelta(timezone)) is used
+
+    Returns
+    -------
+    planes_df : pandas.DataFrame
+        dataframe for all planes, see :meth:`CziFile.get_planes`
+    """
+    with CziFile(path) as czi:
+        return czi.get_planes(acquisition_timezone=acquisition_timezone)
@@ -0,0 +1,263 @@
+# coding: utf-8
+"""
+Export of tiled czi files to chunked OME-NGFF Zarr
+"""
+
+import os
+import shutil
+
+import numpy as np
+
+from ._parsers import _as_metadata, parse_channels, parse_pixel_size, parse_planes
+from ._pool import TiledReaderPool, _attached_executor
+from ._readers import (
+    _full_resolution_images,
+    _pixel_dtype,
+    get_tiled_omexml_metadata,
+    javabridge_session,
+)
+from ._stitch import _block_average
+
+NGFF_VERSION = "0.4"
+_PROGRESS_DIRECTORY = ".pycziutils_progress"
+_UNITS = {
+    "µm": "micrometer",
+    "um": "micrometer",
+    "nm": "nanometer",
+    "mm": "millimeter",
+    "m": "meter",
+}
+
+
+def _import_zarr():
+    try:
+        import zarr
+    except ImportError as e:
+        raise ImportError(
+            "zarr is required to export to Zarr. Install it by `pip install zarr`."
+        ) from e
+    return zarr
+
+
+def _channel_color(channel):
+    """the OME color (signed RGBA int) as RRGGBB"""
+    if "@Color" not in channel:
+        return "FFFFFF"
+    return "%06X" % ((int(channel["@Color"]) & 0xFFFFFFFF) >> 8)
+
+
+def _time_interval(planes_df):
+    """the mean interval between the time points of the first plane series"""
+    first = planes_df[
+        (planes_df["image"] == planes_df["image"].min())
+        & (planes_df["C_index"] == 0)
+        & (planes_df["Z_index"] == 0)
+    ].sort_values("T_index")
+    if len(first) < 2:
+        return 1.0
+    return float(np.mean(np.diff(first["T"].to_numpy(dtype=np.float64))))
+
+
+def _image_attrs(name, levels, pixel_size, time_interval, position, channels, dtype):
+    """the OME-NGFF metadata of an image"""
+    size_x, unit_x, size_y, _ = pixel_size
+    space_axis = {"type": "space"}
+    if unit_x in _UNITS:
+        space_axis["unit"] = _UNITS[unit_x]
+    axes = [
+        {"name": "t", "type": "time", "unit": "second"},
+        {"name": "c", "type": "channel"},
+        dict(space_axis, name="z"),
+        dict(space_axis, name="y"),
+        dict(space_axis, name="x"),
+    ]
+    datasets = []
+    for level in range(levels):
+        scale = [
+            time_interval,
+            1.0,
+            1.0,
+            float(size_y) * 2**level,
+            float(size_x) * 2**level,
+        ]
+        datasets.append(
+            {
+                "path": str(level),
+                "coordinateTransformations": [
+                    {"type": "scale", "scale": scale},
+                    {"type": "translation", "translation": [0.0, 0.0] + position},
+                ],
+            }
+        )
+    if np.issubdtype(dtype, np.integer):
+        value_range = [int(np.iinfo(dtype).min), int(np.iinfo(dtype).max)]
+    else:
+        value_range = [0.0, 1.0]
+    return {
+        "multiscales": [
+            {
+                "version": NGFF_VERSION,
+                "name": name,
+                "axes": axes,
+                "datasets": datasets,
+                "type": "mean",
+            }
+        ],
+        "omero": {
+            "name": name,
+            "channels": [
+                {
+                    "label": channel.get("@Name", str(c)),
+                    "color": _channel_color(channel),
+                    "active": True,
+                    "window": {
+                        "min": value_range[0],
+                        "max": value_range[1],
+                        "start": value_range[0],
+                        "end": value_range[1],
+                    },
+                }
+                for c, channel in enumerate(channels)
+            ],
+        },
+    }
+
+
+def export_zarr(
+    path,
+    out,
+    levels=3,
+    chunks=(1024, 1024),
+    workers=4,
+    ome_xml=None,
+    pool=None,
+    resume=True,
+):
+    """
+    export the tiles of a czi file to OME-NGFF Zarr
+
+    Each tile is written as an image group named by the image index, in the
+    bioformats2raw layout. The tiles are the images at the full resolution;
+    the pyramid levels stored as separate images are skipped. The images have
+    the dimensions (t, c, z, y, x) and the pyramid levels downsampled by 2x2
+    block averaging of each plane, without re-reading the source. The planes
+    are read in parallel through a :class:`pycziutils.TiledReaderPool`, and
+    the written planes are recorded so that an interrupted export can be
+    resumed.
+
+    Parameters
+    ----------
+    path : str
+        path to the czi file
+    out : str
+        path to the output Zarr directory
+    levels : int, default 3
+        the number of the pyramid levels, including the full resolution
+    chunks : tuple of int, default (1024, 1024)
+        the chunk size in (y, x). the chunks have a single plane
+    workers : int, default 4
+        the number of the threads reading and writing the planes
+    ome_xml : Union[str, CziMetadata], default None
+        the output of :func:`pycziutils.get_tiled_omexml_metadata` for the
+        file. read from the file if None
+    pool : TiledReaderPool, default None
+        the reader pool. a pool with workers readers for the file is used and
+        closed if None
+    resume : bool, default True
+        if True, the planes already written to out are skipped. otherwise,
+        out is overwritten
+
+    Returns
+    -------
+    root : zarr.hierarchy.Group
+        the root group of the output
+    """
+    zarr = _import_zarr()
+    root = zarr.open_group(out, mode="a" if resume else "w")
+    if root.attrs.get("pycziutils", {}).get("complete", False):
+        return root
+    progress_directory = os.path.join(out, _PROGRESS_DIRECTORY)
+    os.makedirs(progress_directory, exist_ok=True)
+    written = set(os.listdir(progress_directory))
+
+    own_pool = pool is None
+    if own_pool:
+        pool = TiledReaderPool(readers_per_file=workers, max_files=1)
+    try:
+        with javabridge_session:
+            if ome_xml is None:
+                ome_xml = get_tiled_omexml_metadata(path)
+            ome_xml = _as_metadata(ome_xml)
+            images = _full_resolution_images(path)
+            planes_df = parse_planes(ome_xml)
+            planes_df = planes_df[planes_df["image"].isin(images)]
+            channels = parse_channels(ome_xml)
+            pixel_sizes = parse_pixel_size(ome_xml, assume_all_equal=False)
+            sizes = {}
+            with pool.reader(path) as reader:
+                rdr = reader.rdr
+                for image in images:
+                    rdr.setSeries(image)
+                    sizes[image] = (rdr.getSizeY(), rdr.getSizeX())
+                rdr.setSeries(images[0])
+                dtype = _pixel_dtype(rdr)
+
+        time_interval = _time_interval(planes_df)
+        root.attrs["bioformats2raw.layout"] = 3
+        arrays = {}
+        for image, image_df in planes_df.groupby("image"):
+            shape = (
+                int(image_df["T_index"].max()) + 1,
+                int(image_df["C_index"].max()) + 1,
+                int(image_df["Z_index"].max()) + 1,
+            )
+            group = root.require_group(str(image))
+            first = image_df.iloc[0]
+            # the stage position, 0 if not recorded
+            position = np.nan_to_num([0.0, first["Y"], first["X"]]).tolist()
+            group.attrs.update(
+                _image_attrs(
+                    f"image{image}",
+                    levels,
+                    pixel_sizes[image],
+                    time_interval,
+                    position,
+                    channels,
+                    dtype,
+                )
+            )
+            size_y, size_x = sizes[image]
+            for level in range(levels):
+                level_shape = (size_y >> level, size_x >> level)
+                arrays[image, level] = group.require_dataset(
+                    str(level),
+                    shape=shape + level_shape,
+                    chunks=(1, 1, 1)
+                    + tuple(min(c, s) for c, s in zip(chunks, level_shape)),
+                    dtype=dtype,
+                )
+
+        def write_plane(row):
+            image, t, z, c = row
+            marker = f"{image}-{t}-{z}-{c}"
+            if marker in written:
+                return
+            plane = pool.read(path, series=image, t=t, z=z, c=c, rescale=False)
+            for level in range(levels):
+                if level > 0:
+                    plane = _block_average(plane, 2)
+                arrays[image, level][t, c, z] = plane
+            # recorded after all the levels are written
+            open(os.path.join(progress_directory, marker), "w").close()
+
+        rows = planes_df[["image", "T_index", "Z_index", "C_index"]]
+        with _attached_executor(workers) as executor:
+            for _ in executor.map(write_plane, rows.to_numpy(dtype=int).tolist()):
+                pass
+    finally:
+        if own_pool:
+            pool.close()
+
+    root.attrs["pycziutils"] = {"complete": True, "source": os.path.basename(path)}
+    shutil.rmtree(progress_directory, ignore_errors=True)
+    return root
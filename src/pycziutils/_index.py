@@ -0,0 +1,182 @@
+# coding: utf-8
+"""
+Array-backed index of the planes for constant-time lookups
+"""
+
+import numpy as np
+import pandas as pd
+
+_DIMS = ("image", "T_index", "Z_index", "C_index")
+
+
+class PlaneIndex:
+    """
+    index of the planes of a DataFrame, with constant-time lookups by the
+    dimension indices and range queries on the columns
+
+    The plane ids are the row positions in the DataFrame. The dense array
+    ``plane_ids`` maps (image, T_index, Z_index, C_index) to the plane id
+    (-1 for missing planes), and the columns are kept as arrays.
+
+    Parameters
+    ----------
+    planes_df : pandas.DataFrame
+        the planes, such as the output of :func:`pycziutils.parse_planes` or
+        :func:`pycziutils.get_czi_planes`
+
+    Attributes
+    ----------
+    plane_ids : numpy.ndarray
+        the plane ids with the shape (image, T, Z, C)
+    shape : tuple of int
+        the shape of plane_ids
+    columns : list of str
+        the column names
+
+    Examples
+    --------
+    >>> index = pycziutils.PlaneIndex(pycziutils.parse_planes(ome_xml))
+    >>> plane = index.lookup(image=3, t=0, z=2, c=1)
+    >>> index["X"][plane], index["Y"][plane]
+    >>> planes = index.query(X=(-100, 100), Y=(0, 200), C_index=(0, 0))
+    >>> index.to_dataframe(planes)
+    """
+
+    dims = _DIMS
+
+    def __init__(self, planes_df):
+        indices = planes_df[list(_DIMS)].to_numpy(dtype=np.int64)
+        if len(indices) == 0:
+            raise ValueError("planes_df has no rows")
+        if np.any(indices < 0):
+            raise ValueError("the dimension indices must not be negative")
+        self.shape = tuple(int(s) for s in indices.max(axis=0) + 1)
+        self.plane_ids = np.full(self.shape, -1, dtype=np.int64)
+        self.plane_ids[tuple(indices.T)] = np.arange(len(indices))
+        if np.count_nonzero(self.plane_ids >= 0) != len(indices):
+            raise ValueError("planes_df has duplicated dimension indices")
+        self.columns = list(planes_df.columns)
+        self._arrays = {k: planes_df[k].array for k in self.columns}
+        self._sorted = {}
+
+    def __len__(self):
+        return len(next(iter(self._arrays.values())))
+
+    def __repr__(self):
+        dims = ", ".join(f"{d}: {s}" for d, s in zip(self.dims, self.shape))
+        return f"<PlaneIndex {len(self)} planes ({dims})>"
+
+    def __getitem__(self, column):
+        """the column as an array"""
+        return self._arrays[column]
+
+    def lookup(self, image, t=0, z=0, c=0):
+        """
+        get the plane ids by the dimension indices
+
+        Parameters
+        ----------
+        image, t, z, c : Union[int, array_like]
+            the image, time, Z and channel indices, broadcast together
+
+        Returns
+        -------
+        plane : Union[int, numpy.ndarray]
+            the plane id(s)
+
+        Raises
+        ------
+        KeyError
+            if any of the planes does not exist
+        """
+        key = (image, t, z, c)
+        if all(isinstance(i, (int, np.integer)) for i in key):
+            if all(0 <= i < size for i, size in zip(key, self.shape)):
+                plane = int(self.plane_ids[key])
+                if plane >= 0:
+                    return plane
+            raise KeyError(key)
+        key = np.broadcast_arrays(*[np.asarray(i) for i in key])
+        inside = np.ones(key[0].shape, dtype=bool)
+        for i, size in zip(key, self.shape):
+            inside &= (i >= 0) & (i < size)
+        if not np.all(inside):
+            raise KeyError((image, t, z, c))
+        planes = self.plane_ids[tuple(key)]
+        if np.any(planes < 0):
+            raise KeyError((image, t, z, c))
+        return int(planes) if planes.ndim == 0 else planes
+
+    def _sorted_column(self, column):
+        """the sort order and the sorted values of a column without NaN, cached"""
+        if column not in self._sorted:
+            values = self._arrays[column]
+            order = values.argsort(kind="stable")
+            order = order[~np.asarray(values.isna(), dtype=bool)[order]]
+            self._sorted[column] = (order, values.take(order))
+        return self._sorted[column]
+
+    def query(self, **ranges):
+        """
+        get the plane ids with the column values in the closed ranges
+
+        The first range is searched in the sorted column, the others are
+        checked on the found planes. The planes with NaN (or NaT) in any of
+        the columns are excluded, also with open ends.
+
+        Parameters
+        ----------
+        **ranges
+            the closed ranges (low, high) by the column names, such as
+            X=(x0, x1), Y=(y0, y1) for a stage bounding box or
+            absolute_T=(start, end) for a time window. None for an open end
+
+        Returns
+        -------
+        planes : numpy.ndarray
+            the sorted plane ids
+        """
+        if not ranges:
+            return np.arange(len(self))
+        planes = None
+        for column, (low, high) in ranges.items():
+            if column not in self._arrays:
+                raise KeyError(column)
+            if planes is None:
+                order, values = self._sorted_column(column)
+                start = 0 if low is None else values.searchsorted(low, "left")
+                end = (
+                    len(values) if high is None else values.searchsorted(high, "right")
+                )
+                planes = order[start:end]
+            else:
+                values = self._arrays[column].take(planes)
+                mask = ~np.asarray(values.isna(), dtype=bool)
+                if low is not None:
+                    mask &= np.asarray(values >= low, dtype=bool)
+                if high is not None:
+                    mask &= np.asarray(values <= high, dtype=bool)
+                planes = planes[mask]
+        return np.sort(planes)
+
+    def to_dataframe(self, planes=None):
+        """
+        export the planes as a DataFrame
+
+        Parameters
+        ----------
+        planes : array_like, default None
+            the plane ids. all the planes if None
+
+        Returns
+        -------
+        planes_df : pandas.DataFrame
+            the planes with the columns of the input
+        """
+        if planes is None:
+            return pd.DataFrame(dict(self._arrays), columns=self.columns)
+        planes = np.asarray(planes, dtype=np.int64)
+        return pd.DataFrame(
+            {k: self._arrays[k].take(planes) for k in self.columns},
+            columns=self.columns,
+        )
@@ -0,0 +1,137 @@
+# coding: utf-8
+"""
+Streaming OME-XML parsing with xml.etree.ElementTree.XMLPullParser
+
+Only the requested attributes are kept, and the elements are dropped from
+the tree as soon as they are closed, so the memory usage does not grow with
+the size of the XML.
+"""
+
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+_PIXELS_PATH = ("Image", "Pixels")
+_PLANE_PATH = ("Image", "Pixels", "Plane")
+
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+class _ColumnBuffer:
+    """
+    growable 1D array preallocated with the expected number of entries
+    """
+
+    def __init__(self, dtype, capacity=1):
+        self.dtype = np.dtype(dtype)
+        self.fill_value = np.nan if self.dtype.kind == "f" else None
+        self.array = np.full(max(capacity, 1), self.fill_value, dtype=self.dtype)
+        self.size = 0
+
+    def append(self, value):
+        if self.size == len(self.array):
+            grown = np.full(2 * len(self.array), self.fill_value, dtype=self.dtype)
+            grown[: self.size] = self.array
+            self.array = grown
+        if value is not None:
+            self.array[self.size] = value
+        self.size += 1
+
+    def to_array(self):
+        return self.array[: self.size]
+
+
+def iterparse_properties(ome_xml, requests, group_path=("Image",), chunk_size=2**20):
+    """
+    stream OME-XML and collect the requested properties for each image
+
+    Parameters
+    ----------
+    ome_xml : str
+        the input OME-XML string
+    requests : dict
+        {path : (keys, dtype)} where path is a tuple of element names below
+        the root (for example ("Image", "Pixels", "Plane")), keys is a list of
+        attribute names prefixed by "@" or child element names (text is taken),
+        and dtype is the dtype of the output arrays
+    group_path : tuple, default ("Image",)
+        the path of the elements to group the properties by
+    chunk_size : int, default 2**20
+        the number of characters fed to the parser at once
+
+    Returns
+    -------
+    properties : dict
+        {path : a list of {key : array} for each group element},
+        where each array has one entry per matching element
+    """
+    group_path = tuple(group_path)
+    requests = {
+        tuple(path): (list(keys), dtype) for path, (keys, dtype) in requests.items()
+    }
+    text_requests = {}
+    for path, (keys, _dtype) in requests.items():
+        for key in keys:
+            if not key.startswith("@"):
+                text_requests[path + (key,)] = (path, key)
+
+    results = {path: [] for path in requests}
+    buffers = {}
+
+    def start_group():
+        for path, (keys, dtype) in requests.items():
+            buffers[path] = {key: _ColumnBuffer(dtype) for key in keys}
+            results[path].append(buffers[path])
+
+    def start_pixels(elem):
+        # the number of planes is known from the Pixels element
+        keys, dtype = requests[_PLANE_PATH]
+        capacity = 1
+        for k in ["SizeC", "SizeT", "SizeZ"]:
+            capacity *= int(elem.get(k, "1"))
+        for key in keys:
+            buffers[_PLANE_PATH][key] = _ColumnBuffer(dtype, capacity)
+
+    parser = ET.XMLPullParser(events=("start", "end"))
+    stack = []
+    names = []
+
+    def handle_events():
+        for event, elem in parser.read_events():
+            if event == "start":
+                stack.append(elem)
+                names.append(_local_name(elem.tag))
+                path = tuple(names[1:])
+                if path == group_path:
+                    start_group()
+                elif path == _PIXELS_PATH and _PLANE_PATH in requests:
+                    start_pixels(elem)
+                if path in requests:
+                    for key, buffer in buffers[path].items():
+                        # text values are filled when the child element ends
+                        buffer.append(elem.get(key[1:]) if key[0] == "@" else None)
+            else:
+                path = tuple(names[1:])
+                if path in text_requests and elem.text is not None:
+                    parent_path, key = text_requests[path]
+                    buffer = buffers[parent_path][key]
+                    buffer.array[buffer.size - 1] = elem.text
+                stack.pop()
+                names.pop()
+                if stack:
+                    # drop the closed element; its earlier siblings are already
+                    # removed, so this is always the first child
+                    stack[-1].remove(elem)
+
+    for i in range(0, len(ome_xml), chunk_size):
+        parser.feed(ome_xml[i : i + chunk_size])
+        handle_events()
+    parser.close()
+    handle_events()
+
+    return {
+        path: [{key: b.to_array() for key, b in bs.items()} for bs in group_buffers]
+        for path, group_buffers in results.items()
+    }
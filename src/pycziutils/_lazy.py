@@ -0,0 +1,241 @@
+# coding: utf-8
+"""
+Lazily evaluated array view over a tiled czi file
+"""
+
+import itertools
+
+import numpy as np
+
+from ._parsers import parse_planes
+from ._pool import TiledReaderPool
+from ._readers import (
+    _full_resolution_images,
+    _pixel_dtype,
+    get_tiled_omexml_metadata,
+    javabridge_session,
+)
+
+DIMS = ("tile", "T", "C", "Z", "Y", "X")
+
+
+def _expand_key(key, ndim):
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is None for k in key):
+        raise IndexError("newaxis is not supported")
+    n_ellipsis = sum(k is Ellipsis for k in key)
+    if n_ellipsis > 1:
+        raise IndexError("an index can only have a single ellipsis ('...')")
+    if n_ellipsis == 1:
+        i = next(i for i, k in enumerate(key) if k is Ellipsis)
+        key = key[:i] + (slice(None),) * (ndim - len(key) + 1) + key[i + 1 :]
+    if len(key) > ndim:
+        raise IndexError(f"too many indices for array: {ndim} dimensional")
+    return key + (slice(None),) * (ndim - len(key))
+
+
+class LazyTiledArray:
+    """
+    lazily evaluated array of a tiled czi file with the dimensions
+    (tile, T, C, Z, Y, X)
+
+    Indexing reads only the planes it touches, through a
+    :class:`pycziutils.TiledReaderPool`, and only the region of the Y and X
+    slices in the planes. The arrays used as indices are
+    applied to each dimension independently (orthogonal indexing).
+    The object can be wrapped by dask, see :meth:`to_dask`.
+    The tiles are the images at the full resolution; the pyramid levels
+    stored as separate images are skipped.
+
+    Parameters
+    ----------
+    path : str
+        path to the czi file
+    planes_df : pandas.DataFrame, default None
+        the output of :func:`pycziutils.parse_planes` for the file.
+        computed from the OME-XML if None
+    pool : TiledReaderPool, default None
+        the reader pool. a pool with 4 readers for the file is used and closed
+        by :meth:`close` if None
+
+    Attributes
+    ----------
+    planes_df : pandas.DataFrame
+        the planes of the tiles
+    images : list of int
+        the image index of each tile
+    shape : tuple of int
+        the array shape (tile, T, C, Z, Y, X)
+    dtype : numpy.dtype
+        the pixel type
+    chunks : tuple of int
+        the chunk shape, a single plane
+    """
+
+    dims = DIMS
+
+    def __init__(self, path, planes_df=None, pool=None):
+        self.path = path
+        self._own_pool = pool is None
+        if self._own_pool:
+            pool = TiledReaderPool(readers_per_file=4, max_files=1)
+        self.pool = pool
+        try:
+            with javabridge_session:
+                if planes_df is None:
+                    planes_df = parse_planes(get_tiled_omexml_metadata(path))
+                self.images = _full_resolution_images(path)
+                with pool.reader(path) as reader:
+                    rdr = reader.rdr
+                    rdr.setSeries(self.images[0])
+                    size_y, size_x = rdr.getSizeY(), rdr.getSizeX()
+                    samples = rdr.getRGBChannelCount()
+                    self.dtype = _pixel_dtype(rdr)
+        except BaseException:
+            self.close()
+            raise
+        self.planes_df = planes_df[planes_df["image"].isin(self.images)]
+        self.shape = (
+            len(self.images),
+            int(planes_df["T_index"].max()) + 1,
+            int(planes_df["C_index"].max()) + 1,
+            int(planes_df["Z_index"].max()) + 1,
+            size_y,
+            size_x,
+        ) + ((samples,) if samples > 1 else ())
+        self.chunks = (1, 1, 1, 1) + self.shape[4:]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        dims = ", ".join(f"{d}: {s}" for d, s in zip(self.dims, self.shape))
+        return f"<LazyTiledArray {self.path} ({dims}) {self.dtype}>"
+
+    def _read_plane(self, tile, t, c, z, region=None):
+        return self.pool.read(
+            self.path,
+            series=self.images[tile],
+            t=t,
+            z=z,
+            c=c,
+            region=region,
+            rescale=False,
+        )
+
+    def close(self):
+        """close the readers of the pool if it was created for the array"""
+        if self._own_pool:
+            self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getitem__(self, key):
+        key = _expand_key(key, self.ndim)
+        plane_indices = []
+        squeeze = []
+        for i, k in enumerate(key[:4]):
+            if isinstance(k, (int, np.integer)):
+                squeeze.append(i)
+            plane_indices.append(np.atleast_1d(np.arange(self.shape[i])[k]))
+        plane_key = key[4:]
+        region = None
+        if isinstance(key[4], slice) and isinstance(key[5], slice):
+            # only the bounding region of the Y and X slices is read
+            y0, y1, step_y = key[4].indices(self.shape[4])
+            x0, x1, step_x = key[5].indices(self.shape[5])
+            if step_y > 0 and step_x > 0 and y1 > y0 and x1 > x0:
+                region = (x0, y0, x1 - x0, y1 - y0)
+                plane_key = (slice(None, None, step_y), slice(None, None, step_x))
+                plane_key += key[6:]
+
+        out = None
+        for pos in itertools.product(*[range(len(ind)) for ind in plane_indices]):
+            tile, t, c, z = [int(ind[p]) for ind, p in zip(plane_indices, pos)]
+            plane = self._read_plane(tile, t, c, z, region)[plane_key]
+            if out is None:
+                out = np.empty(
+                    tuple(map(len, plane_indices)) + plane.shape, dtype=plane.dtype
+                )
+            out[pos] = plane
+        if out is None:  # an empty selection
+            plane = np.empty(self.shape[4:], dtype=self.dtype)[plane_key]
+            out = np.empty(tuple(map(len, plane_indices)) + plane.shape, self.dtype)
+        return out.squeeze(axis=tuple(squeeze)) if squeeze else out
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[...]
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+    def to_dask(self, chunks=None):
+        """
+        get the dask array reading the planes on demand
+
+        Parameters
+        ----------
+        chunks : tuple, default None
+            the chunk shape. a single plane if None
+
+        Returns
+        -------
+        array : dask.array.Array
+            the dask array
+        """
+        try:
+            import dask.array as da
+        except ImportError as e:
+            raise ImportError(
+                "dask is required for to_dask. "
+                "Install it by `pip install dask[array]`."
+            ) from e
+        return da.from_array(
+            self,
+            chunks=self.chunks if chunks is None else chunks,
+            meta=np.empty((0,) * self.ndim, dtype=self.dtype),
+        )
+
+
+def open_lazy(path, planes_df=None, pool=None):
+    """
+    open a tiled czi file as a lazily evaluated array
+
+    Parameters
+    ----------
+    path : str
+        path to the czi file
+    planes_df : pandas.DataFrame, default None
+        the output of :func:`pycziutils.parse_planes` for the file.
+        computed from the OME-XML if None
+    pool : TiledReaderPool, default None
+        the reader pool. a pool with 4 readers for the file is used and closed
+        by :meth:`LazyTiledArray.close` if None
+
+    Returns
+    -------
+    array : LazyTiledArray
+        the array with the dimensions (tile, T, C, Z, Y, X)
+
+    Examples
+    --------
+    >>> with pycziutils.open_lazy("path/to/czi/file.czi") as array:
+    ...     array[3, 0, :, 0]  # reads the planes of all channels of the tile 3
+    ...     array.to_dask().max(axis=0).compute()
+    """
+    return LazyTiledArray(path, planes_df=planes_df, pool=pool)
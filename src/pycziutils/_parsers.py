@@ -1,20 +1,28 @@
 import copy
-import json
-from datetime import datetime, timedelta, timezone
+import functools
+from datetime import timedelta, timezone
 
 import numpy as np
-import pandas as pd
-import xmltodict
 
+from ._annotations import AnnotationStore
+from ._iterparse import iterparse_properties
 
-def __wrap_list(x):
+_BACKENDS = ["xmltodict", "iterparse"]
+_DOMAIN_PATHS = {
+    "image": ("Image",),
+    "pixels": ("Image", "Pixels"),
+    "plane": ("Image", "Pixels", "Plane"),
+}
+
+
+def _wrap_list(x):
     if isinstance(x, list):
         return x
     else:
         return [x]
 
 
-def __copy_keys(x, keys):
+def _copy_keys(x, keys):
     #    print(x,keys)
     if not isinstance(keys, list):
         return copy.deepcopy(x[keys])
@@ -22,36 +30,178 @@ def __copy_keys(x, keys):
         return [copy.deepcopy(x.get(key, None)) for key in keys]
 
 
-def parse_properties(ome_xml, keys, domain="pixels"):
+def _lazy_property(func):
     """
-    parse OME-XML and get properties of the specified domain
+    property evaluated on the first access and cached in the instance
+    """
+    attr_name = "_" + func.__name__
+
+    @property
+    @functools.wraps(func)
+    def wrapped(self):
+        if attr_name not in self.__dict__:
+            self.__dict__[attr_name] = func(self)
+        return self.__dict__[attr_name]
+
+    return wrapped
+
+
+class CziMetadata:
+    """
+    OME-XML metadata parsed once and shared by the parse_* functions
+
+    The XML string is parsed on the first access and the image, pixels, plane
+    and annotation views are built lazily and cached. All the module-level
+    parse_* functions accept either an OME-XML string or this object.
 
     Parameters
     ----------
     ome_xml : str
         the input OME-XML string
+    """
+
+    def __init__(self, ome_xml):
+        self.ome_xml = ome_xml
+
+    @_lazy_property
+    def meta_dict(self):
+        """the whole OME-XML as a nested dict"""
+        import xmltodict
+
+        return xmltodict.parse(self.ome_xml)
+
+    @_lazy_property
+    def images(self):
+        """the list of Image elements"""
+        return _wrap_list(self.meta_dict["OME"]["Image"])
+
+    @_lazy_property
+    def pixels(self):
+        """the list of Pixels elements for each image"""
+        return [im["Pixels"] for im in self.images]
+
+    @_lazy_property
+    def planes(self):
+        """the list of lists of Plane elements for each image"""
+        return [_wrap_list(px["Plane"]) for px in self.pixels]
+
+    @_lazy_property
+    def annotations(self):
+        """the indexed original metadata, see :class:`pycziutils.AnnotationStore`"""
+        return AnnotationStore(self.ome_xml)
+
+    @_lazy_property
+    def structured_annotation_dict(self):
+        """OriginalMetadata.key : OriginalMetadata.value pairs as a dict"""
+        return dict(self.annotations)
+
+    def parse_properties(self, keys, domain="pixels", backend="xmltodict"):
+        """see :func:`pycziutils.parse_properties`"""
+        return parse_properties(self, keys, domain=domain, backend=backend)
+
+    def parse_channels(self, assume_all_equal=True):
+        """see :func:`pycziutils.parse_channels`"""
+        return parse_channels(self, assume_all_equal=assume_all_equal)
+
+    def parse_pixel_size(self, assume_all_equal=True):
+        """see :func:`pycziutils.parse_pixel_size`"""
+        return parse_pixel_size(self, assume_all_equal=assume_all_equal)
+
+    def parse_planes(self, acquisition_timezone=0, backend="xmltodict"):
+        """see :func:`pycziutils.parse_planes`"""
+        return parse_planes(
+            self, acquisition_timezone=acquisition_timezone, backend=backend
+        )
+
+    def parse_structured_annotation_dict(self):
+        """see :func:`pycziutils.parse_structured_annotation_dict`"""
+        return parse_structured_annotation_dict(self)
+
+    def parse_binning(self):
+        """see :func:`pycziutils.parse_binning`"""
+        return parse_binning(self)
+
+    def parse_camera_roi(self):
+        """see :func:`pycziutils.parse_camera_roi`"""
+        return parse_camera_roi(self)
+
+    def parse_camera_roi_slice(self):
+        """see :func:`pycziutils.parse_camera_roi_slice`"""
+        return parse_camera_roi_slice(self)
+
+    def parse_camera_LUT(self):
+        """see :func:`pycziutils.parse_camera_LUT`"""
+        return parse_camera_LUT(self)
+
+    def parse_camera_bits(self):
+        """see :func:`pycziutils.parse_camera_bits`"""
+        return parse_camera_bits(self)
+
+
+def _as_metadata(ome_xml):
+    if isinstance(ome_xml, CziMetadata):
+        return ome_xml
+    else:
+        return CziMetadata(ome_xml)
+
+
+def _check_backend(backend):
+    if backend not in _BACKENDS:
+        raise ValueError("backend must be " + " or ".join(_BACKENDS))
+
+
+def _parse_properties_iterparse(ome_xml, keys, domain):
+    path = _DOMAIN_PATHS[domain]
+    _keys = keys if isinstance(keys, list) else [keys]
+    valuess = iterparse_properties(ome_xml, {path: (_keys, object)})[path]
+
+    def pick(values, i):
+        if isinstance(keys, list):
+            return [values[key][i] for key in keys]
+        elif values[keys][i] is None:
+            raise KeyError(keys)
+        else:
+            return values[keys][i]
+
+    if domain == "plane":
+        return [[pick(vs, i) for i in range(len(vs[_keys[0]]))] for vs in valuess]
+    else:
+        return [pick(vs, 0) for vs in valuess]
+
+
+def parse_properties(ome_xml, keys, domain="pixels", backend="xmltodict"):
+    """
+    parse OME-XML and get properties of the specified domain
+
+    Parameters
+    ----------
+    ome_xml : Union[str, CziMetadata]
+        the input OME-XML string or the parsed metadata
     keys :
         the keys for the properties
     domain : str
         the domain level to get properties, should be "image", "pixels" or "plane"
+    backend : str, default "xmltodict"
+        "xmltodict" to parse the whole XML into a dict (cached in CziMetadata),
+        or "iterparse" to stream the XML and keep only the requested keys.
+        "iterparse" supports attributes ("@" prefixed) and text elements only.
 
     Returns
     -------
     properties :
         the properties as a list
     """
-    meta_dict = xmltodict.parse(ome_xml)
-    images = __wrap_list(meta_dict["OME"]["Image"])
+    _check_backend(backend)
+    metadata = _as_metadata(ome_xml)
 
-    if domain == "image":
-        return [__copy_keys(im, keys) for im in images]
+    if domain in _DOMAIN_PATHS and backend == "iterparse":
+        return _parse_properties_iterparse(metadata.ome_xml, keys, domain)
+    elif domain == "image":
+        return [_copy_keys(im, keys) for im in metadata.images]
     elif domain == "pixels":
-        return [__copy_keys(im["Pixels"], keys) for im in images]
+        return [_copy_keys(px, keys) for px in metadata.pixels]
     elif domain == "plane":
-        return [
-            [__copy_keys(pl, keys) for pl in __wrap_list(im["Pixels"]["Plane"])]
-            for im in images
-        ]
+        return [[_copy_keys(pl, keys) for pl in pls] for pls in metadata.planes]
     else:
         raise ValueError("domain must be plane, pixels or image")
 
@@ -62,8 +212,8 @@ def parse_channels(ome_xml, assume_all_equal=True):
 
     Parameters
     ----------
-    ome_xml : str
-        the input OME-XML string
+    ome_xml : Union[str, CziMetadata]
+        the input OME-XML string or the parsed metadata
     assume_all_equal : bool, default True
         if True, assume the channels are the same for all the planes
 
@@ -76,7 +226,7 @@ def parse_channels(ome_xml, assume_all_equal=True):
     channelss = parse_properties(ome_xml, "Channel")
     _channelss = []
     for cc in channelss:
-        _cc = __wrap_list(cc)
+        _cc = _wrap_list(cc)
         for c in _cc:
             del c["@ID"]
         _channelss.append(_cc)
@@ -95,8 +245,8 @@ def parse_pixel_size(ome_xml, assume_all_equal=True):
 
     Parameters
     ----------
-    ome_xml : str
-        the input OME-XML string
+    ome_xml : Union[str, CziMetadata]
+        the input OME-XML string or the parsed metadata
     assume_all_equal : bool, default True
         if True, assume the pixel sizes are the same for all the planes
 
@@ -122,22 +272,87 @@ def parse_pixel_size(ome_xml, assume_all_equal=True):
         return props
 
 
-def parse_planes(ome_xml, acquisition_timezone=0):
+def _as_timezone(acquisition_timezone):
+    if isinstance(acquisition_timezone, int):
+        return timezone(timedelta(hours=acquisition_timezone))
+    else:
+        return acquisition_timezone
+
+
+def _build_planes_df(
+    columns, plane_counts, acq_dates, channel_names, acquisition_timezone
+):
+    """
+    build the parse_planes DataFrame from the plane columns ordered by image
+
+    Parameters
+    ----------
+    columns : dict
+        {name : float array} for "X", "Y", "Z", "T", "C_index", "T_index"
+        and "Z_index" over all the planes
+    plane_counts : array
+        the number of planes for each image
+    acq_dates : list
+        the acquisition dates (UTC) for each image, as strings or datetime64
+    channel_names : array
+        the channel names indexed by C_index
+    acquisition_timezone : Union[datetime.timezone, int]
+        the timezone for image_acquisition_T and absolute_T
+    """
+    import pandas as pd
+
+    columns = dict(columns)
+    for name in ["C_index", "T_index", "Z_index"]:
+        columns[name] = columns[name].astype(int)
+    image = np.repeat(np.arange(len(plane_counts)), plane_counts)
+    plane = np.arange(np.sum(plane_counts)) - np.repeat(
+        np.cumsum(plane_counts) - plane_counts, plane_counts
+    )
+
+    image_acquisition_T = (
+        pd.DatetimeIndex(np.array(acq_dates, dtype="datetime64[ns]")[image])
+        .tz_localize(timezone.utc)
+        .tz_convert(_as_timezone(acquisition_timezone))
+    )
+    # rounded to microseconds as datetime.timedelta does; NaN gives NaT
+    delta_T = pd.to_timedelta(np.round(columns["T"] * 1e6), unit="us")
+    absolute_T = image_acquisition_T + delta_T
+
+    return pd.DataFrame(
+        {
+            "index": plane,
+            **columns,
+            "image": image,
+            "plane": plane,
+            "image_acquisition_T": image_acquisition_T,
+            "absolute_T": absolute_T,
+            "C": np.asarray(channel_names, dtype=object)[columns["C_index"]],
+        }
+    )
+
+
+def parse_planes(ome_xml, acquisition_timezone=0, backend="xmltodict"):
     """
     parse OME-XML and get pandas dataframe for each planes
 
     Parameters
     ----------
-    ome_xml : str
-        the input OME-XML string
+    ome_xml : Union[str, CziMetadata]
+        the input OME-XML string or the parsed metadata
     acquisition_timezone : Union[datetime.timezone, int]
         timezone to use. if int is given,
         datetime.timezone(datetime.timedelta(timezone)) is used
+    backend : str, default "xmltodict"
+        "xmltodict" to use the parsed dict (cached in CziMetadata),
+        or "iterparse" to stream the XML with a small memory footprint
 
     Returns
     -------
     planes_df : pandas.DataFrame
-        dataframe for all planes, containing X,Y,Z positions and time
+        dataframe for all planes, containing X,Y,Z positions and time.
+        image_acquisition_T and absolute_T are timezone-aware datetime64
+        columns, absolute_T being NaT for the planes without DeltaT (it was
+        an object column with NaN for them before the vectorized parsing)
 
     Note
     ----
@@ -154,39 +369,49 @@ def parse_planes(ome_xml, acquisition_timezone=0):
         "@TheZ",
     ]
     names = ["X", "Y", "Z", "T", "C_index", "T_index", "Z_index"]
-    positions = parse_properties(ome_xml, keys, domain="plane")
-    acq_dates = parse_properties(ome_xml, "AcquisitionDate", domain="image")
-    assert len(positions) == len(acq_dates)
-    planes_df = pd.DataFrame()
-    for j, (ps, acq_date) in enumerate(zip(positions, acq_dates)):
-        df = pd.DataFrame(data=ps, columns=names, dtype=np.float64)
-        df["image"] = j
-        df["plane"] = range(len(ps))
-
-        if isinstance(acquisition_timezone, int):
-            acquisition_timezone = timezone(timedelta(hours=acquisition_timezone))
-        acq_date = (
-            datetime.strptime(acq_date, "%Y-%m-%dT%H:%M:%S.%f")
-            .replace(tzinfo=timezone.utc)
-            .astimezone(acquisition_timezone)
+    _check_backend(backend)
+    metadata = _as_metadata(ome_xml)
+
+    if backend == "iterparse":
+        plane_path = _DOMAIN_PATHS["plane"]
+        channel_path = ("Image", "Pixels", "Channel")
+        props = iterparse_properties(
+            metadata.ome_xml,
+            {
+                plane_path: (keys, np.float64),
+                ("Image",): (["AcquisitionDate"], object),
+                channel_path: (["@Name"], object),
+            },
         )
-        df["image_acquisition_T"] = acq_date
-
-        planes_df = planes_df.append(df)
-    for k in [n for n in names if "index" in n] + ["image", "plane"]:
-        planes_df[k] = planes_df[k].astype(int)
-
-    non_nan_indices = ~planes_df["T"].isna()
-    planes_df.loc[non_nan_indices, "absolute_T"] = planes_df.loc[
-        non_nan_indices, "image_acquisition_T"
-    ] + np.vectorize(timedelta)(
-        seconds=planes_df.loc[non_nan_indices, "T"].astype(np.float64)
+        planess = props[plane_path]
+        acq_dates = [im["AcquisitionDate"][0] for im in props[("Image",)]]
+        if any(acq_date is None for acq_date in acq_dates):
+            # as the missing key in the xmltodict backend
+            raise KeyError("AcquisitionDate")
+        plane_counts = np.array([len(pls[keys[0]]) for pls in planess])
+        columns = {
+            name: np.concatenate([pls[key] for pls in planess])
+            for key, name in zip(keys, names)
+        }
+        channel_namess = [ch["@Name"] for ch in props[channel_path]]
+        assert all([np.array_equal(c, channel_namess[0]) for c in channel_namess])
+        channel_names = channel_namess[0]
+    else:
+        planess = metadata.planes
+        acq_dates = [im["AcquisitionDate"] for im in metadata.images]
+        # collect the plane attributes column by column in a single pass
+        plane_counts = np.array([len(pls) for pls in planess])
+        all_planes = [pl for pls in planess for pl in pls]
+        columns = {
+            name: np.array([pl.get(key, None) for pl in all_planes], dtype=np.float64)
+            for key, name in zip(keys, names)
+        }
+        channel_names = [c["@Name"] for c in parse_channels(metadata)]
+    assert len(planess) == len(acq_dates)
+
+    return _build_planes_df(
+        columns, plane_counts, acq_dates, channel_names, acquisition_timezone
     )
-    planes_df = planes_df.reset_index()
-    channels = parse_channels(ome_xml)
-    print(channels)
-    planes_df["C"] = planes_df["C_index"].apply(lambda i: channels[i]["@Name"])
-    return planes_df
 
 
 def summarize_image_size(reader, print_summary=True):
@@ -238,8 +463,8 @@ def parse_structured_annotation_dict(ome_xml):
 
     Parameters
     ----------
-    ome_xml : str
-        the input OME-XML string
+    ome_xml : Union[str, CziMetadata]
+        the input OME-XML string or the parsed metadata
 
     Returns
     -------
@@ -247,12 +472,7 @@ def parse_structured_annotation_dict(ome_xml):
         OriginalMetadata.key : OriginalMetadata.value pairs as a dict
 
     """
-    meta_dict = xmltodict.parse(ome_xml)
-    annotation = meta_dict["OME"]["StructuredAnnotations"]["XMLAnnotation"]
-    return {
-        a["Value"]["OriginalMetadata"]["Key"]: a["Value"]["OriginalMetadata"]["Value"]
-        for a in annotation
-    }
+    return dict(_as_metadata(ome_xml).structured_annotation_dict)
 
 
 def parse_binning(ome_xml):
@@ -261,8 +481,8 @@ def parse_binning(ome_xml):
 
     Parameters
     ----------
-    ome_xml : str
-        the input OME-XML string
+    ome_xml : Union[str, CziMetadata]
+        the input OME-XML string or the parsed metadata
 
     Returns
     -------
@@ -274,9 +494,7 @@ def parse_binning(ome_xml):
     uses 'HardwareSetting|ParameterCollection|Binning'
 
     """
-    annotation_dict = parse_structured_annotation_dict(ome_xml)
-    binning = json.loads(annotation_dict["HardwareSetting|ParameterCollection|Binning"])
-    return list(binning)
+    return _as_metadata(ome_xml).annotations.binning
 
 
 def parse_camera_roi(ome_xml):
@@ -285,8 +503,8 @@ def parse_camera_roi(ome_xml):
 
     Parameters
     ----------
-    ome_xml : str
-        the input OME-XML string
+    ome_xml : Union[str, CziMetadata]
+        the input OME-XML string or the parsed metadata
 
     Returns
     -------
@@ -298,11 +516,7 @@ def parse_camera_roi(ome_xml):
     uses 'HardwareSetting|ParameterCollection|ImageFrame'
 
     """
-    annotation_dict = parse_structured_annotation_dict(ome_xml)
-    roi = json.loads(
-        annotation_dict["HardwareSetting|ParameterCollection|ImageFrame"]
-    )  # or 'HardwareSetting|ParameterCollection|Frame'?
-    return list(roi)[:4]
+    return _as_metadata(ome_xml).annotations.camera_roi
 
 
 def parse_camera_roi_slice(ome_xml):
@@ -311,8 +525,8 @@ def parse_camera_roi_slice(ome_xml):
 
     Parameters
     ----------
-    ome_xml : str
-        the input OME-XML string
+    ome_xml : Union[str, CziMetadata]
+        the input OME-XML string or the parsed metadata
 
     Returns
     -------
@@ -334,8 +548,8 @@ def parse_camera_LUT(ome_xml):
 
     Parameters
     ----------
-    ome_xml : str
-        the input OME-XML string
+    ome_xml : Union[str, CziMetadata]
+        the input OME-XML string or the parsed metadata
 
     Returns
     -------
@@ -348,19 +562,7 @@ def parse_camera_LUT(ome_xml):
          'HardwareSetting|ParameterCollection|CameraLUT2'
 
     """
-    annotation_dict = parse_structured_annotation_dict(ome_xml)
-    try:
-        lut1 = json.loads(
-            annotation_dict["HardwareSetting|ParameterCollection|CameraLUT1"]
-        )
-        lut2 = json.loads(
-            annotation_dict["HardwareSetting|ParameterCollection|CameraLUT2"]
-        )
-        assert len(lut1) == 1
-        assert len(lut2) == 1
-        return (lut1[0], lut2[0])
-    except KeyError:
-        return (np.nan, np.nan)
+    return _as_metadata(ome_xml).annotations.camera_LUT
 
 
 def parse_camera_bits(ome_xml):
@@ -369,8 +571,8 @@ def parse_camera_bits(ome_xml):
 
     Parameters
     ----------
-    ome_xml : str
-        the input OME-XML string
+    ome_xml : Union[str, CziMetadata]
+        the input OME-XML string or the parsed metadata
 
     Returns
     -------
@@ -382,9 +584,4 @@ def parse_camera_bits(ome_xml):
     uses 'HardwareSetting|ParameterCollection|ValidBits'
 
     """
-    annotation_dict = parse_structured_annotation_dict(ome_xml)
-    res = list(
-        json.loads(annotation_dict["HardwareSetting|ParameterCollection|ValidBits"])
-    )
-    assert len(res) == 1
-    return res[0]
+    return _as_metadata(ome_xml).annotations.camera_bits
@@ -0,0 +1,232 @@
+# coding: utf-8
+"""
+Thread-safe pool of initialized tiled readers
+"""
+
+import contextlib
+import functools
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import BrokenExecutor, ThreadPoolExecutor
+
+from ._readers import get_tiled_reader, javabridge_session, read_plane
+
+
+@contextlib.contextmanager
+def _attached_executor(workers):
+    """
+    ThreadPoolExecutor with the threads attached to the JVM while it is open,
+    so that the reads in the threads do not attach and detach them per plane
+    """
+    executor = ThreadPoolExecutor(workers, initializer=javabridge_session.__enter__)
+    try:
+        yield executor
+    finally:
+        # a detaching task in each thread, held by the barrier until all the
+        # threads have one
+        barrier = threading.Barrier(workers)
+
+        def detach():
+            barrier.wait()
+            javabridge_session.__exit__(None, None, None)
+
+        try:
+            for future in [executor.submit(detach) for _ in range(workers)]:
+                future.result()
+        except BrokenExecutor:
+            pass  # the JVM failed to start in the initializer
+        executor.shutdown()
+
+
+class _FileReaders:
+    def __init__(self):
+        self.idle = []
+        self.count = 0  # the number of readers opened or being opened
+        self.in_use = 0
+
+
+class TiledReaderPool:
+    """
+    pool of tiled readers (see :func:`pycziutils.get_tiled_reader`)
+
+    Initializing a reader scans the whole czi file, so the readers are kept
+    open and reused. A reader is used by one thread at a time; up to
+    readers_per_file readers are opened for each file, and the readers of the
+    least recently used files are closed when more than max_files files are
+    open. The threads checking out readers are attached to the JVM through
+    :data:`pycziutils.javabridge_session`, for each checkout unless they are
+    already in the session. The threads reading many planes should be kept
+    in the session (``with pycziutils.javabridge_session:``) to be attached
+    once.
+
+    Parameters
+    ----------
+    readers_per_file : int, default 1
+        the maximum number of readers opened for a file
+    max_files : int, default 8
+        the maximum number of files with open readers
+    tile_cache : TileCache, default None
+        if given, :meth:`read` reads the planes through the cache
+
+    Attributes
+    ----------
+    opened : int
+        the number of readers initialized so far
+
+    Examples
+    --------
+    >>> with pycziutils.TiledReaderPool(readers_per_file=4) as pool:
+    ...     with pool.reader("path/to/czi/file.czi") as reader:
+    ...         image = reader.read(series=0, t=0, z=0, c=0)
+    """
+
+    def __init__(self, readers_per_file=1, max_files=8, tile_cache=None):
+        if readers_per_file < 1 or max_files < 1:
+            raise ValueError("readers_per_file and max_files must be positive")
+        self.readers_per_file = readers_per_file
+        self.max_files = max_files
+        self.tile_cache = tile_cache
+        self.opened = 0
+        self._files = OrderedDict()
+        self._condition = threading.Condition()
+
+    def _evict(self, keep):
+        """close the readers of the least recently used files not in use"""
+        for path in list(self._files):
+            if len(self._files) <= self.max_files:
+                break
+            if path == keep:
+                continue
+            readers = self._files[path]
+            if readers.in_use == 0 and readers.count == len(readers.idle):
+                for rdr in readers.idle:
+                    rdr.close()
+                del self._files[path]
+
+    def _checkout(self, path):
+        with self._condition:
+            while True:
+                readers = self._files.get(path)
+                if readers is None:
+                    readers = self._files[path] = _FileReaders()
+                self._files.move_to_end(path)
+                self._evict(keep=path)
+                if readers.idle:
+                    readers.in_use += 1
+                    return readers.idle.pop()
+                if readers.count < self.readers_per_file:
+                    readers.count += 1
+                    readers.in_use += 1
+                    break
+                self._condition.wait()
+        # initialized outside the lock, as it takes a while
+        try:
+            rdr = get_tiled_reader(path)
+        except BaseException:
+            with self._condition:
+                readers.count -= 1
+                readers.in_use -= 1
+                self._condition.notify_all()
+            raise
+        with self._condition:
+            self.opened += 1
+        return rdr
+
+    def _checkin(self, path, rdr):
+        with self._condition:
+            readers = self._files[path]
+            readers.in_use -= 1
+            readers.idle.append(rdr)
+            self._evict(keep=path)
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def reader(self, path):
+        """
+        check out a reader for the file, waiting until one is available
+
+        Parameters
+        ----------
+        path : str
+            path to the czi file
+
+        Yields
+        ------
+        reader : bioformats.ImageReader
+            the tiled reader, used only by the current thread until returned
+        """
+        path = os.path.abspath(path)
+        with javabridge_session:
+            rdr = self._checkout(path)
+            try:
+                yield rdr
+            finally:
+                self._checkin(path, rdr)
+
+    def read(self, path, series=0, t=0, z=0, c=0, out=None, region=None, **kwargs):
+        """
+        read a plane with a reader from the pool
+
+        Parameters
+        ----------
+        path : str
+            path to the czi file
+        series, t, z, c : int, default 0
+            the image, time, Z and channel indices of the plane
+        out : numpy.ndarray, default None
+            if given, the plane is read without rescaling into this array by
+            :func:`pycziutils.read_plane`, bypassing tile_cache and kwargs
+        region : tuple, default None
+            if given, only the region (x, y, w, h) or (slice_x, slice_y) is
+            read without rescaling by :func:`pycziutils.read_plane`, ignoring
+            kwargs
+        **kwargs
+            passed to bioformats.ImageReader.read
+
+        Returns
+        -------
+        image : numpy.ndarray
+            the plane, read-only if tile_cache is given. out if given.
+        """
+        path = os.path.abspath(path)
+        if self.tile_cache is not None and out is None:
+            if region is not None:
+                kwargs["region"] = region
+            return self.tile_cache.read(
+                functools.partial(self._read, path),
+                path,
+                series=series,
+                t=t,
+                z=z,
+                c=c,
+                **kwargs,
+            )
+        return self._read(
+            path, series=series, t=t, z=z, c=c, out=out, region=region, **kwargs
+        )
+
+    def _read(self, path, series, t, z, c, out=None, region=None, **kwargs):
+        with self.reader(path) as rdr:
+            if out is None and region is None:
+                return rdr.read(series=series, t=t, z=z, c=c, **kwargs)
+            return read_plane(rdr, series=series, t=t, z=z, c=c, out=out, region=region)
+
+    def close(self):
+        """close all the readers not in use"""
+        with self._condition:
+            with javabridge_session:
+                for path in list(self._files):
+                    readers = self._files[path]
+                    for rdr in readers.idle:
+                        rdr.close()
+                    readers.count -= len(readers.idle)
+                    readers.idle = []
+                    if readers.count == 0:
+                        del self._files[path]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
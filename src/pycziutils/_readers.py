@@ -3,14 +3,48 @@
 # ( https://github.com/CellProfiler/python-bioformats ),
 # which is licensed under BSD license. For details, see LICENSE.
 
+import atexit
 import functools
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
 
 import bioformats
 import javabridge
+import numpy as np
 from javabridge import jutil
 
+from ._czifile import _as_region, _check_out
+from ._parsers import _build_planes_df
 
-def get_tiled_reader(path):
+logger = logging.getLogger(__name__)
+
+# the number of the Java byte arrays of different sizes kept for a reader
+_MAX_JAVA_BUFFERS = 4
+# loci.formats.in.MetadataLevel by the metadata_level options
+_METADATA_LEVELS = {
+    "minimum": "MINIMUM",
+    "no_overlays": "NO_OVERLAYS",
+    "all": "ALL",
+}
+# loci.formats.FormatTools pixel types
+_PIXEL_TYPES = {
+    0: "i1",
+    1: "u1",
+    2: "i2",
+    3: "u2",
+    4: "i4",
+    5: "u4",
+    6: "f4",
+    7: "f8",
+}
+
+
+def get_tiled_reader(
+    path, flattened_resolutions=True, metadata_level="all", original_metadata_keys=()
+):
     """
     Read tiled czi image and get ZeissCZIReader without stitching
 
@@ -18,12 +52,24 @@ def get_tiled_reader(path):
     ---------
     path : str
         path to the czi file
+    flattened_resolutions : bool, default True
+        if False, the pyramid levels are not exposed as separate series but
+        as the resolutions of each series (see :func:`read_plane`)
+    metadata_level : str, default "all"
+        the metadata parsed into the metadata store (reader.metadata), one of
+        "minimum", "no_overlays" and "all". "minimum" is enough to read the
+        pixels and initializes the reader the fastest
+    original_metadata_keys : list of str, default ()
+        the original metadata keys added to the metadata store as the
+        structured annotations. a key ending with "*" matches the keys
+        starting with the rest. all the keys if None
 
     Returns
     -------
     reader : ZeissCZIReader
         tiled reader
     """
+    level = _metadata_level(metadata_level)
     CZIAllowStitchKey = jutil.get_static_field(
         "loci/formats/in/ZeissCZIReader",
         "ALLOW_AUTOSTITCHING_KEY",
@@ -47,14 +93,211 @@ def get_tiled_reader(path):
     dynop = DynamicMetadataOptions()
     dynop.set(CZIAllowStitchKey, "false")
     dynop.set(CZIIncludeAttachmentKey, "false")
+    dynop.setMetadataLevel(
+        jutil.get_static_field(
+            "loci/formats/in/MetadataLevel",
+            level,
+            "Lloci/formats/in/MetadataLevel;",
+        )
+    )
     rdr.rdr.setMetadataOptions(dynop)
+    if not flattened_resolutions:
+        javabridge.call(rdr.rdr.o, "setFlattenedResolutions", "(Z)V", False)
+    if original_metadata_keys is None:
+        javabridge.call(rdr.rdr.o, "setOriginalMetadataPopulated", "(Z)V", True)
     rdr.metadata = bioformats.metadatatools.createOMEXMLMetadata()
     rdr.rdr.setMetadataStore(rdr.metadata)
     rdr.rdr.setId(rdr.path)
+    if original_metadata_keys:
+        script = _original_metadata_script(original_metadata_keys)
+        jutil.run_script(script, dict(reader=rdr.rdr, metadata=rdr.metadata))
     return rdr
 
 
-def get_tiled_omexml_metadata(path=None, url=None, *, group_file=True):
+def _metadata_level(metadata_level):
+    if metadata_level not in _METADATA_LEVELS:
+        raise ValueError(f"metadata_level must be one of {list(_METADATA_LEVELS)}")
+    return _METADATA_LEVELS[metadata_level]
+
+
+def _original_metadata_script(keys):
+    """
+    the script adding the original metadata of the reader matching the keys
+    to the OME-XML metadata store (metadata)
+    """
+    return f"""
+        importClass(Packages.loci.common.services.ServiceFactory,
+                    Packages.loci.formats.services.OMEXMLService);
+        var patterns = {json.dumps(list(keys))};
+        function matches(key) {{
+            for (var i = 0; i < patterns.length; i++) {{
+                var p = patterns[i];
+                if (p.charAt(p.length - 1) == "*"
+                    ? key.indexOf(p.substring(0, p.length - 1)) == 0
+                    : key == p) {{
+                    return true;
+                }}
+            }}
+            return false;
+        }}
+        var globalMetadata = reader.getGlobalMetadata();
+        var selected = new java.util.Hashtable();
+        var it = globalMetadata.keySet().iterator();
+        while (it.hasNext()) {{
+            var key = it.next();
+            if (matches(String(key))) {{
+                selected.put(key, globalMetadata.get(key));
+            }}
+        }}
+        new ServiceFactory().getInstance(OMEXMLService)
+            .populateOriginalMetadata(metadata, selected);
+        """
+
+
+def _java_buffer(reader, nbytes):
+    """the Java byte array of nbytes reused for the reader"""
+    buffers = reader.__dict__.setdefault("_pycziutils_buffers", OrderedDict())
+    if nbytes in buffers:
+        buffers.move_to_end(nbytes)
+    else:
+        buffers[nbytes] = jutil.get_env().make_byte_array(np.zeros(nbytes, np.uint8))
+        if len(buffers) > _MAX_JAVA_BUFFERS:
+            buffers.popitem(last=False)
+    return buffers[nbytes]
+
+
+def get_resolution_sizes(reader, series=0):
+    """
+    get the sizes of the resolution levels of a series
+
+    Parameters
+    ----------
+    reader : bioformats.ImageReader
+        the reader, opened by :func:`get_tiled_reader` with
+        flattened_resolutions=False
+    series : int, default 0
+        the series (tile) index
+
+    Returns
+    -------
+    sizes : list of tuple
+        the (sizeY, sizeX) of the levels from the full resolution. a single
+        size if there is no pyramid
+    """
+    rdr = reader.rdr
+    rdr.setSeries(series)
+    sizes = []
+    for level in range(javabridge.call(rdr.o, "getResolutionCount", "()I")):
+        javabridge.call(rdr.o, "setResolution", "(I)V", level)
+        sizes.append((rdr.getSizeY(), rdr.getSizeX()))
+    rdr.setSeries(series)
+    return sizes
+
+
+def _full_resolution_images(path):
+    """
+    the indices of the OME images at the full resolution, skipping the
+    pyramid levels following each of them as separate images
+    """
+    reader = get_tiled_reader(
+        path, flattened_resolutions=False, metadata_level="minimum"
+    )
+    try:
+        rdr = reader.rdr
+        images = []
+        image = 0
+        for series in range(rdr.getSeriesCount()):
+            rdr.setSeries(series)
+            images.append(image)
+            image += javabridge.call(rdr.o, "getResolutionCount", "()I")
+    finally:
+        reader.close()
+    return images
+
+
+def _pixel_dtype(rdr):
+    """the dtype of the pixels of the current series of the Java reader"""
+    pixel_type = rdr.getPixelType()
+    if pixel_type not in _PIXEL_TYPES:
+        raise NotImplementedError(f"pixel type {pixel_type} is not supported")
+    byte_order = "<" if rdr.isLittleEndian() else ">"
+    return np.dtype(byte_order + _PIXEL_TYPES[pixel_type])
+
+
+def read_plane(reader, series=0, t=0, z=0, c=0, out=None, region=None, resolution=0):
+    """
+    read a plane as stored in the file, without rescaling
+
+    The Java byte arrays receiving the planes are allocated once per reader
+    and plane size and reused. The pixels are still copied from them into a
+    newly allocated array, and copied again into out if given.
+
+    Parameters
+    ----------
+    reader : bioformats.ImageReader
+        the reader, such as the output of :func:`get_tiled_reader`. must not be
+        used by other threads at the same time
+    series, t, z, c : int, default 0
+        the image, time, Z and channel indices of the plane
+    out : numpy.ndarray, default None
+        if given, the pixels are copied into this array, which must have the
+        plane (or region) shape and the pixel type of the reader (the byte
+        order may differ)
+    region : tuple, default None
+        the region to read, as (x, y, w, h) or (slice_x, slice_y) such as
+        the output of :func:`pycziutils.parse_camera_roi_slice`. only the
+        pixels in the region are transferred from Java
+    resolution : int, default 0
+        the resolution level, 0 for the full resolution. the region is in the
+        pixels of the level. the reader must be opened with
+        flattened_resolutions=False for the levels above 0
+
+    Returns
+    -------
+    image : numpy.ndarray
+        the plane with the shape (Y, X), or (Y, X, samples) for RGB images.
+        out if given.
+    """
+    rdr = reader.rdr
+    rdr.setSeries(series)
+    if resolution:
+        # after setSeries, which resets the resolution
+        javabridge.call(rdr.o, "setResolution", "(I)V", resolution)
+    dtype = _pixel_dtype(rdr)
+    size_y, size_x = rdr.getSizeY(), rdr.getSizeX()
+    if region is None:
+        x, y, w, h = 0, 0, size_x, size_y
+    else:
+        x, y, w, h = _as_region(region, size_y, size_x)
+    shape = stored_shape = (h, w)
+    samples = rdr.getRGBChannelCount()
+    interleaved = samples == 1 or rdr.isInterleaved()
+    if samples > 1:
+        stored_shape = shape + (samples,) if interleaved else (samples,) + shape
+        shape = shape + (samples,)
+    if out is not None:
+        _check_out(out, shape, dtype)
+    buffer = _java_buffer(reader, int(np.prod(shape)) * dtype.itemsize)
+    index = rdr.getIndex(z, c, t)
+    javabridge.call(rdr.o, "openBytes", "(I[BIIII)[B", index, buffer, x, y, w, h)
+    image = jutil.get_env().get_byte_array_elements(buffer)
+    image = image.view(dtype).reshape(stored_shape)
+    if not interleaved:
+        image = np.moveaxis(image, 0, -1)
+    if out is None:
+        return image
+    np.copyto(out, image, casting="equiv")
+    return out
+
+
+def get_tiled_omexml_metadata(
+    path=None,
+    url=None,
+    *,
+    group_file=True,
+    metadata_level="all",
+    original_metadata_keys=None,
+):
     """
     Read tiled czi image and get ZeissCZIReader without stitching
 
@@ -66,6 +309,14 @@ def get_tiled_omexml_metadata(path=None, url=None, *, group_file=True):
         url to the czi file (optional)
     groupfiles: bool, default True
         utilize the groupfiles option to take the directory structure into account.
+    metadata_level : str, default "all"
+        the metadata to parse, one of "minimum", "no_overlays" and "all".
+        "no_overlays" skips the ROIs and is enough for
+        :func:`pycziutils.parse_planes`
+    original_metadata_keys : list of str, default None
+        the original metadata keys included as the structured annotations.
+        a key ending with "*" matches the keys starting with the rest, such as
+        "HardwareSetting|ParameterCollection|*". all the keys if None
 
     Returns
     -------
@@ -78,13 +329,31 @@ def get_tiled_omexml_metadata(path=None, url=None, *, group_file=True):
     """
 
     with bioformats.ImageReader(path=path, url=url, perform_init=False) as rdr:
-        #
-        # Below, "in" is a keyword and Rhino's parser is just a little wonky I fear.
-        #
-        # It is critical that setGroupFiles be set to false, goodness knows
-        # why, but if you don't the series count is wrong for flex files.
-        #
-        script = f"""
+        script = (
+            _tiled_metadata_script(group_file, metadata_level, original_metadata_keys)
+            + """
+        var xml = service.getOMEXML(metadata);
+        xml;
+        """
+        )
+        xml = jutil.run_script(script, dict(path=rdr.path, reader=rdr.rdr))
+    return xml
+
+
+def _tiled_metadata_script(group_file, metadata_level, original_metadata_keys):
+    """
+    the script initializing the reader with the OME-XML metadata store
+    (metadata), without stitching
+    """
+    level = _metadata_level(metadata_level)
+    populated = "true" if original_metadata_keys is None else "false"
+    #
+    # Below, "in" is a keyword and Rhino's parser is just a little wonky I fear.
+    #
+    # It is critical that setGroupFiles be set to false, goodness knows
+    # why, but if you don't the series count is wrong for flex files.
+    #
+    return f"""
         importClass(Packages.loci.common.services.ServiceFactory,
                     Packages.loci.formats.services.OMEXMLService,
                     Packages.loci.formats['in'].ZeissCZIReader,
@@ -92,53 +361,279 @@ def get_tiled_omexml_metadata(path=None, url=None, *, group_file=True):
                     Packages.loci.formats['in'].DynamicMetadataOptions,
                     Packages.loci.formats['in'].MetadataLevel);
         reader.setGroupFiles({'true' if group_file else 'false'});
-        reader.setOriginalMetadataPopulated(true);
+        reader.setOriginalMetadataPopulated({populated});
         var service = new ServiceFactory().getInstance(OMEXMLService);
         var metadata = service.createOMEXMLMetadata();
         reader.setMetadataStore(metadata);
-        reader.setMetadataOptions(new DefaultMetadataOptions(MetadataLevel.ALL));
+        reader.setMetadataOptions(new DefaultMetadataOptions(MetadataLevel.{level}));
         var dynop=DynamicMetadataOptions();
+        dynop.setMetadataLevel(MetadataLevel.{level});
         dynop.set(ZeissCZIReader.ALLOW_AUTOSTITCHING_KEY,'false');
         dynop.set(ZeissCZIReader.INCLUDE_ATTACHMENTS_KEY,'false');
         reader.setMetadataOptions(dynop);
         reader.setId(path);
-        var xml = service.getOMEXML(metadata);
-        xml;
+        """ + (
+        _original_metadata_script(original_metadata_keys)
+        if original_metadata_keys
+        else ""
+    )
+
+
+# collects the plane table from the metadata store into primitive arrays,
+# with the missing values as NaN or empty strings
+_PLANES_SCRIPT = """
+        var Array = java.lang.reflect.Array;
+        var nImages = metadata.getImageCount();
+        var nPlanes = 0;
+        for (var i = 0; i < nImages; i++) {
+            nPlanes += metadata.getPlaneCount(i);
+        }
+        var values = Array.newInstance(java.lang.Double.TYPE, 7 * nPlanes);
+        var counts = Array.newInstance(java.lang.Integer.TYPE, nImages);
+        var dates = Array.newInstance(java.lang.String, nImages);
+        function number(q) {
+            return q == null ? NaN : q.value().doubleValue();
+        }
+        function index(q) {
+            return q == null ? NaN : q.getValue().doubleValue();
+        }
+        var p = 0;
+        for (var i = 0; i < nImages; i++) {
+            var n = metadata.getPlaneCount(i);
+            counts[i] = n;
+            var date = metadata.getImageAcquisitionDate(i);
+            dates[i] = date == null ? "" : date.getValue();
+            for (var j = 0; j < n; j++, p++) {
+                values[7 * p] = number(metadata.getPlanePositionX(i, j));
+                values[7 * p + 1] = number(metadata.getPlanePositionY(i, j));
+                values[7 * p + 2] = number(metadata.getPlanePositionZ(i, j));
+                values[7 * p + 3] = number(metadata.getPlaneDeltaT(i, j));
+                values[7 * p + 4] = index(metadata.getPlaneTheC(i, j));
+                values[7 * p + 5] = index(metadata.getPlaneTheT(i, j));
+                values[7 * p + 6] = index(metadata.getPlaneTheZ(i, j));
+            }
+        }
+        var nChannels = nImages > 0 ? metadata.getChannelCount(0) : 0;
+        var channels = Array.newInstance(java.lang.String, nChannels);
+        for (var c = 0; c < nChannels; c++) {
+            var name = metadata.getChannelName(0, c);
+            channels[c] = name == null ? "" : name;
+        }
+        var result = Array.newInstance(java.lang.Object, 4);
+        result[0] = values;
+        result[1] = counts;
+        result[2] = dates;
+        result[3] = channels;
+        result;
         """
-        xml = jutil.run_script(script, dict(path=rdr.path, reader=rdr.rdr))
-    return xml
+
+
+def get_tiled_planes(
+    path=None,
+    url=None,
+    *,
+    acquisition_timezone=0,
+    group_file=True,
+    metadata_level="no_overlays",
+):
+    """
+    get the planes DataFrame of a tiled czi file from the metadata store,
+    without the OME-XML
+
+    The same as ``parse_planes(get_tiled_omexml_metadata(path))``, but the
+    plane properties are collected into arrays in Java and transferred at
+    once, skipping the serialization and the parsing of the OME-XML and the
+    population of the original metadata.
+
+    Parameters
+    ---------
+    path : str, default None
+        path to the czi file
+    url : str, default None
+        url to the czi file (optional)
+    acquisition_timezone : Union[datetime.timezone, int]
+        timezone to use, see :func:`pycziutils.parse_planes`
+    group_file: bool, default True
+        utilize the groupfiles option to take the directory structure into account.
+    metadata_level : str, default "no_overlays"
+        the metadata to parse, see :func:`pycziutils.get_tiled_omexml_metadata`
+
+    Returns
+    -------
+    planes_df : pandas.DataFrame
+        dataframe for all planes, see :func:`pycziutils.parse_planes`
+    """
+    with bioformats.ImageReader(path=path, url=url, perform_init=False) as rdr:
+        script = _tiled_metadata_script(group_file, metadata_level, [])
+        result = jutil.run_script(
+            script + _PLANES_SCRIPT, dict(path=rdr.path, reader=rdr.rdr)
+        )
+        env = javabridge.get_env()
+        values, counts, dates, channels = env.get_object_array_elements(result)
+        values = env.get_double_array_elements(values).reshape(-1, 7)
+        counts = env.get_int_array_elements(counts)
+        dates = [
+            env.get_string_utf(d) or None for d in env.get_object_array_elements(dates)
+        ]
+        channels = [
+            env.get_string_utf(c) or None
+            for c in env.get_object_array_elements(channels)
+        ]
+    names = ["X", "Y", "Z", "T", "C_index", "T_index", "Z_index"]
+    columns = {name: values[:, i] for i, name in enumerate(names)}
+    return _build_planes_df(columns, counts, dates, channels, acquisition_timezone)
+
+
+def _set_log_level(log_level):
+    """
+    set the log level of the Java root logger
+    https://forum.image.sc/t/python-bioformats-and-javabridge-debug-messages/12578/11
+    """
+    rootLoggerName = javabridge.get_static_field(
+        "org/slf4j/Logger", "ROOT_LOGGER_NAME", "Ljava/lang/String;"
+    )
+    rootLogger = javabridge.static_call(
+        "org/slf4j/LoggerFactory",
+        "getLogger",
+        "(Ljava/lang/String;)Lorg/slf4j/Logger;",
+        rootLoggerName,
+    )
+    logLevel = javabridge.get_static_field(
+        "ch/qos/logback/classic/Level",
+        log_level,
+        "Lch/qos/logback/classic/Level;",
+    )
+    javabridge.call(
+        rootLogger, "setLevel", "(Lch/qos/logback/classic/Level;)V", logLevel
+    )
+
+
+class JavabridgeSession:
+    """
+    process-wide JVM session, started once and shut down at exit
+
+    javabridge cannot restart the JVM once it is killed, so the JVM is kept
+    running until the process exits. Entering the session (``with``) starts
+    the JVM if needed and attaches the current thread to it; the thread is
+    detached when the outermost ``with`` block in that thread exits, except
+    the main thread, which is kept attached. The threads must be detached
+    before they end, since the JVM waits for them at the exit.
+    The session is reentrant.
+
+    Parameters
+    ----------
+    max_heap_size : str, default None
+        the maximum heap size of the JVM, such as "4G". the javabridge default
+        if None
+    log_level : str, default "ERROR"
+        the log level of the Java root logger
+
+    Attributes
+    ----------
+    startup_time : float
+        the time in seconds taken to start the JVM, None if not started
+    """
+
+    def __init__(self, max_heap_size=None, log_level="ERROR"):
+        self.max_heap_size = max_heap_size
+        self.log_level = log_level
+        self.startup_time = None
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._started = False
+        self._shut_down = False
+        # the idents of the threads attached to the JVM
+        self._attached_threads = set()
+
+    @property
+    def is_running(self):
+        """True if the JVM is running"""
+        return self._started and not self._shut_down
+
+    def start(self, max_heap_size=None, log_level=None):
+        """
+        start the JVM if it is not running
+
+        Parameters
+        ----------
+        max_heap_size : str, default None
+            overrides the max_heap_size of the session if given
+        log_level : str, default None
+            overrides the log_level of the session if given
+
+        Returns
+        -------
+        session : JavabridgeSession
+            this session
+        """
+        with self._lock:
+            if self._shut_down:
+                raise RuntimeError("the JVM cannot be restarted in the same process")
+            if self._started:
+                return self
+            if max_heap_size is not None:
+                self.max_heap_size = max_heap_size
+            if log_level is not None:
+                self.log_level = log_level
+            start_time = time.perf_counter()
+            javabridge.start_vm(
+                class_path=bioformats.JARS, max_heap_size=self.max_heap_size
+            )
+            _set_log_level(self.log_level)
+            self.startup_time = time.perf_counter() - start_time
+            logger.info("started the JVM in %.2f s", self.startup_time)
+            self._started = True
+            # start_vm attaches the calling thread
+            self._attached_threads.add(threading.get_ident())
+            atexit.register(self.shutdown)
+            return self
+
+    def shutdown(self):
+        """kill the JVM. it cannot be started again in this process"""
+        with self._lock:
+            if self.is_running:
+                javabridge.kill_vm()
+                self._shut_down = True
+
+    def __enter__(self):
+        self.start()
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            ident = threading.get_ident()
+            with self._lock:
+                attached = ident in self._attached_threads
+                self._attached_threads.add(ident)
+            if not attached:
+                javabridge.attach()
+        self._local.depth = depth + 1
+        return self
+
+    def __exit__(self, *args):
+        self._local.depth -= 1
+        if self._local.depth > 0:
+            return
+        if threading.current_thread() is threading.main_thread():
+            return  # kept attached, to be reused by the later sessions
+        with self._lock:
+            self._attached_threads.discard(threading.get_ident())
+        javabridge.detach()
+
+
+javabridge_session = JavabridgeSession()
 
 
 def with_javabridge(func):
     """
     runs function with javabridge, with the loglevel error
-    https://forum.image.sc/t/python-bioformats-and-javabridge-debug-messages/12578/11
+
+    The JVM is started by :data:`javabridge_session` on the first call and kept
+    running until the process exits, so the decorated functions can be called
+    many times, also from worker threads.
     """
 
     @functools.wraps(func)
     def wrapped(*args, **kwargs):
-        try:
-            javabridge.start_vm(class_path=bioformats.JARS)
-            myloglevel = "ERROR"  # user string argument for logLevel.
-            rootLoggerName = javabridge.get_static_field(
-                "org/slf4j/Logger", "ROOT_LOGGER_NAME", "Ljava/lang/String;"
-            )
-            rootLogger = javabridge.static_call(
-                "org/slf4j/LoggerFactory",
-                "getLogger",
-                "(Ljava/lang/String;)Lorg/slf4j/Logger;",
-                rootLoggerName,
-            )
-            logLevel = javabridge.get_static_field(
-                "ch/qos/logback/classic/Level",
-                myloglevel,
-                "Lch/qos/logback/classic/Level;",
-            )
-            javabridge.call(
-                rootLogger, "setLevel", "(Lch/qos/logback/classic/Level;)V", logLevel
-            )
+        with javabridge_session:
             return func(*args, **kwargs)
-        finally:
-            javabridge.kill_vm()
 
     return wrapped
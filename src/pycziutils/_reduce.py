@@ -0,0 +1,208 @@
+# coding: utf-8
+"""
+Streaming projections and statistics over groups of planes
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+
+_REDUCTIONS = ["max", "min", "sum", "mean", "histogram"]
+_READERS = ["bioformats", "czifile"]
+_INDEX_COLUMNS = ["image", "T_index", "Z_index", "C_index"]
+
+
+def _histogram_range(dtype, value_range):
+    if value_range is not None:
+        return value_range
+    if dtype.kind in "iu":
+        info = np.iinfo(dtype)
+        return (int(info.min), int(info.max) + 1)
+    raise ValueError("value_range is required for the histogram of float pixels")
+
+
+@contextmanager
+def _open_planes(path, planes_df, reader, pool, workers):
+    """
+    open the planes of a file with the reader, yielding the planes DataFrame
+    (all the planes if planes_df is None), the function reading a plane by
+    (image, t, z, c) and the executor with workers threads to read them in
+    """
+    if reader not in _READERS:
+        raise ValueError(f"reader must be one of {_READERS}")
+    if reader == "czifile":
+        from ._czifile import CziFile
+
+        with CziFile(path) as czi:
+            if planes_df is None:
+                planes_df = czi.get_planes()
+
+            def read(image, t, z, c):
+                return czi.read(series=image, t=t, z=z, c=c)
+
+            with ThreadPoolExecutor(workers) as executor:
+                yield planes_df, read, executor
+        return
+
+    from ._pool import TiledReaderPool, _attached_executor
+
+    own_pool = pool is None
+    if own_pool:
+        pool = TiledReaderPool(readers_per_file=workers, max_files=1)
+    try:
+        if planes_df is None:
+            from ._parsers import parse_planes
+            from ._readers import get_tiled_omexml_metadata, javabridge_session
+
+            with javabridge_session:
+                planes_df = parse_planes(get_tiled_omexml_metadata(path))
+
+        def read(image, t, z, c):
+            return pool.read(path, series=image, t=t, z=z, c=c, rescale=False)
+
+        with _attached_executor(workers) as executor:
+            yield planes_df, read, executor
+    finally:
+        if own_pool:
+            pool.close()
+
+
+def reduce_planes(
+    path,
+    planes_df=None,
+    reductions=("max", "mean"),
+    group_by=("image", "T_index", "C_index"),
+    workers=4,
+    reader="bioformats",
+    bins=256,
+    value_range=None,
+    pool=None,
+    correction=None,
+):
+    """
+    compute projections and statistics over the groups of planes, streaming
+
+    The planes are grouped by the columns of planes_df given as group_by
+    (by default, the Z stacks of each image, time point and channel) and
+    reduced one by one with in-place operations. The groups are processed
+    in parallel, each worker holding a single plane at a time.
+
+    Parameters
+    ----------
+    path : str
+        path to the czi file
+    planes_df : pandas.DataFrame, default None
+        the planes to reduce, such as the output of
+        :func:`pycziutils.parse_planes`. all the planes if None
+    reductions : sequence of str, default ("max", "mean")
+        the reductions among "max", "min", "sum", "mean" and "histogram"
+    group_by : sequence of str, default ("image", "T_index", "C_index")
+        the columns of planes_df to group the planes by
+    workers : int, default 4
+        the number of the worker threads
+    reader : str, default "bioformats"
+        "bioformats" to read the planes through a
+        :class:`pycziutils.TiledReaderPool` without rescaling, or "czifile"
+        to read them by :class:`pycziutils.CziFile` without the JVM
+    bins : int, default 256
+        the number of the histogram bins
+    value_range : tuple, default None
+        the range of the histogram. the range of the pixel type if None
+    pool : TiledReaderPool, default None
+        the reader pool for the "bioformats" reader. a pool with workers
+        readers for the file is used and closed if None
+    correction : ShadingCorrection, default None
+        if given, the planes are corrected by it before the reductions, such
+        as the output of :func:`pycziutils.estimate_shading`. "max" and "min"
+        are float32 then
+
+    Returns
+    -------
+    groups_df : pandas.DataFrame
+        the group_by columns of the groups and the number of the planes
+        ("planes") in each group
+    results : dict
+        the arrays of the reductions, with the groups in the first axis.
+        "max" and "min" have the pixel type, "sum" and "mean" are float64,
+        "histogram" has the counts in the bins. "bin_edges" is included
+        with "histogram".
+
+    Examples
+    --------
+    >>> groups_df, results = pycziutils.reduce_planes(
+    ...     "path/to/czi/file.czi", reductions=["max"], workers=8
+    ... )
+    >>> max_projections = results["max"]  # (groups, Y, X)
+    """
+    reductions = list(reductions)
+    for reduction in reductions:
+        if reduction not in _REDUCTIONS:
+            raise ValueError(f"reductions must be among {_REDUCTIONS}")
+    group_by = list(group_by)
+
+    with _open_planes(path, planes_df, reader, pool, workers) as (
+        planes_df,
+        read,
+        executor,
+    ):
+        if correction is not None:
+            read_raw = read
+
+            def read(image, t, z, c):
+                return correction.apply(read_raw(image, t, z, c), c)
+
+        planes_df = planes_df.sort_values(group_by + ["Z_index", "T_index"])
+        grouped = planes_df.groupby(group_by, sort=True)
+        groups_df = grouped.size().reset_index(name="planes")
+        group_rows = [
+            rows[_INDEX_COLUMNS].to_numpy(dtype=int).tolist() for _, rows in grouped
+        ]
+        if not group_rows:
+            raise ValueError("planes_df has no rows")
+
+        first = read(*group_rows[0][0])
+        n_groups = len(group_rows)
+        results = {}
+        for reduction in reductions:
+            if reduction in ("max", "min"):
+                results[reduction] = np.empty((n_groups,) + first.shape, first.dtype)
+            elif reduction in ("sum", "mean"):
+                results[reduction] = np.zeros((n_groups,) + first.shape, np.float64)
+            else:
+                hist_range = _histogram_range(first.dtype, value_range)
+                results["histogram"] = np.zeros((n_groups, bins), np.int64)
+                results["bin_edges"] = np.histogram_bin_edges(
+                    [], bins=bins, range=hist_range
+                )
+        del first
+
+        def reduce_group(i):
+            for j, row in enumerate(group_rows[i]):
+                plane = read(*row)
+                for reduction in reductions:
+                    if reduction == "max":
+                        if j == 0:
+                            results["max"][i] = plane
+                        else:
+                            np.maximum(results["max"][i], plane, out=results["max"][i])
+                    elif reduction == "min":
+                        if j == 0:
+                            results["min"][i] = plane
+                        else:
+                            np.minimum(results["min"][i], plane, out=results["min"][i])
+                    elif reduction == "histogram":
+                        counts, _ = np.histogram(plane, bins=results["bin_edges"])
+                        results["histogram"][i] += counts
+                if "sum" in results or "mean" in results:
+                    total = results["sum" if "sum" in results else "mean"][i]
+                    np.add(total, plane, out=total)
+                del plane
+            if "mean" in results:
+                if "sum" in results:
+                    results["mean"][i] = results["sum"][i]
+                results["mean"][i] /= len(group_rows[i])
+
+        for _ in executor.map(reduce_group, range(n_groups)):
+            pass
+    return groups_df, results
@@ -0,0 +1,207 @@
+# coding: utf-8
+"""
+Streaming estimation of the flat-field and dark-frame shading correction
+"""
+
+import threading
+
+import numpy as np
+
+from ._parsers import parse_camera_bits, parse_camera_LUT, parse_planes
+from ._reduce import _INDEX_COLUMNS, _open_planes
+from ._stitch import _block_average
+
+_METHODS = ["median", "mean"]
+
+
+class ShadingCorrection:
+    """
+    flat-field and dark-frame correction of the planes of each channel, as
+    (plane - dark) / flatfield
+
+    Parameters
+    ----------
+    flatfield : numpy.ndarray
+        the flat-fields of the channels (C, Y, X), normalized to the mean 1
+    dark : Union[float, numpy.ndarray], default 0
+        the dark offset or frames, broadcastable to the shape of flatfield
+
+    Examples
+    --------
+    >>> correction = pycziutils.estimate_shading("path/to/czi/file.czi")
+    >>> corrected = correction.apply(image, c=1)
+    """
+
+    def __init__(self, flatfield, dark=0):
+        self.flatfield = np.asarray(flatfield, dtype=np.float32)
+        self.dark = np.broadcast_to(
+            np.asarray(dark, dtype=np.float32), self.flatfield.shape
+        )
+
+    def apply(self, image, c=0, out=None):
+        """
+        correct a plane
+
+        Parameters
+        ----------
+        image : numpy.ndarray
+            the plane (Y, X)
+        c : int, default 0
+            the channel index of the plane
+        out : numpy.ndarray, default None
+            the float32 array to write the corrected plane to
+
+        Returns
+        -------
+        corrected : numpy.ndarray
+            the corrected float32 plane
+        """
+        out = np.subtract(image, self.dark[c], out=out, dtype=np.float32)
+        return np.divide(out, self.flatfield[c], out=out)
+
+
+def _camera_offset(ome_xml):
+    """
+    the dark offset as the lower camera LUT value, scaled by the valid bits
+    if the LUT is in fractions of the range (the upper value at most 1)
+    """
+    lut_low, lut_high = parse_camera_LUT(ome_xml)
+    if not np.isfinite(lut_low):
+        return 0.0
+    if lut_high <= 1:
+        try:
+            bits = parse_camera_bits(ome_xml)
+        except KeyError:
+            return 0.0
+        return float(lut_low) * (2 ** int(bits) - 1)
+    return float(lut_low)
+
+
+def _upsample(image, factor, shape):
+    """repeat the pixels factor times, extending the edges to shape"""
+    image = np.repeat(np.repeat(image, factor, axis=0), factor, axis=1)
+    pad = [(0, shape[0] - image.shape[0]), (0, shape[1] - image.shape[1])]
+    return np.pad(image, pad + [(0, 0)] * (image.ndim - 2), mode="edge")
+
+
+def estimate_shading(
+    path,
+    planes_df=None,
+    method="median",
+    downscale=8,
+    max_samples=256,
+    dark=None,
+    ome_xml=None,
+    reader="bioformats",
+    workers=4,
+    pool=None,
+    seed=0,
+):
+    """
+    estimate the flat-field of each channel, streaming the tiles
+
+    The tiles of each channel are read in parallel, corrected for the dark
+    offset and downsampled by block averaging, then reduced to the
+    pixel-wise median or mean. The memory is bounded by max_samples
+    downsampled tiles for the median, and by a downsampled tile for the mean.
+
+    Parameters
+    ----------
+    path : str
+        path to the czi file
+    planes_df : pandas.DataFrame, default None
+        the planes to use, such as the output of
+        :func:`pycziutils.parse_planes`. all the planes if None
+    method : str, default "median"
+        "median" or "mean", the pixel-wise statistic over the tiles
+    downscale : int, default 8
+        the downsampling factor of the tiles during the estimation
+    max_samples : int, default 256
+        the maximum number of the tiles randomly chosen per channel. all the
+        tiles if None
+    dark : Union[float, numpy.ndarray], default None
+        the dark offset or frames, broadcastable to (C, Y, X). if None,
+        computed from :func:`pycziutils.parse_camera_LUT` and
+        :func:`pycziutils.parse_camera_bits` of ome_xml (0 without it)
+    ome_xml : Union[str, CziMetadata], default None
+        the output of :func:`pycziutils.get_tiled_omexml_metadata` for the
+        file. read from the file if None and reader is "bioformats"
+    reader : str, default "bioformats"
+        "bioformats" or "czifile", see :func:`pycziutils.reduce_planes`
+    workers : int, default 4
+        the number of the worker threads
+    pool : TiledReaderPool, default None
+        the reader pool for the "bioformats" reader. a pool with workers
+        readers for the file is used and closed if None
+    seed : int, default 0
+        the seed of the random choice of the tiles
+
+    Returns
+    -------
+    correction : ShadingCorrection
+        the correction with the flat-fields normalized to the mean 1
+    """
+    if method not in _METHODS:
+        raise ValueError(f"method must be one of {_METHODS}")
+    downscale = int(downscale)
+    if downscale < 1:
+        raise ValueError("downscale must be a positive integer")
+    if ome_xml is None and reader == "bioformats":
+        from ._readers import get_tiled_omexml_metadata, javabridge_session
+
+        with javabridge_session:
+            ome_xml = get_tiled_omexml_metadata(path)
+    if planes_df is None and ome_xml is not None:
+        planes_df = parse_planes(ome_xml)
+    if dark is None:
+        dark = 0.0 if ome_xml is None else _camera_offset(ome_xml)
+    rng = np.random.default_rng(seed)
+
+    with _open_planes(path, planes_df, reader, pool, workers) as (
+        planes_df,
+        read,
+        executor,
+    ):
+        if len(planes_df) == 0:
+            raise ValueError("planes_df has no rows")
+        n_channels = int(planes_df["C_index"].max()) + 1
+        shape = read(*planes_df[_INDEX_COLUMNS].iloc[0].to_numpy(dtype=int)).shape
+        if downscale > min(shape[:2]):
+            raise ValueError("downscale must not exceed the tile size")
+        small_shape = (shape[0] // downscale, shape[1] // downscale) + shape[2:]
+        dark = np.broadcast_to(
+            np.asarray(dark, dtype=np.float32), (n_channels,) + shape
+        )
+        flatfield = np.ones((n_channels,) + shape, dtype=np.float32)
+
+        for c, channel_df in planes_df.groupby("C_index", sort=True):
+            rows = channel_df[_INDEX_COLUMNS].to_numpy(dtype=int)
+            if max_samples is not None and len(rows) > max_samples:
+                rows = rows[np.sort(rng.choice(len(rows), max_samples, replace=False))]
+            if method == "median":
+                samples = np.empty((len(rows),) + small_shape, dtype=np.float32)
+            else:
+                total = np.zeros(small_shape, dtype=np.float64)
+                lock = threading.Lock()
+
+            def sample(i):
+                plane = np.subtract(read(*rows[i]), dark[c], dtype=np.float32)
+                small = _block_average(plane, downscale)
+                del plane
+                if method == "median":
+                    samples[i] = small
+                else:
+                    with lock:
+                        np.add(total, small, out=total)
+
+            for _ in executor.map(sample, range(len(rows))):
+                pass
+            if method == "median":
+                estimate = np.median(samples, axis=0)
+                del samples
+            else:
+                estimate = total / len(rows)
+            estimate = estimate / np.mean(estimate)
+            flatfield[c] = _upsample(estimate, downscale, shape)
+
+    return ShadingCorrection(flatfield, dark)
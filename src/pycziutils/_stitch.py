@@ -0,0 +1,412 @@
+# coding: utf-8
+"""
+Streaming mosaic stitching by the stage positions of the tiles
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from ._parsers import _as_metadata, parse_pixel_size, parse_planes
+
+_BLENDINGS = ["overwrite", "linear"]
+
+
+def get_tile_offsets(planes_df, pixel_size, flip_x=False, flip_y=False):
+    """
+    convert the stage positions of the tiles to pixel offsets in the mosaic
+
+    Parameters
+    ----------
+    planes_df : pandas.DataFrame
+        the output of :func:`pycziutils.parse_planes`. the position of the
+        first plane of each image is used
+    pixel_size : list
+        the output of :func:`pycziutils.parse_pixel_size`, in the same unit as
+        the stage positions
+    flip_x, flip_y : bool, default False
+        if True, the pixel coordinates increase against the stage coordinates
+
+    Returns
+    -------
+    offsets : pandas.DataFrame
+        the columns "image", "Y_offset" and "X_offset", with the minimum
+        offsets at 0
+    """
+    tiles = planes_df.groupby("image", sort=True)[["X", "Y"]].first()
+    x = tiles["X"].to_numpy(dtype=np.float64) / float(pixel_size[0])
+    y = tiles["Y"].to_numpy(dtype=np.float64) / float(pixel_size[2])
+    if flip_x:
+        x = -x
+    if flip_y:
+        y = -y
+    return pd.DataFrame(
+        {
+            "image": tiles.index.to_numpy(),
+            "Y_offset": np.round(y - y.min()).astype(np.int64),
+            "X_offset": np.round(x - x.min()).astype(np.int64),
+        }
+    )
+
+
+def _block_average(plane, factor):
+    """
+    downsample a plane by averaging the factor x factor blocks, dropping the
+    last rows and columns not filling a block
+    """
+    if factor == 1:
+        return plane
+    h, w = plane.shape[0] // factor * factor, plane.shape[1] // factor * factor
+    blocks = plane[:h, :w].reshape(
+        (h // factor, factor, w // factor, factor) + plane.shape[2:]
+    )
+    mean = blocks.mean(axis=(1, 3))
+    if plane.dtype.kind in "iu":
+        mean = np.round(mean)
+    return mean.astype(plane.dtype)
+
+
+def _flattened_series(resolution_counts):
+    """
+    the (series, resolution) of each series of a reader with the flattened
+    resolutions, as the OME images, from the resolution counts of the series
+    """
+    return [(s, r) for s, n in enumerate(resolution_counts) for r in range(n)]
+
+
+def _overview_tile(read_level, sizes, downscale):
+    """
+    read a tile downscaled by downscale, from the coarsest resolution level
+    with the factor dividing downscale, block-averaged for the rest
+
+    read_level(level) reads the tile at the level, and sizes are the
+    (sizeY, sizeX) of the levels from the full resolution
+    """
+    level, factor = 0, 1
+    for r, (_, size_x) in enumerate(sizes[1:], 1):
+        level_factor = int(round(sizes[0][1] / size_x))
+        if level_factor > factor and downscale % level_factor == 0:
+            level, factor = r, level_factor
+    return _block_average(read_level(level), downscale // factor)
+
+
+def _linear_weight(shape):
+    """the weight decreasing linearly to the tile edges"""
+    ramps = [
+        np.minimum(np.arange(1, n + 1), np.arange(n, 0, -1)).astype(np.float32)
+        for n in shape
+    ]
+    return ramps[0][:, np.newaxis] * ramps[1][np.newaxis, :]
+
+
+def _new_array(shape, dtype, filename):
+    if filename is None:
+        return np.zeros(shape, dtype=dtype)
+    return np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=shape)
+
+
+class MosaicCanvas:
+    """
+    output canvas of a mosaic, to which the tiles are added one by one
+
+    Parameters
+    ----------
+    shape : tuple of int
+        the canvas shape (Y, X) or (Y, X, RGB)
+    dtype : numpy.dtype
+        the pixel type
+    out : str, default None
+        the path of the output .npy file, memory-mapped. the canvas is kept
+        in memory if None
+    blending : str, default "overwrite"
+        "overwrite" to overwrite the overlaps by the later tiles, or "linear"
+        to average the overlaps weighted by the distance to the tile edges
+    strip_rows : int, default 1024
+        the number of rows normalized at once by :meth:`finalize` for the
+        linear blending, to bound the memory
+
+    Examples
+    --------
+    >>> canvas = pycziutils.MosaicCanvas((1000, 1000), np.uint16, "mosaic.npy")
+    >>> canvas.add(tile, y=100, x=200)
+    >>> mosaic = canvas.finalize()
+    """
+
+    def __init__(self, shape, dtype, out=None, blending="overwrite", strip_rows=1024):
+        if blending not in _BLENDINGS:
+            raise ValueError(f"blending must be one of {_BLENDINGS}")
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.blending = blending
+        self.strip_rows = strip_rows
+        self.array = _new_array(self.shape, self.dtype, out)
+        self._temp_directory = None
+        if blending == "linear":
+            if out is None:
+                sum_filename = weight_filename = None
+            else:
+                self._temp_directory = tempfile.mkdtemp(
+                    dir=os.path.dirname(os.path.abspath(out))
+                )
+                sum_filename = os.path.join(self._temp_directory, "sum.npy")
+                weight_filename = os.path.join(self._temp_directory, "weight.npy")
+            self._sum = _new_array(self.shape, np.float32, sum_filename)
+            self._weight = _new_array(self.shape[:2], np.float32, weight_filename)
+
+    def add(self, tile, y, x):
+        """
+        add a tile to the canvas
+
+        Parameters
+        ----------
+        tile : numpy.ndarray
+            the tile image (Y, X) or (Y, X, RGB)
+        y, x : int
+            the offset of the tile in the canvas. the parts outside the
+            canvas are ignored
+        """
+        tile = np.asarray(tile)
+        y0, x0 = max(y, 0), max(x, 0)
+        y1 = min(y + tile.shape[0], self.shape[0])
+        x1 = min(x + tile.shape[1], self.shape[1])
+        if y1 <= y0 or x1 <= x0:
+            return
+        tile_slice = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+        canvas_slice = (slice(y0, y1), slice(x0, x1))
+        if self.blending == "overwrite":
+            self.array[canvas_slice] = tile[tile_slice]
+        else:
+            weight = _linear_weight(tile.shape[:2])[tile_slice]
+            self._weight[canvas_slice] += weight
+            weight = weight.reshape(weight.shape + (1,) * (tile.ndim - 2))
+            self._sum[canvas_slice] += tile[tile_slice] * weight
+
+    def finalize(self):
+        """
+        finish the canvas
+
+        Returns
+        -------
+        mosaic : numpy.ndarray
+            the mosaic, a numpy.memmap if out is given
+        """
+        if self.blending == "linear":
+            for y in range(0, self.shape[0], self.strip_rows):
+                strip = slice(y, y + self.strip_rows)
+                weight = self._weight[strip]
+                weight = weight.reshape(weight.shape + (1,) * (len(self.shape) - 2))
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    values = np.where(weight > 0, self._sum[strip] / weight, 0)
+                if self.dtype.kind in "iu":
+                    values = np.round(values)
+                self.array[strip] = values
+            del self._sum, self._weight
+            if self._temp_directory is not None:
+                shutil.rmtree(self._temp_directory, ignore_errors=True)
+                self._temp_directory = None
+            self.blending = None  # finalized
+        if isinstance(self.array, np.memmap):
+            self.array.flush()
+        return self.array
+
+
+def stitch_tiles(
+    path,
+    out=None,
+    t=0,
+    z=0,
+    c=0,
+    blending="overwrite",
+    ome_xml=None,
+    pool=None,
+    flip_x=False,
+    flip_y=False,
+):
+    """
+    stitch the tiles of a plane by the stage positions, reading one tile at a
+    time
+
+    The tiles are the images at the full resolution; the pyramid levels
+    stored as separate images are skipped.
+
+    Parameters
+    ----------
+    path : str
+        path to the czi file
+    out : str, default None
+        the path of the output .npy file, memory-mapped. the mosaic is kept
+        in memory if None
+    t, z, c : int, default 0
+        the time, Z and channel indices of the plane to stitch
+    blending : str, default "overwrite"
+        "overwrite" or "linear", see :class:`pycziutils.MosaicCanvas`
+    ome_xml : Union[str, CziMetadata], default None
+        the output of :func:`pycziutils.get_tiled_omexml_metadata` for the
+        file. read from the file if None
+    pool : TiledReaderPool, default None
+        the reader pool. a pool with a reader for the file is used and closed
+        if None
+    flip_x, flip_y : bool, default False
+        passed to :func:`pycziutils.get_tile_offsets`
+
+    Returns
+    -------
+    mosaic : numpy.ndarray
+        the mosaic, a numpy.memmap if out is given
+    """
+    from ._pool import TiledReaderPool
+    from ._readers import (
+        _full_resolution_images,
+        get_tiled_omexml_metadata,
+        javabridge_session,
+    )
+
+    own_pool = pool is None
+    if own_pool:
+        pool = TiledReaderPool()
+    try:
+        with javabridge_session:
+            if ome_xml is None:
+                ome_xml = get_tiled_omexml_metadata(path)
+            ome_xml = _as_metadata(ome_xml)
+            # the pyramid levels are separate images, not placed as tiles
+            planes_df = parse_planes(ome_xml)
+            planes_df = planes_df[
+                planes_df["image"].isin(_full_resolution_images(path))
+                & (planes_df["T_index"] == t)
+                & (planes_df["Z_index"] == z)
+                & (planes_df["C_index"] == c)
+            ]
+            if len(planes_df) == 0:
+                raise IndexError(f"no plane for t={t}, z={z}, c={c}")
+            # the pixel sizes differ by the level
+            pixel_size = parse_pixel_size(ome_xml, assume_all_equal=False)[
+                int(planes_df["image"].iloc[0])
+            ]
+            offsets = get_tile_offsets(
+                planes_df, pixel_size, flip_x=flip_x, flip_y=flip_y
+            )
+
+            def read_tile(image):
+                return pool.read(path, series=image, t=t, z=z, c=c, rescale=False)
+
+            canvas = None
+            for row in offsets.itertuples():
+                tile = read_tile(int(row.image))
+                if canvas is None:
+                    shape = (
+                        offsets["Y_offset"].max() + tile.shape[0],
+                        offsets["X_offset"].max() + tile.shape[1],
+                    ) + tile.shape[2:]
+                    canvas = MosaicCanvas(shape, tile.dtype, out=out, blending=blending)
+                canvas.add(tile, row.Y_offset, row.X_offset)
+    finally:
+        if own_pool:
+            pool.close()
+    return canvas.finalize()
+
+
+def make_overview(
+    path,
+    downscale=16,
+    t=0,
+    z=0,
+    c=0,
+    out=None,
+    ome_xml=None,
+    flip_x=False,
+    flip_y=False,
+):
+    """
+    make a downsampled overview of the tiles placed by the stage positions
+
+    For each tile, the coarsest pyramid level of the file with the factor
+    dividing downscale is read, and block-averaged for the rest of the
+    downscaling. Without such levels, the full resolution tiles are
+    block-averaged one by one.
+
+    Parameters
+    ----------
+    path : str
+        path to the czi file
+    downscale : int, default 16
+        the downscaling factor of the overview
+    t, z, c : int, default 0
+        the time, Z and channel indices of the plane
+    out : str, default None
+        the path of the output .npy file, memory-mapped. the overview is kept
+        in memory if None
+    ome_xml : Union[str, CziMetadata], default None
+        the output of :func:`pycziutils.get_tiled_omexml_metadata` for the
+        file. read from the file if None
+    flip_x, flip_y : bool, default False
+        passed to :func:`pycziutils.get_tile_offsets`
+
+    Returns
+    -------
+    overview : numpy.ndarray
+        the overview image, a numpy.memmap if out is given
+    """
+    from ._readers import (
+        get_resolution_sizes,
+        get_tiled_omexml_metadata,
+        get_tiled_reader,
+        javabridge_session,
+        read_plane,
+    )
+
+    downscale = int(downscale)
+    if downscale < 1:
+        raise ValueError("downscale must be a positive integer")
+    with javabridge_session:
+        if ome_xml is None:
+            ome_xml = get_tiled_omexml_metadata(path)
+        ome_xml = _as_metadata(ome_xml)
+        reader = get_tiled_reader(path, flattened_resolutions=False)
+        try:
+            level_sizes = [
+                get_resolution_sizes(reader, series)
+                for series in range(reader.rdr.getSeriesCount())
+            ]
+            # the OME images are the flattened series, with the pyramid levels
+            # as separate images. only the full resolution ones are placed
+            flattened = _flattened_series([len(sizes) for sizes in level_sizes])
+            series = {image: s for image, (s, r) in enumerate(flattened) if r == 0}
+            planes_df = parse_planes(ome_xml)
+            planes_df = planes_df[
+                planes_df["image"].isin(list(series))
+                & (planes_df["T_index"] == t)
+                & (planes_df["Z_index"] == z)
+                & (planes_df["C_index"] == c)
+            ]
+            if len(planes_df) == 0:
+                raise IndexError(f"no plane for t={t}, z={z}, c={c}")
+            # the pixel sizes differ by the level
+            pixel_size = parse_pixel_size(ome_xml, assume_all_equal=False)[
+                int(planes_df["image"].iloc[0])
+            ]
+            offsets = get_tile_offsets(
+                planes_df, pixel_size, flip_x=flip_x, flip_y=flip_y
+            )
+
+            canvas = None
+            for row in offsets.itertuples():
+                s = series[int(row.image)]
+                tile = _overview_tile(
+                    lambda level: read_plane(reader, s, t, z, c, resolution=level),
+                    level_sizes[s],
+                    downscale,
+                )
+                if canvas is None:
+                    shape = (
+                        offsets["Y_offset"].max() // downscale + tile.shape[0],
+                        offsets["X_offset"].max() // downscale + tile.shape[1],
+                    ) + tile.shape[2:]
+                    canvas = MosaicCanvas(shape, tile.dtype, out=out)
+                canvas.add(tile, row.Y_offset // downscale, row.X_offset // downscale)
+        finally:
+            reader.close()
+    return canvas.finalize()
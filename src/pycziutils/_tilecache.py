@@ -0,0 +1,208 @@
+# coding: utf-8
+"""
+In-memory LRU cache of the tiles read through the tiled readers
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+
+def _hashable(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(v) for v in value)
+    if isinstance(value, slice):
+        return ("slice", value.start, value.stop, value.step)
+    return value
+
+
+def _tile_key(path, series, t, z, c, kwargs):
+    options = tuple((k, _hashable(v)) for k, v in sorted(kwargs.items()))
+    return (path, series, t, z, c, options)
+
+
+class TileCache:
+    """
+    thread-safe LRU cache of the tiles, bounded by the total bytes
+
+    The cached arrays are read-only and shared by the callers.
+
+    Parameters
+    ----------
+    max_bytes : int, default 2**30
+        the maximum total size of the cached tiles in bytes. a tile larger
+        than this is not cached
+
+    Attributes
+    ----------
+    hits : int
+        the number of cache hits
+    misses : int
+        the number of cache misses
+    evictions : int
+        the number of evicted tiles
+    size : int
+        the total size of the cached tiles in bytes
+
+    Examples
+    --------
+    >>> cache = pycziutils.TileCache(max_bytes=2**28)
+    >>> reader = cache.wrap(pycziutils.get_tiled_reader("path/to/czi/file.czi"))
+    >>> image = reader.read(series=3, c=1)  # read through bioformats
+    >>> image = reader.read(series=3, c=1)  # taken from the cache
+    """
+
+    def __init__(self, max_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def get(self, key):
+        """
+        get the cached tile
+
+        Parameters
+        ----------
+        key : hashable
+            the key of the tile
+
+        Returns
+        -------
+        image : numpy.ndarray
+            the read-only tile, None if not cached
+        """
+        with self._lock:
+            image = self._tiles.get(key)
+            if image is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._tiles.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        """
+        cache the tile, evicting the least recently used tiles if needed
+
+        Parameters
+        ----------
+        key : hashable
+            the key of the tile
+        image : numpy.ndarray
+            the tile, made read-only
+
+        Returns
+        -------
+        image : numpy.ndarray
+            the read-only tile
+        """
+        image.flags.writeable = False
+        if image.nbytes > self.max_bytes:
+            return image
+        with self._lock:
+            previous = self._tiles.pop(key, None)
+            if previous is not None:
+                self.size -= previous.nbytes
+            self._tiles[key] = image
+            self.size += image.nbytes
+            while self.size > self.max_bytes:
+                _, evicted = self._tiles.popitem(last=False)
+                self.size -= evicted.nbytes
+                self.evictions += 1
+        return image
+
+    def clear(self):
+        """remove all the tiles"""
+        with self._lock:
+            self._tiles.clear()
+            self.size = 0
+
+    def read(self, read_func, path, series=0, t=0, z=0, c=0, **kwargs):
+        """
+        read a tile through the cache
+
+        Parameters
+        ----------
+        read_func : callable
+            called as read_func(series=series, t=t, z=z, c=c, **kwargs) if not
+            cached
+        path : str
+            path to the czi file, used in the key
+        series, t, z, c : int, default 0
+            the image, time, Z and channel indices of the plane
+        **kwargs
+            passed to read_func and used in the key, such as XYWH or rescale
+
+        Returns
+        -------
+        image : numpy.ndarray
+            the read-only tile
+        """
+        key = _tile_key(path, series, t, z, c, kwargs)
+        image = self.get(key)
+        if image is None:
+            image = read_func(series=series, t=t, z=z, c=c, **kwargs)
+            image = self.put(key, image)
+        return image
+
+    def wrap(self, reader):
+        """
+        wrap a reader to read the tiles through the cache
+
+        Parameters
+        ----------
+        reader : bioformats.ImageReader
+            the reader, such as the output of :func:`pycziutils.get_tiled_reader`
+
+        Returns
+        -------
+        reader : CachedReader
+            the wrapped reader
+        """
+        return CachedReader(reader, self)
+
+
+class CachedReader:
+    """
+    reader whose read method goes through a :class:`pycziutils.TileCache`.
+    the other attributes are those of the wrapped reader
+
+    Parameters
+    ----------
+    reader : bioformats.ImageReader
+        the wrapped reader
+    cache : TileCache
+        the tile cache
+    """
+
+    def __init__(self, reader, cache):
+        self.reader = reader
+        self.cache = cache
+        self._path = os.path.abspath(reader.path) if reader.path else id(reader)
+
+    def read(self, c=None, z=0, t=0, series=None, **kwargs):
+        """
+        read a tile, see bioformats.ImageReader.read. the returned array is
+        read-only
+        """
+        if kwargs.get("wants_max_intensity", False):
+            return self.reader.read(series=series, t=t, z=z, c=c, **kwargs)
+        return self.cache.read(
+            self.reader.read, self._path, series=series, t=t, z=z, c=c, **kwargs
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.reader, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.reader.close()
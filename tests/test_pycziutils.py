@@ -4,10 +4,16 @@
 """Tests for `pycziutils` package."""
 
 import os
+import pickle
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from glob import glob
 from os import path
 
 import numpy as np
+import pandas as pd
 import pycziutils
 import pytest
 
@@ -50,6 +56,65 @@ def assert_indices(series, index_max):
     assert np.array_equal(np.sort(series.unique()), np.arange(index_max))
 
 
+def make_ome_xml(images=3, T=2, channels=("Phase", "EGFP"), acquisition_date=True):
+    """a small OME-XML with the planes of the images, without DeltaT at T=0"""
+    out = ['<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06">']
+    for i in range(images):
+        out.append(f'<Image ID="Image:{i}">')
+        if acquisition_date:
+            out.append(f"<AcquisitionDate>2021-04-12T02:1{i}:21.340</AcquisitionDate>")
+        out.append(
+            f'<Pixels ID="Pixels:{i}" PhysicalSizeX="1.3" PhysicalSizeY="1.3" '
+            f'SizeC="{len(channels)}" SizeT="{T}" SizeZ="1">'
+        )
+        for c, name in enumerate(channels):
+            out.append(f'<Channel ID="Channel:{i}:{c}" Name="{name}"/>')
+        for t in range(T):
+            for c in range(len(channels)):
+                delta_t = f'DeltaT="{10.5 * t + 0.125 * c + i:.3f}" ' if t else ""
+                out.append(
+                    f'<Plane {delta_t}PositionX="{100.0 * i}" PositionY="-20.5" '
+                    f'PositionZ="0.5" TheC="{c}" TheT="{t}" TheZ="0"/>'
+                )
+        out.append("</Pixels></Image>")
+    out.append("</OME>")
+    return "".join(out)
+
+
+def parse_planes_per_image(ome_xml, acquisition_timezone=0):
+    """the former per-image implementation of parse_planes"""
+    keys = ["@PositionX", "@PositionY", "@PositionZ", "@DeltaT"]
+    keys += ["@TheC", "@TheT", "@TheZ"]
+    names = ["X", "Y", "Z", "T", "C_index", "T_index", "Z_index"]
+    positions = pycziutils.parse_properties(ome_xml, keys, domain="plane")
+    acq_dates = pycziutils.parse_properties(ome_xml, "AcquisitionDate", "image")
+    acquisition_timezone = timezone(timedelta(hours=acquisition_timezone))
+    dfs = []
+    for j, (ps, acq_date) in enumerate(zip(positions, acq_dates)):
+        df = pd.DataFrame(data=ps, columns=names, dtype=np.float64)
+        df["image"] = j
+        df["plane"] = range(len(ps))
+        df["image_acquisition_T"] = (
+            datetime.strptime(acq_date, "%Y-%m-%dT%H:%M:%S.%f")
+            .replace(tzinfo=timezone.utc)
+            .astimezone(acquisition_timezone)
+        )
+        dfs.append(df)
+    planes_df = pd.concat(dfs)
+    for k in [n for n in names if "index" in n] + ["image", "plane"]:
+        planes_df[k] = planes_df[k].astype(int)
+    non_nan_indices = ~planes_df["T"].isna()
+    planes_df.loc[non_nan_indices, "absolute_T"] = planes_df.loc[
+        non_nan_indices, "image_acquisition_T"
+    ] + np.vectorize(timedelta)(
+        seconds=planes_df.loc[non_nan_indices, "T"].astype(np.float64)
+    )
+    planes_df = planes_df.reset_index()
+    channels = pycziutils.parse_channels(ome_xml)
+    planes_df["C"] = planes_df["C_index"].apply(lambda i: channels[i]["@Name"])
+    return planes_df
+
+
 @pycziutils.with_javabridge
 def test_read_images_by_dataframe(czi_files_path):
     for name, data in czi_files_path:
@@ -92,3 +157,737 @@ def test_read_images_by_dataframe(czi_files_path):
             )
             assert np.any(np.array(image) > 0)
             # TODO check other properties
+
+
+@pycziutils.with_javabridge
+def test_czi_metadata(czi_files_path):
+    for name, _data in czi_files_path:
+        ome_xml = pycziutils.get_tiled_omexml_metadata(name)
+        # the parsed metadata object gives the same results as the string
+        metadata = pycziutils.CziMetadata(ome_xml)
+        assert pycziutils.parse_planes(ome_xml).equals(
+            pycziutils.parse_planes(metadata)
+        )
+        for parser in [
+            pycziutils.parse_channels,
+            pycziutils.parse_pixel_size,
+            pycziutils.parse_binning,
+            pycziutils.parse_camera_roi,
+            pycziutils.parse_camera_LUT,
+            pycziutils.parse_camera_bits,
+        ]:
+            np.testing.assert_equal(parser(ome_xml), parser(metadata))
+
+
+@pycziutils.with_javabridge
+def test_parse_planes_iterparse(czi_files_path):
+    for name, _data in czi_files_path:
+        ome_xml = pycziutils.get_tiled_omexml_metadata(name)
+        assert pycziutils.parse_planes(ome_xml).equals(
+            pycziutils.parse_planes(ome_xml, backend="iterparse")
+        )
+
+
+@pycziutils.with_javabridge
+def test_czi_file_bioformats(czi_files_path):
+    for name, _data in czi_files_path:
+        planes_df = pycziutils.parse_planes(pycziutils.get_tiled_omexml_metadata(name))
+        # the plane table read without bioformats has the same planes
+        czi_planes_df = pycziutils.get_czi_planes(name)
+        for k in ["image", "plane", "C_index", "T_index", "Z_index", "C"]:
+            assert np.array_equal(czi_planes_df[k], planes_df[k])
+
+        # the pixels read without bioformats are the same
+        reader = pycziutils.get_tiled_reader(name)
+        with pycziutils.CziFile(name) as czi:
+            for _, row in czi_planes_df.iterrows():
+                kwargs = dict(
+                    series=row["image"],
+                    t=row["T_index"],
+                    z=row["Z_index"],
+                    c=row["C_index"],
+                )
+                assert np.array_equal(
+                    czi.read(**kwargs), reader.read(**kwargs, rescale=False)
+                )
+        reader.close()
+
+
+@pycziutils.with_javabridge
+def test_metadata_cache_bioformats(czi_files_path, tmp_path):
+    for i, (name, _data) in enumerate(czi_files_path):
+        ome_xml = pycziutils.get_tiled_omexml_metadata(name)
+        planes_df = pycziutils.parse_planes(ome_xml)
+        # the cached metadata is the same
+        cache = pycziutils.MetadataCache(str(tmp_path / f"cache{i}"))
+        for _ in range(2):
+            assert cache.get_tiled_omexml_metadata(name) == ome_xml
+            assert cache.parse_planes(name).equals(planes_df)
+        # a hit or a miss per call, not counting the OME-XML read in parse_planes
+        assert cache.hits == 2 and cache.misses == 2
+
+
+@pycziutils.with_javabridge
+def test_get_tiled_planes(czi_files_path):
+    for name, _data in czi_files_path:
+        planes_df = pycziutils.parse_planes(pycziutils.get_tiled_omexml_metadata(name))
+        # the same planes from the metadata store without the OME-XML
+        assert planes_df.equals(pycziutils.get_tiled_planes(name))
+
+
+@pycziutils.with_javabridge
+def test_metadata_level(czi_files_path):
+    for name, data in czi_files_path:
+        ome_xml = pycziutils.get_tiled_omexml_metadata(name)
+        # the reduced metadata gives the same planes and the selected keys
+        prefix = "HardwareSetting|ParameterCollection|"
+        reduced_ome_xml = pycziutils.get_tiled_omexml_metadata(
+            name, metadata_level="no_overlays", original_metadata_keys=[prefix + "*"]
+        )
+        assert pycziutils.parse_planes(ome_xml).equals(
+            pycziutils.parse_planes(reduced_ome_xml)
+        )
+        annotations = pycziutils.parse_structured_annotation_dict(reduced_ome_xml)
+        assert len(annotations) > 0
+        assert all(k.startswith(prefix) for k in annotations)
+        assert pycziutils.parse_camera_bits(
+            reduced_ome_xml
+        ) == pycziutils.parse_camera_bits(ome_xml)
+        with pytest.raises(ValueError):
+            pycziutils.get_tiled_omexml_metadata(name, metadata_level="none")
+
+        # the reader with the minimum metadata reads the same pixels
+        minimum_reader = pycziutils.get_tiled_reader(name, metadata_level="minimum")
+        with pycziutils.CziFile(name) as czi:
+            for c in range(len(data["channel"])):
+                assert np.array_equal(
+                    czi.read(series=0, c=c),
+                    minimum_reader.read(series=0, c=c, rescale=False),
+                )
+        minimum_reader.close()
+
+
+def test_lazy_import(czi_files_path):
+    # run in a new interpreter, as the modules may be imported by the others
+    script = """
+import sys
+import pycziutils
+
+heavy = ["bioformats", "javabridge", "pandas", "xmltodict"]
+assert not [m for m in heavy if m in sys.modules], "imported on import"
+# the parsers and the reader without bioformats work without Java
+sys.modules["bioformats"] = sys.modules["javabridge"] = None
+planes_df = pycziutils.get_czi_planes(sys.argv[1])
+assert len(planes_df) > 0
+assert pycziutils.CziMetadata("<OME/>").structured_annotation_dict == {}
+try:
+    pycziutils.get_tiled_reader
+except ImportError:
+    pass
+else:
+    raise AssertionError("bioformats is imported")
+"""
+    name, _data = czi_files_path[0]
+    subprocess.run([sys.executable, "-c", script, name], check=True)
+    assert set(pycziutils.__all__) <= set(dir(pycziutils))
+    with pytest.raises(AttributeError):
+        pycziutils.no_such_function
+
+
+def test_parse_planes_per_image():
+    ome_xml = make_ome_xml()
+    expected = parse_planes_per_image(ome_xml, acquisition_timezone=9)
+    for backend in ["xmltodict", "iterparse"]:
+        planes_df = pycziutils.parse_planes(
+            ome_xml, acquisition_timezone=9, backend=backend
+        )
+        assert list(planes_df.columns) == list(expected.columns)
+        # absolute_T is datetime64 with NaT for the planes without DeltaT,
+        # instead of the datetime objects and NaN
+        dtype = planes_df["image_acquisition_T"].dtype
+        assert planes_df["absolute_T"].dtype == dtype
+        assert planes_df["absolute_T"].isna().equals(expected["T"].isna())
+        # the time unit of the datetime objects depends on the pandas version
+        expected = expected.astype({"image_acquisition_T": dtype, "absolute_T": dtype})
+        pd.testing.assert_frame_equal(planes_df, expected)
+
+
+def test_parse_planes_without_acquisition_date():
+    ome_xml = make_ome_xml(acquisition_date=False)
+    for backend in ["xmltodict", "iterparse"]:
+        with pytest.raises(KeyError):
+            pycziutils.parse_planes(ome_xml, backend=backend)
+
+
+def test_annotation_store():
+    annotations = [
+        ("HardwareSetting|ParameterCollection|Binning", "[4,4]"),
+        ("HardwareSetting|ParameterCollection|ValidBits", "[12]"),
+        ("HardwareSetting|ParameterCollectionX", "1.5"),
+        ("Information|Image|Name", "not json"),
+    ]
+    ome_xml = (
+        '<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06">'
+        "<Image ID='Image:0'/><StructuredAnnotations>"
+        + "".join(
+            f'<XMLAnnotation ID="Annotation:{i}"><Value><OriginalMetadata>'
+            f"<Key>{k}</Key><Value>{v}</Value></OriginalMetadata></Value>"
+            "</XMLAnnotation>"
+            for i, (k, v) in enumerate(annotations)
+        )
+        + "</StructuredAnnotations></OME>"
+    )
+    metadata = pycziutils.CziMetadata(ome_xml)
+    store = metadata.annotations
+    assert dict(store) == dict(annotations)
+    assert pycziutils.parse_structured_annotation_dict(metadata) == dict(annotations)
+    assert store.value("HardwareSetting|ParameterCollection|Binning") == [4, 4]
+    assert store.value("Information|Image|Name") == "not json"
+    assert store.keys_with_prefix("HardwareSetting|ParameterCollection|*") == [
+        "HardwareSetting|ParameterCollection|Binning",
+        "HardwareSetting|ParameterCollection|ValidBits",
+    ]
+    assert store.with_prefix("Information|") == {"Information|Image|Name": "not json"}
+    assert store.binning == pycziutils.parse_binning(ome_xml) == [4, 4]
+    assert store.camera_bits == pycziutils.parse_camera_bits(ome_xml) == 12
+    assert np.all(np.isnan(pycziutils.parse_camera_LUT(ome_xml)))
+    with pytest.raises(KeyError):
+        pycziutils.parse_camera_roi(metadata)
+
+
+def test_javabridge_session(czi_files_path):
+    session = pycziutils.javabridge_session
+    name = czi_files_path[0][0]
+    with session:
+        with session:  # reentrant
+            assert session.is_running
+        assert session.startup_time > 0
+        tiled_czi_ome_xml = pycziutils.get_tiled_omexml_metadata(name)
+
+    # the JVM is kept running, and used from the worker threads
+    read_metadata = pycziutils.with_javabridge(pycziutils.get_tiled_omexml_metadata)
+    with ThreadPoolExecutor(2) as executor:
+        xmls = list(executor.map(read_metadata, [name] * 4))
+    assert xmls == [tiled_czi_ome_xml] * 4
+    assert session.is_running
+
+
+def test_javabridge_session_in_worker(czi_files_path):
+    # run in a new interpreter to start the JVM in a worker thread. the JVM
+    # waits for the threads left attached at the exit, hanging the process
+    script = """
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pycziutils
+
+session = pycziutils.javabridge_session
+
+
+def read():
+    with session:
+        reader = pycziutils.get_tiled_reader(sys.argv[1])
+        reader.read(rescale=False)
+        reader.close()
+    return threading.get_ident()
+
+
+with ThreadPoolExecutor(1) as executor:
+    ident = executor.submit(read).result()
+    assert ident not in session._attached_threads
+    assert executor.submit(read).result() not in session._attached_threads
+with session:
+    pass
+assert session._attached_threads == {threading.get_ident()}
+"""
+    name, _data = czi_files_path[0]
+    subprocess.run([sys.executable, "-c", script, name], check=True, timeout=300)
+
+
+@pycziutils.with_javabridge
+def test_tiled_reader_pool(czi_files_path):
+    files = [name for name, _data in czi_files_path]
+    with pycziutils.TiledReaderPool(readers_per_file=2, max_files=1) as pool:
+        for name in files:
+            planes_df = pycziutils.get_czi_planes(name)
+            rows = planes_df[["image", "T_index", "Z_index", "C_index"]].to_numpy()
+
+            def read(row):
+                return pool.read(
+                    name, series=row[0], t=row[1], z=row[2], c=row[3], rescale=False
+                )
+
+            with ThreadPoolExecutor(4) as executor:
+                images = list(executor.map(read, rows))
+            with pycziutils.CziFile(name) as czi:
+                for row, image in zip(rows, images):
+                    assert np.array_equal(image, czi.read(*row))
+        assert pool.opened <= 2 * len(files)
+        assert len(pool._files) == 1
+
+    # the tiles read through the cache
+    cache = pycziutils.TileCache()
+    with pycziutils.TiledReaderPool(tile_cache=cache) as pool:
+        with cache.wrap(pycziutils.get_tiled_reader(files[0])) as reader:
+            for _ in range(2):
+                image = pool.read(files[0], rescale=False)
+                assert np.array_equal(image, reader.read(c=0, rescale=False))
+    assert cache.hits == 2 and cache.misses == 2
+
+    # the tiles read into a given buffer
+    with pycziutils.TiledReaderPool() as pool:
+        with pycziutils.CziFile(files[0]) as czi:
+            image = czi.read()
+            out = np.zeros_like(image)
+            assert pool.read(files[0], out=out) is out
+            assert np.array_equal(out, image)
+            region = pool.read(files[0], region=(5, 10, 30, 20))
+            assert np.array_equal(region, image[10:30, 5:35])
+
+
+@pycziutils.with_javabridge
+def test_read_planes(czi_files_path):
+    for name, _data in czi_files_path:
+        planes_df = pycziutils.get_czi_planes(name).iloc[::-1]
+        with pycziutils.CziFile(name) as czi:
+            expected = np.array(
+                [
+                    czi.read(
+                        series=row.image, t=row.T_index, z=row.Z_index, c=row.C_index
+                    )
+                    for row in planes_df.itertuples()
+                ]
+            )
+        for backend in ["threads", "processes"]:
+            images = pycziutils.read_planes(
+                name,
+                planes_df,
+                workers=2,
+                backend=backend,
+                max_in_flight=3,
+                rescale=False,
+            )
+            assert np.array_equal(images, expected)
+
+        # corrected while being copied
+        correction = pycziutils.ShadingCorrection(
+            np.full((len(_data["channel"]),) + expected.shape[1:], 2.0), dark=1
+        )
+        images = pycziutils.read_planes(
+            name, planes_df, workers=2, correction=correction, rescale=False
+        )
+        assert images.dtype == np.float32
+        assert np.allclose(images, (expected - 1.0) / 2)
+
+
+def test_extract_metadata_many(czi_files_path, tmp_path):
+    files = [name for name, _data in czi_files_path]
+    missing = str(tmp_path / "missing.czi")
+    results = list(pycziutils.extract_metadata_many(files + [missing], processes=2))
+    assert sorted(r.path for r in results) == sorted(files + [missing])
+    for result in results:
+        if result.path == missing:
+            assert result.error is not None
+            assert result.ome_xml is None and result.planes_df is None
+        else:
+            assert result.error is None
+            assert result.planes_df.equals(pycziutils.parse_planes(result.ome_xml))
+
+
+def test_extract_metadata_unpicklable_error(monkeypatch):
+    from pycziutils import _batch
+
+    class JavaObject:
+        def __reduce__(self):
+            raise TypeError("cannot pickle a Java object")
+
+    class JavaException(Exception):
+        def __init__(self, throwable):
+            self.throwable = throwable
+            super().__init__("java.io.IOException: broken file")
+
+    def fail(path, group_file):
+        raise JavaException(JavaObject())
+
+    monkeypatch.setattr(_batch, "get_tiled_omexml_metadata", fail)
+    with pytest.raises(RuntimeError, match="IOException: broken file") as e:
+        _batch._extract_metadata("broken.czi", 0, True)
+    assert "Traceback" in str(e.value)
+    pickle.loads(pickle.dumps(e.value))
+
+    # picklable exceptions are sent as they are
+    def missing(path, group_file):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(_batch, "get_tiled_omexml_metadata", missing)
+    with pytest.raises(FileNotFoundError):
+        _batch._extract_metadata("missing.czi", 0, True)
+
+
+@pycziutils.with_javabridge
+def test_open_lazy(czi_files_path):
+    for name, data in czi_files_path:
+        with pycziutils.open_lazy(name) as array:
+            n_tiles = data["tile"][0] * data["tile"][1]
+            n_channels = len(data["channel"])
+            assert array.shape[:4] == (n_tiles, data["time"], n_channels, data["z"])
+            assert array.images == list(range(n_tiles))  # no pyramid levels
+            with pycziutils.CziFile(name) as czi:
+                tile = n_tiles - 1
+                image = czi.read(series=tile, c=n_channels - 1)
+                assert array.dtype == image.dtype
+                assert np.array_equal(array[tile, 0, -1, 0], image)
+                assert np.array_equal(
+                    array[-1, ..., 10:20, ::2][0, -1, 0], image[10:20, ::2]
+                )
+            shape = np.asarray(array[:2]).shape
+            assert shape == (min(2, n_tiles),) + array.shape[1:]
+        assert array.pool.opened == 1 and not array.pool._files  # closed
+
+        # a given pool is left open
+        with pycziutils.TiledReaderPool() as pool:
+            with pycziutils.open_lazy(name, pool=pool) as array:
+                array[0, 0, 0, 0]
+            assert pool._files[os.path.abspath(name)].idle
+
+
+@pycziutils.with_javabridge
+def test_stitch_tiles(czi_files_path, tmp_path):
+    for name, _data in czi_files_path:
+        ome_xml = pycziutils.get_tiled_omexml_metadata(name)
+        planes_df = pycziutils.parse_planes(ome_xml)
+        offsets = pycziutils.get_tile_offsets(
+            planes_df, pycziutils.parse_pixel_size(ome_xml)
+        )
+        last = offsets.iloc[-1]
+        with pycziutils.CziFile(name) as czi:
+            tile = czi.read(series=last["image"])
+        for blending in ["overwrite", "linear"]:
+            out = str(tmp_path / f"{blending}.npy")
+            mosaic = pycziutils.stitch_tiles(
+                name, out=out, ome_xml=ome_xml, blending=blending
+            )
+            assert mosaic.shape == (
+                offsets["Y_offset"].max() + tile.shape[0],
+                offsets["X_offset"].max() + tile.shape[1],
+            )
+            assert np.array_equal(np.load(out, mmap_mode="r"), mosaic)
+        y, x = last["Y_offset"], last["X_offset"]
+        stitched = np.load(str(tmp_path / "overwrite.npy"))
+        assert np.array_equal(
+            stitched[y : y + tile.shape[0], x : x + tile.shape[1]], tile
+        )
+
+
+@pycziutils.with_javabridge
+def test_export_zarr(czi_files_path, tmp_path):
+    zarr = pytest.importorskip("zarr")
+    # the file with the most channels
+    name, data = max(czi_files_path, key=lambda f: len(f[1]["channel"]))
+    out = str(tmp_path / "out.zarr")
+    pycziutils.export_zarr(name, out, levels=2, chunks=(128, 128), workers=2)
+    root = zarr.open_group(out, mode="r")
+    assert root.attrs["pycziutils"]["complete"]
+    assert len(list(root.group_keys())) == data["tile"][0] * data["tile"][1]
+    labels = [c["label"] for c in root["0"].attrs["omero"]["channels"]]
+    assert labels == data["channel"]
+    with pycziutils.CziFile(name) as czi:
+        for c in range(len(data["channel"])):
+            image = czi.read(c=c)
+            assert root["0/0"].dtype == image.dtype
+            assert np.array_equal(root["0/0"][0, c, 0], image)
+            assert root["0/1"].shape[-2:] == (image.shape[0] // 2, image.shape[1] // 2)
+
+    # an interrupted export is resumed, skipping the recorded planes
+    root = zarr.open_group(out, mode="a")
+    del root.attrs["pycziutils"]
+    root["0/0"][0, :, 0] = 0
+    os.makedirs(os.path.join(out, ".pycziutils_progress"))
+    open(os.path.join(out, ".pycziutils_progress", "0-0-0-1"), "w").close()
+    pycziutils.export_zarr(name, out, levels=2, chunks=(128, 128), workers=2)
+    assert np.all(root["0/0"][0, 1, 0] == 0)
+    with pycziutils.CziFile(name) as czi:
+        assert np.array_equal(root["0/0"][0, 0, 0], czi.read(c=0))
+        pycziutils.export_zarr(name, out, levels=2, resume=False)
+        assert np.array_equal(root["0/0"][0, 1, 0], czi.read(c=1))
+
+
+@pycziutils.with_javabridge
+def test_make_overview(czi_files_path):
+    for name, _data in czi_files_path:
+        overview = pycziutils.make_overview(name, downscale=4)
+        with pycziutils.CziFile(name) as czi:
+            image = czi.read().astype(np.float64)
+        # the sample files have a single tile without pyramid levels
+        h, w = image.shape[0] // 4, image.shape[1] // 4
+        expected = image[: h * 4, : w * 4].reshape(h, 4, w, 4).mean(axis=(1, 3))
+        assert overview.shape == (h, w)
+        assert np.array_equal(overview, np.round(expected))
+
+
+def test_overview_pyramid():
+    from pycziutils._stitch import _block_average, _flattened_series, _overview_tile
+
+    # the pyramid levels of the series are flattened in a row
+    assert _flattened_series([3, 1, 2]) == [
+        (0, 0),
+        (0, 1),
+        (0, 2),
+        (1, 0),
+        (2, 0),
+        (2, 1),
+    ]
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 4096, size=(144, 216)).astype(np.uint16)
+    for level_factor, downscale, expected_level in [
+        (2, 16, 3),
+        (2, 6, 1),
+        (3, 4, 0),  # the levels 1/3 and 1/9 do not divide 4
+        (3, 6, 1),
+        (3, 9, 2),
+    ]:
+        levels = [image]
+        for _ in range(3):
+            levels.append(_block_average(levels[-1], level_factor))
+        sizes = [level.shape for level in levels]
+        read = []
+
+        def read_level(level):
+            read.append(level)
+            return levels[level]
+
+        tile = _overview_tile(read_level, sizes, downscale)
+        assert read == [expected_level]
+        assert tile.shape == (144 // downscale, 216 // downscale)
+        factor = level_factor**expected_level
+        expected = _block_average(levels[expected_level], downscale // factor)
+        assert np.array_equal(tile, expected)
+
+
+def test_mosaic_canvas(tmp_path):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 4096, size=(230, 400)).astype(np.uint16)
+    offsets = [(y, x) for y in (0, 80) for x in (0, 100, 200, 300)]
+    for blending in ["overwrite", "linear"]:
+        out = str(tmp_path / f"{blending}.npy")
+        canvas = pycziutils.MosaicCanvas(
+            image.shape, image.dtype, out=out, blending=blending, strip_rows=37
+        )
+        for y, x in offsets:
+            canvas.add(image[y : y + 150, x : x + 100], y, x)
+        # overlaps of the same values are kept by both of the blendings
+        assert np.array_equal(canvas.finalize(), image)
+        assert np.array_equal(np.load(out), image)
+    assert sorted(os.listdir(tmp_path)) == ["linear.npy", "overwrite.npy"]
+
+
+def test_get_czi_planes(czi_files_path):
+    for name, data in czi_files_path:
+        planes_df = pycziutils.get_czi_planes(name)
+        assert_indices(planes_df["image"], data["tile"][0] * data["tile"][1])
+        assert_indices(planes_df["C_index"], len(data["channel"]))
+        assert_indices(planes_df["T_index"], data["time"])
+        assert_indices(planes_df["Z_index"], data["z"])
+        assert list(planes_df.sort_values("C_index")["C"].unique()) == data["channel"]
+        assert np.all(planes_df["X_size"] == data["area"][0] // data["binning"][0])
+        assert np.all(planes_df["Y_size"] == data["area"][1] // data["binning"][1])
+        assert not planes_df["absolute_T"].isna().any()
+
+        with pycziutils.CziFile(name) as czi:
+            assert len(czi.directory) == len(planes_df)
+            assert "<ImageDocument>" in czi.metadata_xml
+            for _, row in planes_df.iterrows():
+                image = czi.read(
+                    series=row["image"],
+                    t=row["T_index"],
+                    z=row["Z_index"],
+                    c=row["C_index"],
+                )
+                assert image.shape == (row["Y_size"], row["X_size"])
+                assert image.dtype == np.uint16
+                assert not image.flags.writeable  # zero-copy view
+                assert 0 < np.max(image) < 2 ** data["bitdepth"]
+
+                # read into a given buffer
+                out = np.zeros(image.shape, dtype=">u2")
+                assert czi.read(row["image"], c=row["C_index"], out=out) is out
+                assert np.array_equal(out, image)
+                with pytest.raises(ValueError):
+                    czi.read(row["image"], c=row["C_index"], out=out[1:])
+
+                # read a region
+                region = czi.read(
+                    row["image"], c=row["C_index"], region=(5, 10, 30, 20)
+                )
+                assert np.array_equal(region, image[10:30, 5:35])
+                region = czi.read(
+                    row["image"], c=row["C_index"], region=(slice(5, 35), slice(10, 30))
+                )
+                assert np.array_equal(region, image[10:30, 5:35])
+
+
+@pytest.mark.parametrize("compression", ["uncompressed", "zstd0", "zstd1"])
+def test_czi_compression(compression, tmp_path):
+    if compression != "uncompressed":
+        pytest.importorskip("zstandard")
+    sys.path.insert(0, path.join(path.dirname(__file__), "..", "benchmarks"))
+    try:
+        from synthetic import make_czi
+    finally:
+        sys.path.pop(0)
+
+    name = str(tmp_path / f"{compression}.czi")
+    pixels = make_czi(
+        name, tiles=2, T=2, channels=("Phase", "EGFP"), compression=compression
+    )
+    with pycziutils.CziFile(name) as czi:
+        for index, (image, t, z, c) in enumerate(np.ndindex(pixels.shape[:4])):
+            expected = pixels[image, t, z, c]
+            assert np.array_equal(czi.read_subblock(index), expected)
+            assert np.array_equal(czi.read(image, t, z, c), expected)
+            out = np.zeros(expected.shape, dtype=expected.dtype)
+            assert czi.read(image, t, z, c, out=out) is out
+            assert np.array_equal(out, expected)
+            region = czi.read_subblock(index, region=(5, 10, 30, 20))
+            assert np.array_equal(region, expected[10:30, 5:35])
+            out = np.zeros((20, 30), dtype=">u2")
+            assert czi.read(image, t, z, c, out=out, region=(5, 10, 30, 20)) is out
+            assert np.array_equal(out, expected[10:30, 5:35])
+
+
+def test_plane_index(czi_files_path):
+    for name, data in czi_files_path:
+        planes_df = pycziutils.get_czi_planes(name)
+        index = pycziutils.PlaneIndex(planes_df)
+        assert len(index) == len(planes_df)
+        assert index.shape == (1, data["time"], data["z"], len(data["channel"]))
+        assert index.to_dataframe().equals(planes_df)
+        for i, row in enumerate(planes_df.itertuples()):
+            assert index.lookup(row.image, row.T_index, row.Z_index, row.C_index) == i
+        assert np.array_equal(
+            index.lookup(0, c=planes_df["C_index"]), np.arange(len(planes_df))
+        )
+        with pytest.raises(KeyError):
+            index.lookup(0, c=len(data["channel"]))
+
+        # the range queries match the boolean masks
+        t0, t1 = planes_df["absolute_T"].min(), planes_df["absolute_T"].median()
+        planes = index.query(absolute_T=(t0, t1), X=(None, planes_df["X"].max()))
+        mask = planes_df["absolute_T"].between(t0, t1)
+        assert np.array_equal(planes, np.flatnonzero(mask))
+        assert index.to_dataframe(planes).equals(planes_df[mask].reset_index(drop=True))
+        assert len(index.query(C_index=(len(data["channel"]), None))) == 0
+
+
+def test_plane_index_missing_values():
+    planes_df = pd.DataFrame(
+        {
+            "image": [0, 1, 2, 3],
+            "T_index": 0,
+            "Z_index": 0,
+            "C_index": 0,
+            "X": [1.0, np.nan, 3.0, 2.0],
+            "absolute_T": pd.to_datetime(
+                ["2021-01-01", "2021-01-02", None, "2021-01-03"], utc=True
+            ),
+        }
+    )
+    index = pycziutils.PlaneIndex(planes_df)
+    assert np.array_equal(index.query(X=(None, None)), [0, 2, 3])
+    assert np.array_equal(index.query(absolute_T=(None, None)), [0, 1, 3])
+    assert np.array_equal(index.query(X=(2.0, None)), [2, 3])
+    assert np.array_equal(index.query(X=(None, None), absolute_T=(None, None)), [0, 3])
+    assert np.array_equal(
+        index.query(absolute_T=(planes_df["absolute_T"][1], None), X=(None, 3.0)),
+        [3],
+    )
+
+
+def test_tile_cache(czi_files_path):
+    # the file with the most channels
+    name, data = max(czi_files_path, key=lambda f: len(f[1]["channel"]))
+    assert len(data["channel"]) > 2
+    with pycziutils.CziFile(name) as czi:
+        image = czi.read()
+        cache = pycziutils.TileCache(max_bytes=2 * image.nbytes)
+        for c in [0, 1, 0, 2, 0, 1]:
+            cached = cache.read(czi.read, name, c=c)
+            assert np.array_equal(cached, czi.read(c=c))
+            assert not cached.flags.writeable
+        assert (cache.hits, cache.misses, cache.evictions) == (2, 4, 2)
+        assert cache.size == 2 * image.nbytes and len(cache) == 2
+
+
+def test_reduce_planes(czi_files_path):
+    name, data = max(czi_files_path, key=lambda f: len(f[1]["channel"]))
+    with pycziutils.CziFile(name) as czi:
+        planes = [czi.read(c=c) for c in range(len(data["channel"]))]
+    groups_df, results = pycziutils.reduce_planes(
+        name,
+        reductions=["max", "min", "mean", "histogram"],
+        reader="czifile",
+        bins=16,
+        value_range=(0, 2 ** data["bitdepth"]),
+    )
+    assert list(groups_df["C_index"]) == list(range(len(data["channel"])))
+    assert np.all(groups_df["planes"] == 1)
+    assert np.array_equal(results["max"], planes)
+    assert np.array_equal(results["min"], planes)
+    assert np.allclose(results["mean"], planes)
+    assert len(results["bin_edges"]) == 17
+    assert np.all(results["histogram"].sum(axis=1) == planes[0].size)
+
+    # reduced over the channels
+    groups_df, results = pycziutils.reduce_planes(
+        name, reductions=["sum"], group_by=["image"], reader="czifile"
+    )
+    assert list(groups_df["planes"]) == [len(data["channel"])]
+    assert np.allclose(results["sum"][0], np.sum(planes, axis=0))
+    with pytest.raises(ValueError):
+        pycziutils.reduce_planes(name, reductions=["median"], reader="czifile")
+
+
+def test_estimate_shading(czi_files_path):
+    name, data = max(czi_files_path, key=lambda f: len(f[1]["channel"]))
+    with pycziutils.CziFile(name) as czi:
+        planes = [czi.read(c=c) for c in range(len(data["channel"]))]
+    for method in ["median", "mean"]:
+        correction = pycziutils.estimate_shading(
+            name, method=method, downscale=10, dark=1, reader="czifile"
+        )
+        assert correction.flatfield.shape == (len(planes),) + planes[0].shape
+        assert np.allclose(correction.flatfield.mean(axis=(1, 2)), 1)
+        for c, plane in enumerate(planes):
+            # a single tile is flattened to its mean in each 10x10 block
+            corrected = correction.apply(plane, c)
+            blocks = corrected.reshape(35, 10, 40, 10).mean(axis=(1, 3))
+            assert np.allclose(blocks, np.mean(plane - 1.0), rtol=1e-4)
+
+    # applied on the fly
+    _, results = pycziutils.reduce_planes(
+        name, reductions=["max"], reader="czifile", correction=correction
+    )
+    assert results["max"].dtype == np.float32
+    assert np.allclose(results["max"][1], correction.apply(planes[1], 1))
+
+
+def test_metadata_cache(czi_files_path, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    cache = pycziutils.MetadataCache(cache_dir, max_bytes=2**20)
+    for name, _data in czi_files_path:
+        planes_df = pycziutils.get_czi_planes(name, acquisition_timezone=9)
+        for _ in range(2):
+            assert cache.get_czi_planes(name, acquisition_timezone=9).equals(planes_df)
+    assert cache.hits == len(czi_files_path)
+    assert cache.misses == len(czi_files_path)
+    assert cache.evictions == 0
+
+    cache = pycziutils.MetadataCache(cache_dir, max_bytes=1)
+    cache.get_czi_planes(czi_files_path[0][0])
+    assert cache.hits == 1
+    os.utime(czi_files_path[0][0])  # modified files are not taken from the cache
+    cache.get_czi_planes(czi_files_path[0][0])
+    assert cache.misses == 1
+    assert len(os.listdir(cache_dir)) == 1